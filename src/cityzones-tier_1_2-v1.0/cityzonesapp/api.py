@@ -27,6 +27,25 @@ def get_file_data(stream, fp, eof: str):
             fp.write(line.strip())
             fp.write(b'\n')
 
+def get_binary_file_data(stream, fp, eof: bytes):
+    # Scan until the beginning of data
+    while True:
+        if stream.readline() == b'\r\n':
+            break
+
+    # Lines are copied as they are, except for the line break before the
+    # boundary, which belongs to the multipart encoding
+    previous = b''
+    while True:
+        line = stream.readline()
+
+        if len(line) == 0 or line.startswith(eof):
+            fp.write(previous.removesuffix(b'\r\n'))
+            return
+        else:
+            fp.write(previous)
+            previous = line
+
 @bp.before_request
 def authorize():
     g.worker = db.session.query(models.Worker).where(models.Worker.token == str(request.headers.get('X-API-Key'))).first()
@@ -86,7 +105,8 @@ def post_result(id):
                 result.res_data = res_data
                 g.worker.tasks += 1
                 g.worker.last_task_at = datetime.now()
-                g.worker.total_time += res_data['time_classification'] + res_data['time_positioning']
+                # Workers with stage statistics report the time of the whole run
+                g.worker.total_time += res_data.get('time_total', res_data['time_classification'] + res_data['time_positioning'])
                 models.db.session.add(result)
                 models.db.session.add(g.worker)
                 models.db.session.commit()
@@ -112,6 +132,11 @@ def post_result(id):
                         fp = open(f'{os.getenv("RESULTS_DIR")}/{task.base_filename}_{dataname}.csv', 'wb')
                         get_file_data(request.stream, fp, boundary)
                         fp.close()
+
+                    elif dataname == 'raster':
+                        fp = open(f'{os.getenv("RESULTS_DIR")}/{task.base_filename}_raster.npz', 'wb')
+                        get_binary_file_data(request.stream, fp, boundary)
+                        fp.close()
                     
                     elif dataname == 'res_data':
                         fp = io.BytesIO()
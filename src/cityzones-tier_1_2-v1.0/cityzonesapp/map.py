@@ -1,5 +1,5 @@
 from flask import Blueprint, Response, current_app, render_template, request, send_file
-from . import meta, models
+from . import meta, models, raster
 import os
 import io
 import csv
@@ -141,6 +141,7 @@ def get_result(id):
 
         map_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_map.csv'
         edus_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_edus.csv'
+        raster_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_raster.npz'
         classification = {
             'polygon': [],
             'center_lat': 0,
@@ -166,21 +167,27 @@ def get_result(id):
             elif geojson_geometry.type == 'MultiPolygon':
                 classification['polygon'] = geojson_geometry.coordinates[0][0]
 
-            fp = open(map_file, 'r')
-            reader = csv.reader(fp)
-            fp.readline()  # Skip header line
+            if os.path.isfile(map_file):
+                fp = open(map_file, 'r')
+                reader = csv.reader(fp)
+                fp.readline()  # Skip header line
 
-            for row in reader:
-                M = row[1]
-                geodata = json.loads(row[2])
-                coord = geodata['coordinates']
-                classification[M].append(coord)
-                if coord[0] < left:   left   = coord[0]
-                if coord[0] > right:  right  = coord[0]
-                if coord[1] < bottom: bottom = coord[1]
-                if coord[1] > top:    top    = coord[1]
+                for row in reader:
+                    M = row[1]
+                    geodata = json.loads(row[2])
+                    coord = geodata['coordinates']
+                    classification[M].append(coord)
 
-            fp.close()
+                fp.close()
+            else:
+                classification.update(raster.get_classification(raster.load_raster(raster_file)))
+
+            for M in ['1', '2', '3']:
+                for coord in classification[M]:
+                    if coord[0] < left:   left   = coord[0]
+                    if coord[0] > right:  right  = coord[0]
+                    if coord[1] < bottom: bottom = coord[1]
+                    if coord[1] > top:    top    = coord[1]
 
             classification['center_lat'] = (bottom + top) / 2
             classification['center_lon'] = (left + right) / 2
@@ -215,15 +222,24 @@ def download_result(id):
         map_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_map.csv'
         edus_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_edus.csv'
         roads_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_roads.csv'
+        raster_file = f'{os.getenv("RESULTS_DIR")}/{result.task.base_filename}_raster.npz'
         zip_data = io.BytesIO()
 
         try:
             with ZipFile(zip_data, 'w', compression=ZIP_DEFLATED, compresslevel=9) as myzip:
-                myzip.write(map_file, arcname=f'{result.task.base_filename}_map.csv')
+                # Results sent as a raster get their map and roads CSV files rebuilt from it
+                if os.path.isfile(map_file) or not os.path.isfile(raster_file):
+                    myzip.write(map_file, arcname=f'{result.task.base_filename}_map.csv')
+                    if os.path.isfile(roads_file):
+                        myzip.write(roads_file, arcname=f'{result.task.base_filename}_roads.csv')
+                else:
+                    raster_data = raster.load_raster(raster_file)
+                    for name in ['map', 'roads']:
+                        with myzip.open(f'{result.task.base_filename}_{name}.csv', 'w') as fp:
+                            raster.write_csv(raster_data, name, io.TextIOWrapper(fp, encoding='utf-8', write_through=True))
+                    myzip.write(raster_file, arcname=f'{result.task.base_filename}_raster.npz')
                 if os.path.isfile(edus_file):
                     myzip.write(edus_file, arcname=f'{result.task.base_filename}_edus.csv')
-                if os.path.isfile(roads_file):
-                    myzip.write(roads_file, arcname=f'{result.task.base_filename}_roads.csv')
         except FileNotFoundError:
             return Response(json.dumps({'msg': 'The map file for this task is missing!'}), headers={'Content-type': 'application/json'}, status=404)
         
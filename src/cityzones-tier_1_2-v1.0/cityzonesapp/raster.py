@@ -0,0 +1,123 @@
+'''
+Raster results functions.
+
+These functions read the compact raster results written by riskzones.py
+(a NumPy .npz file) without depending on NumPy, and rebuild the map and roads
+CSV files from them.
+'''
+
+from zipfile import ZipFile
+import ast
+import struct
+
+# Zones written at once when building CSV files.
+CSV_CHUNK_SIZE = 65536
+
+def read_npy(data: bytes):
+    '''
+    Read an array in NumPy .npy format.
+
+    Returns a Python scalar for 0-d arrays or a flat list otherwise, along with
+    the array shape.
+    '''
+    if data[:6] != b'\x93NUMPY':
+        raise ValueError('Not a NumPy array file.')
+
+    if data[6] == 1:
+        length = struct.unpack('<H', data[8:10])[0]
+        begin = 10
+    else:
+        length = struct.unpack('<I', data[8:12])[0]
+        begin = 12
+
+    header = ast.literal_eval(data[begin:begin + length].decode('latin1'))
+    dtype = header['descr']
+    shape = header['shape']
+    body = data[begin + length:]
+
+    formats = {'|u1': 'B', '|b1': '?', '<i8': 'q', '<f8': 'd'}
+    if dtype not in formats or header['fortran_order']:
+        raise ValueError(f'Unsupported array type {dtype}.')
+
+    count = 1
+    for size in shape:
+        count *= size
+    values = list(struct.unpack(f'<{count}{formats[dtype]}', body[:count * struct.calcsize(formats[dtype])]))
+
+    if len(shape) == 0:
+        return values[0], shape
+    return values, shape
+
+def load_raster(filename: str) -> dict:
+    '''
+    Load a raster result file.
+    '''
+    raster = {}
+    with ZipFile(filename, 'r') as myzip:
+        for name in myzip.namelist():
+            raster[name.removesuffix('.npy')], _ = read_npy(myzip.read(name))
+    return raster
+
+def get_flagged_zones(raster: dict, name: str) -> list:
+    '''
+    Get the IDs of the zones with the flag name ('inside', 'roads' or 'edus')
+    set, in increasing order.
+    '''
+    n_zones = raster['grid_x'] * raster['grid_y']
+    zones = []
+    for i, byte in enumerate(raster[name]):
+        if byte == 0:
+            continue
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                zones.append(i * 8 + bit)
+
+    return [zone for zone in zones if zone < n_zones]
+
+def get_coordinates(raster: dict, zone: int) -> list:
+    '''
+    Get the [lon, lat] coordinates of the center of a zone, computed as
+    riskzones.py does.
+    '''
+    width = abs(raster['right'] - raster['left'])
+    height = abs(raster['top'] - raster['bottom'])
+    x = zone % raster['grid_x']
+    y = zone // raster['grid_x']
+    lon = x / raster['grid_x'] * width + raster['left'] + width / raster['grid_x'] / 2
+    lat = y / raster['grid_y'] * height + raster['bottom'] + height / raster['grid_y'] / 2
+    return [lon, lat]
+
+def get_classification(raster: dict) -> dict:
+    '''
+    Get the coordinates of the zones inside the AoI grouped by RL.
+    '''
+    classification = {}
+    for i in range(1, raster['M'] + 1):
+        classification[str(i)] = []
+
+    for zone in get_flagged_zones(raster, 'inside'):
+        classification[str(raster['RL'][zone])].append(get_coordinates(raster, zone))
+
+    return classification
+
+def write_csv(raster: dict, name: str, fp):
+    '''
+    Write the 'map' or 'roads' CSV file of a raster result to fp, in the same
+    format riskzones.py writes it.
+    '''
+    if name == 'map':
+        fp.write('system:index,class,.geo\n')
+        zones = get_flagged_zones(raster, 'inside')
+    else:
+        fp.write('system:index,.geo\n')
+        zones = get_flagged_zones(raster, 'roads')
+
+    for begin in range(0, len(zones), CSV_CHUNK_SIZE):
+        rows = []
+        for row, zone in enumerate(zones[begin:begin + CSV_CHUNK_SIZE], begin):
+            lon, lat = get_coordinates(raster, zone)
+            if name == 'map':
+                rows.append(f'{row:020},{raster["RL"][zone]},"{{""type"":""Point"",""coordinates"":[{lon},{lat}]}}"\n')
+            else:
+                rows.append(f'{row:020},"{{""type"":""Point"",""coordinates"":[{lon},{lat}]}}"\n')
+        fp.write(''.join(rows))
@@ -0,0 +1,339 @@
+# encoding:utf-8
+"""
+RiskZones benchmark
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This program times every stage of riskzones and every EDUs positioning
+algorithm on synthetic cities, so speed-ups can be measured and slowdowns
+caught before deploying new workers.
+
+Each benchmark case describes a city: its size, zone size, number of vertices
+of the AoI polygon, number of PoIs and spacing of its roads. The AoI GeoJSON,
+the OSM XML and the config file of the city are generated from a fixed seed,
+so every run uses the same inputs. The results are written in JSON and may be
+compared with a baseline, the results of a previous run on the same machine.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing as mp
+import numpy
+import riskzones
+
+# Benchmark cases. size and road_spacing are in meters.
+CASES = {
+    'small': {'size': 3000, 'zone_size': 25, 'vertices': 32, 'pois': 50, 'road_spacing': 200, 'edus': 100},
+    'medium': {'size': 8000, 'zone_size': 25, 'vertices': 64, 'pois': 200, 'road_spacing': 150, 'edus': 300},
+    'many_pois': {'size': 5000, 'zone_size': 25, 'vertices': 16, 'pois': 5000, 'road_spacing': 200, 'edus': 200,
+                  'risk_engine': 'approx'},
+    'many_vertices': {'size': 5000, 'zone_size': 25, 'vertices': 2000, 'pois': 100, 'road_spacing': 200, 'edus': 200},
+    'dense_roads': {'size': 5000, 'zone_size': 10, 'vertices': 32, 'pois': 100, 'road_spacing': 50, 'edus': 200},
+    'large_fft': {'size': 20000, 'zone_size': 25, 'vertices': 128, 'pois': 1000, 'road_spacing': 400, 'edus': 500,
+                  'risk_engine': 'fft'},
+}
+
+# Cases run when none are given.
+DEFAULT_CASES = ('small', 'medium', 'many_pois', 'many_vertices')
+
+EDU_ALGS = ('random', 'balanced', 'enhanced', 'restricted')
+
+# PoI types of the synthetic cities and their weights.
+POIS_TYPES = {
+    'amenity': {
+        'hospital': {'w': 10.0},
+        'fire_station': {'w': 5.0},
+        'police': {'w': 2.0}
+    },
+    'railway': {
+        'station': {'w': 3.0}
+    }
+}
+
+# Center of the synthetic cities and meters per degree of latitude.
+CENTER_LAT = 41.15
+CENTER_LON = -8.61
+METERS_PER_DEGREE = 111320
+
+# A stage is reported as slower than the baseline only if it takes more than
+# this many seconds, so the noise of very short stages is ignored.
+MIN_TIME = 0.05
+
+def make_city(directory: str, name: str, case: dict, seed: int = 0) -> dict:
+    """
+    Write the AoI GeoJSON and the OSM XML of a synthetic city to directory and
+    return its config.
+    """
+    rng = numpy.random.default_rng(seed)
+    half_lat = case['size'] / 2 / METERS_PER_DEGREE
+    half_lon = half_lat / numpy.cos(numpy.radians(CENTER_LAT))
+    bbox = (CENTER_LON - half_lon, CENTER_LAT - half_lat, CENTER_LON + half_lon, CENTER_LAT + half_lat)
+
+    # AoI: a star shaped polygon inside the grid
+    angles = numpy.sort(rng.uniform(0, 2 * numpy.pi, case['vertices']))
+    radius = 0.9 * rng.uniform(0.7, 1.0, case['vertices'])
+    polygon = numpy.column_stack((CENTER_LON + half_lon * radius * numpy.cos(angles),
+                                  CENTER_LAT + half_lat * radius * numpy.sin(angles))).tolist()
+    polygon.append(polygon[0])
+    geojson_data = {
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [polygon]}}]
+    }
+    fp = open(os.path.join(directory, f'{name}.geojson'), 'w')
+    json.dump(geojson_data, fp)
+    fp.close()
+
+    write_osm(os.path.join(directory, f'{name}.osm'), rng, bbox, case['pois'], case['road_spacing'])
+
+    conf = {
+        'left': bbox[0],
+        'bottom': bbox[1],
+        'right': bbox[2],
+        'top': bbox[3],
+        'zone_size': case['zone_size'],
+        'cache_zones': False,
+        'M': 3,
+        'edus': case['edus'],
+        'geojson': os.path.join(directory, f'{name}.geojson'),
+        'pois': os.path.join(directory, f'{name}.osm'),
+        'pois_types': POIS_TYPES,
+        'edu_alg': EDU_ALGS[0],
+        'output': os.path.join(directory, f'{name}.csv'),
+        'output_edus': os.path.join(directory, f'{name}_edus.csv'),
+        'output_roads': os.path.join(directory, f'{name}_roads.csv'),
+        'res_data': os.path.join(directory, f'{name}_res_data.json')
+    }
+    if 'risk_engine' in case.keys():
+        conf['risk_engine'] = case['risk_engine']
+
+    # The other algorithms run as scenarios, sharing the classification
+    conf['scenarios'] = [{'edu_alg': edu_alg} for edu_alg in EDU_ALGS[1:]]
+    return conf
+
+def write_osm(filename: str, rng: numpy.random.Generator, bbox: tuple, n_pois: int, road_spacing: float):
+    """
+    Write an OSM XML file with a grid of roads every road_spacing meters and
+    n_pois PoIs of random types. A tenth of the PoIs are buildings (ways).
+    """
+    left, bottom, right, top = bbox
+    step_lat = road_spacing / METERS_PER_DEGREE
+    step_lon = step_lat / numpy.cos(numpy.radians(CENTER_LAT))
+    lats = numpy.arange(bottom, top, step_lat)
+    lons = numpy.arange(left, right, step_lon)
+    types = [(key, value) for key in POIS_TYPES.keys() for value in POIS_TYPES[key].keys()]
+
+    fp = open(filename, 'w')
+    fp.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\" generator=\"riskzones benchmark\">\n")
+
+    # Road intersections, slightly moved so roads aren't perfectly aligned
+    jitter = 0.1
+    node_lat = lats[:, None] + rng.uniform(-jitter, jitter, (len(lats), len(lons))) * step_lat
+    node_lon = lons[None, :] + rng.uniform(-jitter, jitter, (len(lats), len(lons))) * step_lon
+    node_ids = numpy.arange(1, len(lats) * len(lons) + 1).reshape(len(lats), len(lons))
+    fp.write(''.join([f'  <node id="{id}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n'
+                      for id, lat, lon in zip(node_ids.ravel().tolist(), node_lat.ravel().tolist(), node_lon.ravel().tolist())]))
+    next_id = len(lats) * len(lons) + 1
+
+    # PoIs
+    pois_lat = rng.uniform(bottom, top, n_pois)
+    pois_lon = rng.uniform(left, right, n_pois)
+    pois_type = rng.integers(len(types), size=n_pois)
+    is_way = rng.random(n_pois) < 0.1
+    buildings = []
+    for lat, lon, type, way in zip(pois_lat.tolist(), pois_lon.tolist(), pois_type.tolist(), is_way.tolist()):
+        key, value = types[type]
+        if way:
+            fp.write(f'  <node id="{next_id}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+            buildings.append((next_id, key, value))
+        else:
+            fp.write(f'  <node id="{next_id}" lat="{lat:.7f}" lon="{lon:.7f}">\n'
+                     f'    <tag k="{key}" v="{value}"/>\n    <tag k="name" v="PoI {next_id}"/>\n  </node>\n')
+        next_id += 1
+
+    # Roads along the rows and columns of intersections
+    ways = [node_ids[row, :] for row in range(len(lats))] + [node_ids[:, col] for col in range(len(lons))]
+    for nodes in ways:
+        fp.write(f'  <way id="{next_id}">\n')
+        fp.write(''.join([f'    <nd ref="{node}"/>\n' for node in nodes.tolist()]))
+        fp.write('    <tag k="highway" v="residential"/>\n  </way>\n')
+        next_id += 1
+
+    for node, key, value in buildings:
+        fp.write(f'  <way id="{next_id}">\n    <nd ref="{node}"/>\n'
+                 f'    <tag k="building" v="yes"/>\n    <tag k="{key}" v="{value}"/>\n  </way>\n')
+        next_id += 1
+
+    fp.write('</osm>\n')
+    fp.close()
+
+def run_case(conf: dict, repeat: int) -> dict:
+    """
+    Run the pipeline for a city repeat times and return the statistics of
+    its stages (see stagestats), keeping the fastest run of each stage.
+
+    Stages shared by every positioning algorithm are in 'stages' and the
+    stages of each algorithm in 'edu_algs'.
+    """
+    result = {'stages': {}, 'edu_algs': {edu_alg: {} for edu_alg in EDU_ALGS}}
+    for i in range(repeat):
+        engine = riskzones.RiskZonesEngine(conf)
+        try:
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                engine.run()
+        finally:
+            engine.close()
+
+        keep_fastest(result['stages'], engine.stats.stages)
+        for edu_alg, run_stats in zip(EDU_ALGS, engine.runs_stats):
+            keep_fastest(result['edu_algs'][edu_alg], run_stats.stages)
+
+    return result
+
+def keep_fastest(stages: dict, new_stages: dict):
+    """
+    Keep in stages the fastest run of each stage in new_stages.
+    """
+    for name, stats in new_stages.items():
+        if name not in stages.keys() or stats['wall'] < stages[name]['wall']:
+            stages[name] = stats
+
+def get_times(results: dict) -> dict:
+    """
+    Get the wall time of every stage in results as a flat dict, with keys
+    like 'small/risk' or 'small/enhanced/positioning'.
+    """
+    times = {}
+    for case, result in results['cases'].items():
+        for name, stats in result['stages'].items():
+            times[f'{case}/{name}'] = stats['wall']
+        for edu_alg, stages in result['edu_algs'].items():
+            for name, stats in stages.items():
+                times[f'{case}/{edu_alg}/{name}'] = stats['wall']
+    return times
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare the stage times in results with a baseline and return the
+    stages slower than the baseline by more than tolerance (relative), as
+    (stage, baseline time, time) tuples.
+    """
+    slower = []
+    times = get_times(results)
+    for stage, baseline_time in get_times(baseline).items():
+        if stage not in times.keys():
+            continue
+        if times[stage] > MIN_TIME and times[stage] > baseline_time * (1 + tolerance):
+            slower.append((stage, baseline_time, times[stage]))
+    return slower
+
+def print_results(results: dict, baseline: dict = None):
+    """
+    Print a table with the wall time of every stage, and the ratio to the
+    baseline if given.
+    """
+    baseline_times = get_times(baseline) if baseline != None else {}
+    for stage, seconds in get_times(results).items():
+        line = f'{stage:40} {seconds:10.3f} s'
+        if stage in baseline_times.keys() and baseline_times[stage] > 0:
+            line += f' {seconds / baseline_times[stage]:8.2f}x'
+        print(line)
+
+if __name__ == '__main__':
+    """
+    Main program.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark riskzones on synthetic cities.')
+    parser.add_argument('--cases', default=','.join(DEFAULT_CASES),
+                        help=f'comma separated benchmark cases ({", ".join(CASES.keys())}, or all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case (the fastest is kept)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic cities')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown accepted by the comparison')
+    args = parser.parse_args()
+
+    # Python multiprocessing start method
+    mp.set_start_method('spawn')
+    riskzones.set_memory_limit()
+
+    cases = list(CASES.keys()) if args.cases == 'all' else args.cases.split(',')
+    for case in cases:
+        if case not in CASES.keys():
+            print(f'Unknown benchmark case: {case}.')
+            sys.exit(riskzones.EXIT_HELP)
+
+    results = {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'cpus': os.cpu_count(),
+            'mem_limit': riskzones.RES_MEM_SOFT
+        },
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cases': {}
+    }
+
+    directory = tempfile.mkdtemp(prefix='riskzones_benchmark_')
+    try:
+        # Warm up the pool, as in the worker, so its startup isn't timed
+        run_case(make_city(directory, 'warmup', CASES['small'], args.seed), 1)
+
+        for case in cases:
+            print(f'Running {case}... ', end='', flush=True)
+            conf = make_city(directory, case, CASES[case], args.seed)
+            results['cases'][case] = run_case(conf, args.repeat)
+            results['cases'][case]['case'] = CASES[case]
+            print('Done!')
+    finally:
+        riskzones.close_pool()
+        shutil.rmtree(directory, True)
+
+    baseline = None
+    if args.baseline != None:
+        fp = open(args.baseline, 'r')
+        baseline = json.load(fp)
+        fp.close()
+
+    print_results(results, baseline)
+
+    if args.output != None:
+        fp = open(args.output, 'w')
+        json.dump(results, fp, indent=2)
+        fp.close()
+
+    if baseline != None:
+        if baseline.get('machine') != results['machine']:
+            print(f'WARNING: the baseline was taken on another machine ({baseline.get("machine")}), so times may not be comparable.')
+        missing = sorted(set(get_times(baseline).keys()) - set(get_times(results).keys()))
+        if len(missing) > 0:
+            print(f'WARNING: stages of the baseline not run now: {", ".join(missing)}.')
+
+        slower = compare(results, baseline, args.tolerance)
+        for stage, baseline_time, seconds in slower:
+            print(f'SLOWER: {stage} took {seconds:.3f} s, baseline {baseline_time:.3f} s.')
+        if len(slower) > 0:
+            sys.exit(1)
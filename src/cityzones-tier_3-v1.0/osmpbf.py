@@ -0,0 +1,467 @@
+# encoding:utf-8
+"""
+RiskZones OSM PBF reader
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This module reads OSM PBF files (https://wiki.openstreetmap.org/wiki/PBF_Format)
+directly, without converting them to XML. The protobuf messages are decoded
+here, and the packed arrays of ids, coordinates and references with NumPy.
+
+Every data block of a file is read, decompressed and decoded on its own by
+read_nodes, read_ways and read_relations, so blocks can be handled in parallel
+by a process pool (see osmpois.extract_pois). Arrays given to these functions
+may be shmpool descriptors.
+"""
+
+import zlib
+import lzma
+import numpy
+import shmpool
+
+# Required features of PBF files this module can read
+SUPPORTED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes')
+
+# Types of the members of relations
+MEMBER_NODE = 0
+MEMBER_WAY = 1
+
+def read_varint(data: memoryview, pos: int) -> tuple[int, int]:
+    """
+    Read a varint from data at pos and return it and the position after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def read_message(data: memoryview) -> dict:
+    """
+    Decode the fields of a protobuf message in a dict of field number to the
+    list of its values: ints for varints and memoryviews for the others
+    (strings, bytes, embedded messages and packed arrays).
+    """
+    fields = {}
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}.')
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+def get_packed(fields: dict, number: int) -> memoryview:
+    """
+    Get the bytes of a packed array field, which may be split in several
+    chunks.
+    """
+    chunks = fields.get(number, [])
+    if len(chunks) == 1:
+        return chunks[0]
+    return memoryview(b''.join(chunks))
+
+def read_packed(data: memoryview) -> list:
+    """
+    Decode a short packed array of varints.
+    """
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+def decode_varints(data: memoryview) -> numpy.ndarray:
+    """
+    Decode a packed array of varints as uint64.
+    """
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    if len(raw) == 0:
+        return numpy.empty(0, dtype=numpy.uint64)
+
+    # Every varint ends in a byte without its high bit set
+    ends = numpy.flatnonzero(raw < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (numpy.arange(len(raw)) - numpy.repeat(starts, ends - starts + 1))
+    values = (raw & 0x7f).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+    return numpy.add.reduceat(values, starts)
+
+def read_messages(messages: list) -> tuple[numpy.ndarray, dict, dict]:
+    """
+    Decode the fields of many protobuf messages at once. Every field must be a
+    varint or hold only varints (packed arrays of varints and messages of
+    varints), as in OSM nodes, so the messages are a single array of varints.
+
+    Returns that array and, by field number, the values of varint fields for
+    every message (0 if missing) and the ranges [start, end) of the other
+    fields in the array (empty if missing). Repeated fields keep their last
+    value.
+    """
+    data = numpy.frombuffer(b''.join(messages), dtype=numpy.uint8)
+    values = decode_varints(data).astype(numpy.int64)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1)).astype(numpy.int64)
+
+    # Position (in varints) of the next field of every message
+    message_ends = numpy.searchsorted(starts, numpy.cumsum([len(message) for message in messages], dtype=numpy.int64))
+    pos = numpy.concatenate(([0], message_ends[:-1])).astype(numpy.int64)
+
+    varints = {}
+    ranges = {}
+    active = numpy.flatnonzero(pos < message_ends)
+    while len(active) > 0:
+        key = values[pos[active]]
+        numbers = key >> 3
+        wire_types = key & 7
+        if ((wire_types != 0) & (wire_types != 2)).any():
+            raise ValueError(f'Unsupported protobuf wire type {wire_types[(wire_types != 0) & (wire_types != 2)][0]}.')
+
+        value = values[pos[active] + 1]
+        begin = pos[active] + 2
+        end = numpy.where(wire_types == 2, numpy.searchsorted(starts, starts[numpy.minimum(begin, len(starts) - 1)] + value), begin)
+        end = numpy.where((wire_types == 2) & (value == 0), begin, end)
+        for number in numpy.unique(numbers).tolist():
+            field = numbers == number
+            if (wire_types[field] == 0).all():
+                varints.setdefault(number, numpy.zeros(len(messages), dtype=numpy.int64))[active[field]] = value[field]
+            else:
+                field_ranges = ranges.setdefault(number, numpy.zeros((len(messages), 2), dtype=numpy.int64))
+                field_ranges[active[field], 0] = begin[field]
+                field_ranges[active[field], 1] = end[field]
+
+        pos[active] = end
+        active = active[end < message_ends[active]]
+
+    return values, varints, ranges
+
+def decode_zigzag(values: numpy.ndarray) -> numpy.ndarray:
+    """
+    Decode zigzag encoded (sint64) varints.
+    """
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+def decode_deltas(data: memoryview) -> numpy.ndarray:
+    """
+    Decode a packed array of delta coded sint64 values.
+    """
+    return numpy.cumsum(decode_zigzag(decode_varints(data)))
+
+def to_int64(value: int) -> int:
+    """
+    Convert a varint to a signed int64 (negative values use 10 bytes).
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def read_blob(fp, size: int) -> memoryview:
+    """
+    Read a blob of size bytes from fp and return its decompressed data.
+    """
+    blob = read_message(memoryview(fp.read(size)))
+    if 1 in blob.keys():
+        return blob[1][0]
+    if 3 in blob.keys():
+        return memoryview(zlib.decompress(blob[3][0]))
+    if 4 in blob.keys():
+        return memoryview(lzma.decompress(blob[4][0]))
+    raise ValueError('Unsupported compression of a PBF blob.')
+
+def get_blocks(file: str) -> list:
+    """
+    Get the offset and size of every data blob in a PBF file, checking the
+    features required by its header.
+    """
+    blocks = []
+    fp = open(file, 'rb')
+    try:
+        while True:
+            length = fp.read(4)
+            if len(length) < 4:
+                break
+            header = read_message(memoryview(fp.read(int.from_bytes(length, 'big'))))
+            type = bytes(header[1][0]).decode()
+            size = header[3][0]
+
+            if type == 'OSMHeader':
+                for feature in read_message(read_blob(fp, size)).get(4, []):
+                    if bytes(feature).decode() not in SUPPORTED_FEATURES:
+                        raise ValueError(f'{file} requires the unsupported PBF feature {bytes(feature).decode()}.')
+            else:
+                if type == 'OSMData':
+                    blocks.append((fp.tell(), size))
+                fp.seek(size, 1)
+    finally:
+        fp.close()
+
+    return blocks
+
+def read_block(file: str, offset: int, size: int) -> dict:
+    """
+    Read a data block: its string table, the parameters of its coordinates
+    and its primitive groups.
+    """
+    fp = open(file, 'rb')
+    fp.seek(offset)
+    block = read_message(read_blob(fp, size))
+    fp.close()
+
+    return {
+        'strings': [bytes(string).decode() for string in read_message(block[1][0]).get(1, [])],
+        'granularity': block.get(17, [100])[0],
+        'lat_offset': to_int64(block.get(19, [0])[0]),
+        'lon_offset': to_int64(block.get(20, [0])[0]),
+        'groups': [read_message(group) for group in block.get(2, [])]
+    }
+
+def get_kinds(block: dict) -> set:
+    """
+    Get the kinds of elements in a block ('node', 'way', 'relation').
+    """
+    kinds = set()
+    for group in block['groups']:
+        if 1 in group.keys() or 2 in group.keys():
+            kinds.add('node')
+        if 3 in group.keys():
+            kinds.add('way')
+        if 4 in group.keys():
+            kinds.add('relation')
+    return kinds
+
+def get_array(array) -> numpy.ndarray:
+    """
+    Get an array given directly or as a shmpool descriptor.
+    """
+    return shmpool.attach(array) if isinstance(array, tuple) else array
+
+def isin_sorted(values: numpy.ndarray, sorted_ids: numpy.ndarray) -> numpy.ndarray:
+    """
+    Get a mask of the values found in a sorted array.
+    """
+    if len(sorted_ids) == 0:
+        return numpy.zeros(len(values), dtype=numpy.bool_)
+    index = numpy.searchsorted(sorted_ids, values)
+    index[index == len(sorted_ids)] = 0
+    return sorted_ids[index] == values
+
+def get_tags(strings: list, keys: list, values: list) -> dict:
+    """
+    Get the tags of an element from the indexes of its keys and values in the
+    string table.
+    """
+    return {strings[key]: strings[value] for key, value in zip(keys, values)}
+
+def read_nodes(file: str, offset: int, size: int, bbox: tuple, ids, keys: set, all_tagged: bool = False) -> dict:
+    """
+    Read the nodes of a block that are inside bbox (left, bottom, right, top)
+    or, if bbox is None, the ones in the sorted array ids. If all_tagged is
+    set, nodes with any tag in keys are read too.
+
+    Returns the kinds of elements in the block, the lowest and highest ids of
+    all its nodes ('id_range', None if it has no nodes), the ids and
+    coordinates ((N, 2) array of lat, lon) of the nodes read and the ones
+    among them with any tag in keys, as (id, lat, lon, tags) tuples. Nodes
+    with tags in keys are not in the arrays.
+    """
+    block = read_block(file, offset, size)
+    strings = block['strings']
+    wanted = numpy.array([string in keys for string in strings], dtype=numpy.bool_)
+    ids = get_array(ids) if ids is not None else None
+
+    result = {'kinds': get_kinds(block), 'id_range': None, 'ids': [], 'coords': [], 'tagged': []}
+    for group in block['groups']:
+        if 1 in group.keys():
+            # Plain nodes, all decoded at once
+            values, varints, ranges = read_messages(group[1])
+            missing = numpy.zeros(len(group[1]), dtype=numpy.int64)
+            node_ids = decode_zigzag(varints.get(1, missing).astype(numpy.uint64))
+            lat = decode_zigzag(varints.get(8, missing).astype(numpy.uint64))
+            lon = decode_zigzag(varints.get(9, missing).astype(numpy.uint64))
+            tags = (ranges.get(2, numpy.zeros((len(group[1]), 2), dtype=numpy.int64)),
+                    ranges.get(3, numpy.zeros((len(group[1]), 2), dtype=numpy.int64)))
+
+            # Nodes with any key in keys
+            counts = tags[0][:, 1] - tags[0][:, 0]
+            node = numpy.repeat(numpy.arange(len(node_ids)), counts)
+            index = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts - tags[0][:, 0], counts)
+            has_tags = numpy.zeros(len(node_ids), dtype=numpy.bool_)
+            has_tags[node[wanted[values[index]]]] = True
+        elif 2 in group.keys():
+            dense = read_message(group[2][0])
+            node_ids = decode_deltas(get_packed(dense, 1))
+            lat = decode_deltas(get_packed(dense, 8))
+            lon = decode_deltas(get_packed(dense, 9))
+
+            # Keys and values of all nodes in one array, each node ending with
+            # a 0 (the array is empty if no node has tags)
+            keys_vals = decode_varints(get_packed(dense, 10)).astype(numpy.int64)
+            ends = numpy.flatnonzero(keys_vals == 0)
+            has_tags = numpy.zeros(len(node_ids), dtype=numpy.bool_)
+            if len(ends) == len(node_ids) and len(ends) > 0:
+                starts = numpy.concatenate(([0], ends[:-1] + 1))
+                node = numpy.repeat(numpy.arange(len(ends)), ends - starts + 1)
+                is_key = ((numpy.arange(len(keys_vals)) - starts[node]) % 2 == 0) & (keys_vals != 0)
+                has_tags[node[is_key & wanted[keys_vals]]] = True
+        else:
+            continue
+
+        # Coordinates in nanodegrees divided by 1e9, giving the same floats as
+        # the decimal coordinates of XML files
+        lat = (block['lat_offset'] + block['granularity'] * lat) / 1e9
+        lon = (block['lon_offset'] + block['granularity'] * lon) / 1e9
+
+        if bbox != None:
+            left, bottom, right, top = bbox
+            selected = (lat >= bottom) & (lat <= top) & (lon >= left) & (lon <= right)
+        else:
+            selected = isin_sorted(node_ids, ids)
+        if all_tagged:
+            selected |= has_tags
+
+        tagged = selected & has_tags
+        for node in numpy.flatnonzero(tagged).tolist():
+            if 1 in group.keys():
+                node_tags = get_tags(strings, values[tags[0][node, 0]:tags[0][node, 1]].tolist(), values[tags[1][node, 0]:tags[1][node, 1]].tolist())
+            else:
+                pairs = keys_vals[starts[node]:ends[node]].tolist()
+                node_tags = get_tags(strings, pairs[0::2], pairs[1::2])
+            result['tagged'].append((int(node_ids[node]), float(lat[node]), float(lon[node]), node_tags))
+
+        if len(node_ids) > 0:
+            low, high = int(node_ids.min()), int(node_ids.max())
+            if result['id_range'] != None:
+                low, high = min(low, result['id_range'][0]), max(high, result['id_range'][1])
+            result['id_range'] = (low, high)
+
+        selected &= ~tagged
+        result['ids'].append(node_ids[selected])
+        result['coords'].append(numpy.column_stack((lat[selected], lon[selected])))
+
+    result['ids'] = numpy.concatenate(result['ids']) if len(result['ids']) > 0 else numpy.empty(0, dtype=numpy.int64)
+    result['coords'] = numpy.concatenate(result['coords']) if len(result['coords']) > 0 else numpy.empty((0, 2))
+    return result
+
+def read_ways(file: str, offset: int, size: int, node_ids, way_ids, keys: set) -> dict:
+    """
+    Read the ways of a block with at least one node in the sorted array
+    node_ids or, if node_ids is None, the ones with any tag in keys or in the
+    sorted array way_ids.
+
+    Returns their ids, their node references (concatenated in refs, the ones
+    of way i being refs[offsets[i]:offsets[i + 1]]) and their tags, only for
+    ways with any tag in keys (an empty dict for the others).
+    """
+    block = read_block(file, offset, size)
+    strings = block['strings']
+    wanted = numpy.array([string in keys for string in strings], dtype=numpy.bool_)
+
+    ids = []
+    tags = []
+    refs = []
+    for group in block['groups']:
+        for way in group.get(3, []):
+            fields = read_message(way)
+            ids.append(to_int64(fields[1][0]))
+            way_keys = read_packed(get_packed(fields, 2))
+            tags.append((way_keys, get_packed(fields, 3)) if wanted[way_keys].any() else None)
+            refs.append(get_packed(fields, 8))
+
+    # Decode the references of all ways at once. Deltas restart at each way,
+    # so the running sum is taken back to zero at the start of every way.
+    raw = numpy.frombuffer(b''.join(refs), dtype=numpy.uint8)
+    byte_ends = numpy.cumsum([len(way_refs) for way_refs in refs], dtype=numpy.int64)
+    offsets = numpy.concatenate(([0], numpy.searchsorted(numpy.flatnonzero(raw < 0x80), byte_ends)))
+    total = numpy.cumsum(decode_zigzag(decode_varints(raw)))
+    refs = total - numpy.repeat(numpy.concatenate(([0], total))[offsets[:-1]], numpy.diff(offsets))
+
+    if node_ids is not None:
+        # Ways with at least one node in node_ids
+        found = isin_sorted(refs, get_array(node_ids))
+        nonempty = numpy.diff(offsets) > 0
+        included = numpy.zeros(len(ids), dtype=numpy.bool_)
+        if nonempty.any():
+            included[nonempty] = numpy.logical_or.reduceat(found, offsets[:-1][nonempty])
+    else:
+        included = isin_sorted(numpy.array(ids, dtype=numpy.int64), get_array(way_ids))
+        included |= numpy.array([way_tags != None for way_tags in tags], dtype=numpy.bool_)
+
+    result = {'kinds': get_kinds(block), 'ids': [], 'offsets': [0], 'refs': [], 'tags': []}
+    for way in numpy.flatnonzero(included).tolist():
+        result['ids'].append(ids[way])
+        result['refs'].append(refs[offsets[way]:offsets[way + 1]])
+        result['offsets'].append(result['offsets'][-1] + len(result['refs'][-1]))
+        result['tags'].append(get_tags(strings, tags[way][0], read_packed(tags[way][1])) if tags[way] != None else {})
+
+    result['ids'] = numpy.array(result['ids'], dtype=numpy.int64)
+    result['offsets'] = numpy.array(result['offsets'], dtype=numpy.int64)
+    result['refs'] = numpy.concatenate(result['refs']) if len(result['refs']) > 0 else numpy.empty(0, dtype=numpy.int64)
+    return result
+
+def read_relations(file: str, offset: int, size: int, node_ids, way_ids, keys: set) -> dict:
+    """
+    Read the relations of a block with any member in the sorted arrays
+    node_ids and way_ids or, if they are None, the ones with any tag in keys.
+
+    Returns the kinds of elements in the block and the relations read as
+    (id, tags, member ways) tuples, with tags only for relations with any tag
+    in keys (an empty dict for the others) and the ids of their member ways in
+    order.
+    """
+    block = read_block(file, offset, size)
+    strings = block['strings']
+    wanted = numpy.array([string in keys for string in strings], dtype=numpy.bool_)
+    if node_ids is not None:
+        node_ids = get_array(node_ids)
+        way_ids = get_array(way_ids)
+
+    result = {'kinds': get_kinds(block), 'relations': []}
+    for group in block['groups']:
+        for relation in group.get(4, []):
+            fields = read_message(relation)
+            relation_keys = read_packed(get_packed(fields, 2))
+            has_tags = bool(wanted[relation_keys].any())
+            if node_ids is None and not has_tags:
+                continue
+
+            members = decode_deltas(get_packed(fields, 9))
+            types = numpy.array(read_packed(get_packed(fields, 10)), dtype=numpy.int64)
+            ways = members[types == MEMBER_WAY]
+            if node_ids is not None:
+                if not isin_sorted(members[types == MEMBER_NODE], node_ids).any() and not isin_sorted(ways, way_ids).any():
+                    continue
+
+            relation_tags = get_tags(strings, relation_keys, read_packed(get_packed(fields, 3))) if has_tags else {}
+            result['relations'].append((to_int64(fields[1][0]), relation_tags, ways))
+
+    return result
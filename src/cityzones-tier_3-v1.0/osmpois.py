@@ -17,148 +17,448 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
+import itertools
+import contextlib
 import xml.etree.ElementTree as ET
+import numpy
+import osmpbf
+import shmpool
+import stagestats
+
+# Highway types considered as roads
+ROAD_TYPES = ('motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential')
 
 '''
-Extract roads and PoIs of types pois_types from OSM file.
+Coordinates of OSM elements by id.
+
+Coordinates are appended to compact arrays while the file is read. On a
+lookup the ones added since the previous lookup are merged into NumPy arrays
+sorted by id, so ids are found by binary search and elements may be added in
+any order, even between lookups. An id added again replaces its coordinates.
 '''
-def extract_pois(file: str, pois_types: dict) -> tuple[list, list]:
-    tree = ET.parse(file)
-    root = tree.getroot()
+class CoordinateStore:
+    def __init__(self):
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.coords = numpy.empty((0, 2), dtype=numpy.float64)
+        self.new_ids = array.array('q')
+        self.new_coords = array.array('d')
+
+    def __len__(self) -> int:
+        self.merge()
+        return len(self.ids)
+
+    '''
+    Add the coordinates of an element.
+    '''
+    def add(self, id: int, lat: float, lon: float):
+        self.new_ids.append(id)
+        self.new_coords.append(lat)
+        self.new_coords.append(lon)
+
+    '''
+    Add the coordinates ((N, 2) array of lat, lon) of many elements.
+    '''
+    def extend(self, ids: numpy.ndarray, coords: numpy.ndarray):
+        self.new_ids.frombytes(numpy.ascontiguousarray(ids, dtype=numpy.int64).tobytes())
+        self.new_coords.frombytes(numpy.ascontiguousarray(coords, dtype=numpy.float64).tobytes())
+
+    '''
+    Merge the coordinates added since the last merge into the sorted arrays.
+    '''
+    def merge(self):
+        if len(self.new_ids) == 0:
+            return
+
+        ids = numpy.concatenate((self.ids, numpy.frombuffer(self.new_ids, dtype=numpy.int64)))
+        coords = numpy.concatenate((self.coords, numpy.frombuffer(self.new_coords, dtype=numpy.float64).reshape(-1, 2)))
+        self.new_ids = array.array('q')
+        self.new_coords = array.array('d')
+
+        if (ids[1:] <= ids[:-1]).any():
+            order = numpy.argsort(ids, kind='stable')
+            ids = ids[order]
+            coords = coords[order]
+
+            # Keep the last coordinates added for each id
+            last = numpy.append(ids[1:] != ids[:-1], True)
+            ids = ids[last]
+            coords = coords[last]
+
+        self.ids = ids
+        self.coords = coords
+
+    '''
+    Get the coordinates (an (N, 2) array of lat, lon) of the elements with ids
+    refs and a mask of the ones found. Coordinates of the missing elements are
+    undefined.
+    '''
+    def lookup(self, refs: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+        self.merge()
+        if len(self.ids) == 0:
+            return numpy.zeros((len(refs), 2)), numpy.zeros(len(refs), dtype=numpy.bool_)
+
+        index = numpy.searchsorted(self.ids, refs)
+        index[index == len(self.ids)] = 0
+        return self.coords[index], self.ids[index] == refs
+
+'''
+Extract roads and PoIs of types pois_types from an OSM file, in XML or PBF
+format (files ending in .pbf).
+
+Each PoI has its type as 'key=value' in 'type', and 'weight_override' set if
+its weight comes from a poi_weight tag instead of pois_types. Roads are
+returned as an (N, 4) array of segments: start lat, start lon, end lat and end
+lon.
+
+XML files are read as a stream (see iter_elements). From PBF files only the
+area inside bbox (left, bottom, right, top) is read, if given, and the blocks
+of the file are decoded in parallel by pool, a shmpool.SharedPool (see
+iter_pbf_elements). In both cases only the coordinates of ordinary nodes and
+ways are kept in memory (see CoordinateStore), and the tags of the PoIs.
+
+Each kind of OSM element is measured as a stage in stats, if given (see
+stagestats).
+'''
+def extract_pois(file: str, pois_types: dict, stats: stagestats.StageStats = None, bbox: tuple = None,
+                 pool: shmpool.SharedPool = None) -> tuple[list, numpy.ndarray]:
+    if stats == None:
+        stats = stagestats.StageStats()
+
+    weights = compile_pois_types(pois_types)
     pois = []
     roads = []
-    nodes = {}
-    ways = {}
-    relations = {}
-
-    # Collect nodes from OSM
-    for node in root.iter('node'):
-        id = int(node.get('id'))
-
-        node_data = {
-            'lat': float(node.get('lat')),
-            'lon': float(node.get('lon')),
-            'weight': 1.0
-        }
-
-        for tag in node.iter('tag'):
-            node_data[tag.get('k')] = tag.get('v')
-        
-        nodes[id] = node_data
-
-        # If this node already represents the requested pois_types, just add it to
-        # the list of POIs
-        for node_key in node_data.keys():
-            try:
-                if node_data[node_key] in pois_types[node_key].keys():
-                    if 'poi_weight' in node_data.keys():
-                        node_data['weight'] = float(node_data['poi_weight'])
-                    else:
-                        node_data['weight'] = pois_types[node_key][node_data[node_key]]['w']
-                    pois.append(node_data)
-            except KeyError:
-                pass
-    
-    # Collect ways from OSM
-    for way in root.iter('way'):
-        id = int(way.get('id'))
-
-        way_data = {
-            'weight': 1.0
-        }
-
-        # Ways contain a set of nodes, so we must gather them
-        way_nodes = []
-        way_roads = []
-        for node in way.iter('nd'):
-            way_nodes.append(int(node.get('ref')))
-
-            # Combine nodes in a way to make roads
-            if len(way_nodes) < 2: continue
-            try:
-                road = {}
-                road['start'] = {}
-                road['end'] = {}
-                road['start']['lat'] = nodes[way_nodes[-2]]['lat']
-                road['start']['lon'] = nodes[way_nodes[-2]]['lon']
-                road['end']['lat'] = nodes[way_nodes[-1]]['lat']
-                road['end']['lon'] = nodes[way_nodes[-1]]['lon']
-                way_roads.append(road)
-            except KeyError:
-                pass
-        
-        # Check if this way is a highway (roads, streets, etc.)
-        for tag in way.iter('tag'):
-            way_data[tag.get('k')] = tag.get('v')
-            if tag.get('k') == 'highway' and tag.get('v') in ['motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential']:
-                roads += way_roads
-
-        # Get the first available node to copy its coordinates
-        # (depending on the boundaries of the exported OSM file, some
-        # nodes may be out of the map)
-        for node in way_nodes:
-            if node in nodes:
-                way_data['lat'] = float(nodes[node]['lat'])
-                way_data['lon'] = float(nodes[node]['lon'])
-                break
-
-        ways[id] = way_data
-
-        # If this way already represents the requested pois_types, just add it to
-        # the list of POIs
-        for way_key in way_data.keys():
-            try:
-                if way_data[way_key] in pois_types[way_key].keys():
-                    if 'poi_weight' in way_data.keys():
-                        way_data['weight'] = float(way_data['poi_weight'])
-                    else:
-                        way_data['weight'] = pois_types[way_key][way_data[way_key]]['w']
-                    pois.append(way_data)
-            except KeyError:
-                pass
-
-    # Collect relations from OSM
-    for relation in root.iter('relation'):
-        id = int(relation.get('id'))
-
-        relation_data = {
-            'weight': 1.0
-        }
-
-        for tag in relation.iter('tag'):
-            relation_data[tag.get('k')] = tag.get('v')
-
-        # Relations contain a set of ways, so we must gather them
-        relation_ways = []
-        for member in relation.iter('member'):
-            if member.get('type') == 'way':
-                relation_ways.append(int(member.get('ref')))
-
-        # Get the first available way to copy its coordinates
-        # (depending on the boundaries of the exported OSM file, some
-        # ways may be out of the map)
-        for way in relation_ways:
-            if way in ways:
-                relation_data['lat'] = float(ways[way]['lat'])
-                relation_data['lon'] = float(ways[way]['lon'])
-                break
-
-        relations[id] = relation_data
-
-        # If this relation represents the requested pois_types, just add it to
-        # the list of POIs
-        for relation_key in relation_data.keys():
-            try:
-                if relation_data[relation_key] in pois_types[relation_key].keys():
-                    if 'poi_weight' in relation_data.keys():
-                        relation_data['weight'] = float(relation_data['poi_weight'])
-                    else:
-                        relation_data['weight'] = pois_types[relation_key][relation_data[relation_key]]['w']
-                    pois.append(relation_data)
-            except KeyError:
-                pass
-
-    return pois, roads
+    for kind, id, data, segments, record in iter_features(file, set(pois_types.keys()), stats, bbox, pool):
+        if segments is not None:
+            roads.append(segments)
+        if data != None:
+            record['pois'] += add_poi(pois, data, weights)
+
+    if len(roads) == 0:
+        return pois, numpy.empty((0, 4), dtype=numpy.float64)
+    return pois, numpy.concatenate(roads)
+
+'''
+Iterate over the features of an OSM file that may be PoIs or roads, as
+(kind, id, data, segments, record).
+
+data is the dict of a node, way or relation with tags (only nodes with any tag
+in keys, for PBF files), with its coordinates in 'lat' and 'lon' (missing if
+none of its nodes or ways is in the file) and 'weight' set to 1.0, or None.
+segments is the (N, 4) array of road segments of a highway way, or None.
+record is the record of the stage of its kind in stats (see iter_elements).
+'''
+def iter_features(file: str, keys: set, stats: stagestats.StageStats, bbox: tuple = None, pool: shmpool.SharedPool = None):
+    nodes = CoordinateStore()
+    ways = CoordinateStore()
+
+    if file.endswith('.pbf'):
+        elements = iter_pbf_elements(file, keys | {'highway'}, stats, bbox, pool)
+    else:
+        elements = iter_elements(file, stats)
+
+    for kind, id, data, tags, record in elements:
+        if kind == 'nodes':
+            nodes.extend(id, data)
+            record['nodes'] += len(id)
+
+        elif kind == 'node':
+            lat, lon = data
+            nodes.add(id, lat, lon)
+            record['nodes'] += 1
+
+            # Only nodes with tags may be PoIs
+            if tags == None:
+                continue
+
+            node_data = {
+                'lat': lat,
+                'lon': lon,
+                'weight': 1.0
+            }
+            node_data.update(tags)
+
+            yield kind, id, node_data, None, record
+
+        elif kind == 'way':
+            record['ways'] += 1
+
+            way_data = {
+                'weight': 1.0
+            }
+            way_data.update(tags)
+
+            # Ways contain a set of nodes (depending on the boundaries of the
+            # exported OSM file, some nodes may be out of the map)
+            coords, found = nodes.lookup(data)
+
+            # If this way is a highway (roads, streets, etc.), combine its
+            # nodes to make roads
+            segments = None
+            if way_data.get('highway') in ROAD_TYPES:
+                connected = found[:-1] & found[1:]
+                segments = numpy.hstack((coords[:-1][connected], coords[1:][connected]))
+                record['roads'] += len(segments)
+
+            # Get the first available node to copy its coordinates
+            first = numpy.flatnonzero(found)
+            if len(first) > 0:
+                way_data['lat'], way_data['lon'] = coords[first[0]].tolist()
+                ways.add(id, way_data['lat'], way_data['lon'])
+
+            yield kind, id, way_data, segments, record
+
+        elif kind == 'relation':
+            record['relations'] += 1
+
+            relation_data = {
+                'weight': 1.0
+            }
+            relation_data.update(tags)
+
+            # Relations contain a set of ways, so get the first available one
+            # to copy its coordinates (depending on the boundaries of the
+            # exported OSM file, some ways may be out of the map)
+            coords, found = ways.lookup(data)
+            first = numpy.flatnonzero(found)
+            if len(first) > 0:
+                relation_data['lat'], relation_data['lon'] = coords[first[0]].tolist()
+
+            yield kind, id, relation_data, None, record
+
+'''
+Compile pois_types into the weight of every PoI type by key and value, so
+elements are matched only against the keys of the config.
+'''
+def compile_pois_types(pois_types: dict) -> dict:
+    return {key: {value: poi_type['w'] for value, poi_type in types.items()} for key, types in pois_types.items()}
+
+'''
+Add an element to the list of PoIs if it represents any PoI type of weights
+(see compile_pois_types) and return how many times it was added.
+
+An element of several types is added once for each of them, all with the
+type of its last tag among them.
+'''
+def add_poi(pois: list, data: dict, weights: dict) -> int:
+    matched = [key for key, values in weights.items() if key in data.keys() and data[key] in values]
+    if len(matched) > 1:
+        matched.sort(key=list(data.keys()).index)
+
+    for key in matched:
+        data['type'] = f'{key}={data[key]}'
+        if 'poi_weight' in data.keys():
+            data['weight'] = float(data['poi_weight'])
+            data['weight_override'] = True
+        else:
+            data['weight'] = weights[key][data[key]]
+        pois.append(data)
+    return len(matched)
+
+'''
+Get the counts of the stage of a kind of OSM element.
+'''
+def get_stage_counts(kind: str) -> dict:
+    if kind == 'node':
+        return {'nodes': 0, 'pois': 0}
+    if kind == 'way':
+        return {'ways': 0, 'roads': 0, 'pois': 0}
+    return {'relations': 0, 'pois': 0}
+
+'''
+Iterate over the nodes, ways and relations of an OSM XML file as a stream.
+
+Each element is yielded as (kind, id, data, tags, record): data is (lat, lon)
+for nodes, the ids of their nodes for ways and the ids of their member ways for
+relations, tags is None for nodes without tags, and record is the record of
+the stage of its kind in stats ('osm_nodes', 'osm_ways' or 'osm_relations').
+
+Elements are dropped from the tree right after being read, so the memory used
+doesn't grow with the size of the file. As OSM files are sorted by kind, each
+stage measures the parsing and handling of all elements of a kind. Unsorted
+files are read too, each run of elements of a kind being added to the stage
+of its kind, but ways and relations only find the nodes and ways before them.
+'''
+def iter_elements(file: str, stats: stagestats.StageStats):
+    context = ET.iterparse(file, events=('start', 'end'))
+    _, root = next(context)
+    kinds = []
+
+    with contextlib.ExitStack() as stage:
+        for event, element in context:
+            if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+                continue
+
+            if len(kinds) == 0 or element.tag != kinds[-1]:
+                stage.close()
+                record = stage.enter_context(stats.stage(f'osm_{element.tag}s'))
+                record.update(get_stage_counts(element.tag))
+                kinds.append(element.tag)
+
+            id = int(element.get('id'))
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')} if len(element) > 0 else None
+            if element.tag == 'node':
+                yield 'node', id, (float(element.get('lat')), float(element.get('lon'))), tags, record
+            elif element.tag == 'way':
+                refs = numpy.array([int(node.get('ref')) for node in element.iter('nd')], dtype=numpy.int64)
+                yield 'way', id, refs, tags if tags != None else {}, record
+            else:
+                refs = numpy.array([int(member.get('ref')) for member in element.iter('member') if member.get('type') == 'way'], dtype=numpy.int64)
+                yield 'relation', id, refs, tags if tags != None else {}, record
+            root.clear()
+
+    # Kinds of elements missing in the file
+    for kind in ('node', 'way', 'relation'):
+        if kind not in kinds:
+            with stats.stage(f'osm_{kind}s') as record:
+                record.update(get_stage_counts(kind))
+
+'''
+Iterate over the nodes, ways and relations of an OSM PBF file with tags in
+keys, in the same way as iter_elements. Untagged nodes (and nodes without tags
+in keys) are yielded together as ('nodes', ids, coords, None, record).
+
+With bbox, only the area inside it is read, cut as osmium extract -b does by
+default (see read_pbf_area). Without it, the elements of the whole file that
+may be PoIs or roads are read (see read_pbf_file). The blocks of the file are
+decoded in parallel by pool, if given (see osmpbf).
+'''
+def iter_pbf_elements(file: str, keys: set, stats: stagestats.StageStats, bbox: tuple = None, pool: shmpool.SharedPool = None):
+    if bbox != None:
+        nodes, ways, relations = read_pbf_area(file, keys, stats, bbox, pool)
+    else:
+        nodes, ways, relations = read_pbf_file(file, keys, stats, pool)
+
+    with stats.stage('osm_nodes') as record:
+        record.update(get_stage_counts('node'))
+        yield 'nodes', numpy.concatenate([result['ids'] for result in nodes]), numpy.concatenate([result['coords'] for result in nodes]), None, record
+        for id, lat, lon, tags in sorted(itertools.chain(*[result['tagged'] for result in nodes])):
+            yield 'node', id, (lat, lon), tags, record
+
+    with stats.stage('osm_ways') as record:
+        record.update(get_stage_counts('way'))
+        for result in sorted(ways, key=lambda result: result['ids'][0] if len(result['ids']) > 0 else 0):
+            offsets = result['offsets'].tolist()
+            for i, id in enumerate(result['ids'].tolist()):
+                yield 'way', id, result['refs'][offsets[i]:offsets[i + 1]], result['tags'][i], record
+
+    with stats.stage('osm_relations') as record:
+        record.update(get_stage_counts('relation'))
+        for id, tags, refs in relations:
+            yield 'relation', id, refs, tags, record
+
+'''
+Read the area of an OSM PBF file inside bbox as osmium extract -b does:
+nodes inside bbox, ways with any of them and every node of these ways, and
+relations with any of these nodes or ways as members.
+
+The file is read in three passes, measured as stages in stats: nodes inside
+bbox ('pbf_nodes'), ways with them ('pbf_ways') and then the missing nodes of
+these ways and the relations ('pbf_complete'). Returns the results of
+osmpbf.read_nodes and osmpbf.read_ways for every block read and the relations
+sorted by id.
+'''
+def read_pbf_area(file: str, keys: set, stats: stagestats.StageStats, bbox: tuple, pool: shmpool.SharedPool) -> tuple:
+    blocks = osmpbf.get_blocks(file)
+
+    with stats.stage('pbf_nodes') as record:
+        nodes = map_blocks(pool, osmpbf.read_nodes, [(file, offset, size, bbox, None, keys) for offset, size in blocks])
+        _, way_blocks, relation_blocks = get_blocks_by_kind(blocks, nodes)
+        record['blocks'] = len(blocks)
+        record['nodes'] = sum(len(result['ids']) + len(result['tagged']) for result in nodes)
+        node_ids = get_node_ids(nodes)
+
+    with stats.stage('pbf_ways') as record:
+        shared_ids = share(pool, node_ids)
+        ways = map_blocks(pool, osmpbf.read_ways, [(file, offset, size, shared_ids, None, keys) for offset, size in way_blocks])
+        record['blocks'] = len(way_blocks)
+        record['ways'] = sum(len(result['ids']) for result in ways)
+
+    with stats.stage('pbf_complete') as record:
+        # Nodes of the ways outside bbox, only from the blocks whose range of
+        # node ids (seen in the first pass) holds any of them
+        missing = numpy.setdiff1d(numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + [result['refs'] for result in ways]), node_ids)
+        missing_blocks = [block for block, result in zip(blocks, nodes) if result['id_range'] != None and
+                          numpy.searchsorted(missing, result['id_range'][0]) < numpy.searchsorted(missing, result['id_range'][1], 'right')]
+        shared_ids = share(pool, missing)
+        completed = map_blocks(pool, osmpbf.read_nodes, [(file, offset, size, None, shared_ids, keys) for offset, size in missing_blocks])
+        record['blocks'] = len(missing_blocks)
+        record['nodes'] = sum(len(result['ids']) + len(result['tagged']) for result in completed)
+        nodes += completed
+
+        node_ids = get_node_ids(nodes)
+        way_ids = numpy.sort(numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + [result['ids'] for result in ways]))
+        shared_ids = (share(pool, node_ids), share(pool, way_ids))
+        relations = map_blocks(pool, osmpbf.read_relations, [(file, offset, size, *shared_ids, keys) for offset, size in relation_blocks])
+        relations = sorted(itertools.chain(*[result['relations'] for result in relations]), key=lambda relation: relation[0])
+        record['relations'] = len(relations)
+
+    return nodes, ways, relations
+
+'''
+Read the elements of a whole OSM PBF file that may be PoIs or roads: nodes,
+ways and relations with tags in keys, the member ways of these relations and
+the nodes of all these ways.
+
+The file is read backwards in three passes, measured as stages in stats:
+relations ('pbf_relations'), ways ('pbf_ways') and nodes ('pbf_nodes'), so
+untagged elements not needed by the others are never kept. Returns the same as
+read_pbf_area.
+'''
+def read_pbf_file(file: str, keys: set, stats: stagestats.StageStats, pool: shmpool.SharedPool) -> tuple:
+    blocks = osmpbf.get_blocks(file)
+
+    with stats.stage('pbf_relations') as record:
+        relations = map_blocks(pool, osmpbf.read_relations, [(file, offset, size, None, None, keys) for offset, size in blocks])
+        node_blocks, way_blocks, _ = get_blocks_by_kind(blocks, relations)
+        relations = sorted(itertools.chain(*[result['relations'] for result in relations]), key=lambda relation: relation[0])
+        member_ids = numpy.unique(numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + [refs for _, _, refs in relations]))
+        record['blocks'] = len(blocks)
+        record['relations'] = len(relations)
+
+    with stats.stage('pbf_ways') as record:
+        shared_ids = share(pool, member_ids)
+        ways = map_blocks(pool, osmpbf.read_ways, [(file, offset, size, None, shared_ids, keys) for offset, size in way_blocks])
+        record['blocks'] = len(way_blocks)
+        record['ways'] = sum(len(result['ids']) for result in ways)
+
+    with stats.stage('pbf_nodes') as record:
+        shared_ids = share(pool, numpy.unique(numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + [result['refs'] for result in ways])))
+        nodes = map_blocks(pool, osmpbf.read_nodes, [(file, offset, size, None, shared_ids, keys, True) for offset, size in node_blocks])
+        record['blocks'] = len(node_blocks)
+        record['nodes'] = sum(len(result['ids']) + len(result['tagged']) for result in nodes)
+
+    return nodes, ways, relations
+
+'''
+Get the blocks with nodes, ways and relations, given the results of reading
+every block of a file with osmpbf.
+'''
+def get_blocks_by_kind(blocks: list, results: list) -> tuple[list, list, list]:
+    return tuple([block for block, result in zip(blocks, results) if kind in result['kinds']] for kind in ('node', 'way', 'relation'))
+
+'''
+Get the sorted ids of the nodes read by osmpbf.read_nodes.
+'''
+def get_node_ids(results: list) -> numpy.ndarray:
+    return numpy.sort(numpy.concatenate([result['ids'] for result in results] +
+                                        [numpy.array([node[0] for node in result['tagged']], dtype=numpy.int64) for result in results]))
+
+'''
+Run func for every item of payload, in pool if given.
+'''
+def map_blocks(pool: shmpool.SharedPool, func, payload: list) -> list:
+    if pool == None:
+        return list(itertools.starmap(func, payload))
+    return pool.starmap(func, payload)
+
+'''
+Share an array with the workers of pool, if given.
+'''
+def share(pool: shmpool.SharedPool, array: numpy.ndarray):
+    if pool == None:
+        return array
+    return pool.share(array)
 
 '''
 Main program.
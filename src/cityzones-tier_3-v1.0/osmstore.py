@@ -0,0 +1,331 @@
+# encoding:utf-8
+"""
+RiskZones regional OSM store
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This module keeps the PoIs and road segments of a whole region, read once from
+its OSM PBF file, in a directory of square tiles, so the grid area of a task
+is read from a few small files instead of the regional file.
+
+Each tile is a NumPy .npz file with the PoIs inside it and the road segments
+whose bounding box overlaps it. manifest.json records the source file, the
+tile size, the PoI keys and a hash of every tile. When the source file
+changes, build() reads it again but only rewrites the tiles whose contents
+changed.
+
+Usage: python3 osmstore.py <OSM PBF file> <store directory> [--tile-size DEGREES] [--keys KEYS] [--force]
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing as mp
+import numpy
+import osmpois
+import shmpool
+import stagecache
+import stagestats
+
+# Version of the store format
+STORE_VERSION = 1
+
+# Default size of the tiles (degrees)
+TILE_SIZE = 0.1
+
+# Default keys of the PoIs kept in the store
+POI_KEYS = ('amenity', 'railway')
+
+# Tags kept with every PoI besides its keys
+POI_FIELDS = ('lat', 'lon', 'weight', 'poi_weight', 'name')
+
+# Order of the kinds of PoIs, the same order they are read from OSM files
+KINDS = ('node', 'way', 'relation')
+
+MANIFEST = 'manifest.json'
+
+def get_tile_filename(directory: str, tile: str) -> str:
+    """
+    Get the file name of a tile.
+    """
+    return os.path.join(directory, 'tiles', f'{tile}.npz')
+
+def get_tile_index(values: numpy.ndarray, tile_size: float) -> numpy.ndarray:
+    """
+    Get the index of the tiles of coordinates (lat or lon) along their axis.
+    """
+    return numpy.floor(numpy.asarray(values, dtype=numpy.float64) / tile_size).astype(numpy.int64)
+
+def load_manifest(directory: str) -> dict:
+    """
+    Get the manifest of a store, or None if there is no store in directory.
+    """
+    try:
+        fp = open(os.path.join(directory, MANIFEST), 'r')
+        manifest = json.load(fp)
+        fp.close()
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+def get_source_stat(file: str) -> list:
+    """
+    Get the size and modification time that identify a version of the source
+    file.
+    """
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_features(file: str, keys: tuple, stats: stagestats.StageStats, pool: shmpool.SharedPool) -> tuple:
+    """
+    Read the PoIs with any tag in keys and the road segments of a whole OSM
+    file.
+
+    Returns the (kind, id) of the PoIs, their data (only the tags in keys and
+    POI_FIELDS) and the road segments with their keys, way id << 16 | index
+    of the segment in the way (OSM ways have at most 2000 nodes).
+    """
+    poi_keys = []
+    pois = []
+    roads = []
+    road_keys = []
+    for kind, id, data, segments, record in osmpois.iter_features(file, set(keys), stats, None, pool):
+        if segments is not None and len(segments) > 0:
+            roads.append(segments)
+            road_keys.append((id << 16) + numpy.arange(len(segments), dtype=numpy.int64))
+
+        # PoIs without coordinates can't be in any tile
+        if data == None or 'lat' not in data.keys() or not any(key in data.keys() for key in keys):
+            continue
+        poi_keys.append((KINDS.index(kind), id))
+        pois.append({key: value for key, value in data.items() if key in keys or key in POI_FIELDS})
+        record['pois'] += 1
+
+    poi_keys = numpy.array(poi_keys, dtype=numpy.int64).reshape(-1, 2)
+    roads = numpy.concatenate(roads) if len(roads) > 0 else numpy.empty((0, 4), dtype=numpy.float64)
+    road_keys = numpy.concatenate(road_keys) if len(road_keys) > 0 else numpy.empty(0, dtype=numpy.int64)
+    return poi_keys, pois, roads, road_keys
+
+def split_tiles(poi_keys: numpy.ndarray, pois: list, roads: numpy.ndarray, road_keys: numpy.ndarray, tile_size: float) -> dict:
+    """
+    Split PoIs and road segments in tiles of tile_size degrees.
+
+    Each PoI goes to the tile of its coordinates and each segment to every
+    tile its bounding box overlaps. Returns the arrays of every tile by its
+    name, 'x_y' with the indexes of the tile along lon and lat.
+    """
+    tiles = {}
+
+    pois_x = get_tile_index([poi['lon'] for poi in pois], tile_size)
+    pois_y = get_tile_index([poi['lat'] for poi in pois], tile_size)
+    order = numpy.lexsort((poi_keys[:, 1], poi_keys[:, 0], pois_y, pois_x))
+    for indexes in split_groups(order, pois_x, pois_y):
+        data = json.dumps([pois[i] for i in indexes.tolist()]).encode()
+        tiles[f'{pois_x[indexes[0]]}_{pois_y[indexes[0]]}'] = {
+            'poi_keys': poi_keys[indexes],
+            'pois': numpy.frombuffer(data, dtype=numpy.uint8)
+        }
+
+    # One copy of each segment for every tile of its bounding box
+    x0 = get_tile_index(numpy.minimum(roads[:, 1], roads[:, 3]), tile_size)
+    x1 = get_tile_index(numpy.maximum(roads[:, 1], roads[:, 3]), tile_size)
+    y0 = get_tile_index(numpy.minimum(roads[:, 0], roads[:, 2]), tile_size)
+    y1 = get_tile_index(numpy.maximum(roads[:, 0], roads[:, 2]), tile_size)
+    width = x1 - x0 + 1
+    count = width * (y1 - y0 + 1)
+    segment = numpy.repeat(numpy.arange(len(roads)), count)
+    k = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+    roads_x = x0[segment] + k % width[segment]
+    roads_y = y0[segment] + k // width[segment]
+
+    order = numpy.lexsort((road_keys[segment], roads_y, roads_x))
+    for indexes in split_groups(order, roads_x, roads_y):
+        tile = tiles.setdefault(f'{roads_x[indexes[0]]}_{roads_y[indexes[0]]}', {})
+        tile['roads'] = roads[segment[indexes]]
+        tile['road_keys'] = road_keys[segment[indexes]]
+
+    for tile in tiles.values():
+        tile.setdefault('poi_keys', numpy.empty((0, 2), dtype=numpy.int64))
+        tile.setdefault('pois', numpy.frombuffer(b'[]', dtype=numpy.uint8))
+        tile.setdefault('roads', numpy.empty((0, 4), dtype=numpy.float64))
+        tile.setdefault('road_keys', numpy.empty(0, dtype=numpy.int64))
+    return tiles
+
+def split_groups(order: numpy.ndarray, x: numpy.ndarray, y: numpy.ndarray) -> list:
+    """
+    Split indexes sorted by tile (order) in groups of the same tile.
+    """
+    if len(order) == 0:
+        return []
+    changes = numpy.flatnonzero((numpy.diff(x[order]) != 0) | (numpy.diff(y[order]) != 0)) + 1
+    return numpy.split(order, changes)
+
+def build(file: str, directory: str, tile_size: float = TILE_SIZE, keys: tuple = POI_KEYS, force: bool = False,
+          stats: stagestats.StageStats = None, pool: shmpool.SharedPool = None) -> bool:
+    """
+    Build or refresh the store in directory from an OSM file (PBF or XML).
+
+    Nothing is done if the store was built from the same version of the file
+    with the same tile size and keys, unless force is set. Otherwise only the
+    tiles whose contents changed are written, each one atomically, then the
+    manifest and at last the tiles that no longer exist are deleted, so an
+    interrupted refresh is redone by the next call. Returns whether the store
+    was refreshed.
+    """
+    if stats == None:
+        stats = stagestats.StageStats()
+
+    keys = tuple(sorted(keys))
+    source = {'file': os.path.abspath(file), 'stat': get_source_stat(file)}
+    settings = {'version': STORE_VERSION, 'tile_size': tile_size, 'keys': list(keys)}
+
+    manifest = load_manifest(directory)
+    if manifest != None and manifest['settings'] != settings:
+        manifest = None
+    if manifest != None and manifest['source'] == source and not force:
+        return False
+
+    poi_keys, pois, roads, road_keys = read_features(file, keys, stats, pool)
+
+    with stats.stage('store_write') as record:
+        tiles = split_tiles(poi_keys, pois, roads, road_keys, tile_size)
+        hashes = {name: stagecache.get_key(name, *[tile[array] for array in sorted(tile.keys())]) for name, tile in tiles.items()}
+        old_hashes = manifest['tiles'] if manifest != None else {}
+
+        os.makedirs(os.path.join(directory, 'tiles'), exist_ok=True)
+        record['tiles'] = len(tiles)
+        record['written'] = 0
+        for name, tile in tiles.items():
+            filename = get_tile_filename(directory, name)
+            if old_hashes.get(name) == hashes[name] and os.path.isfile(filename):
+                continue
+            fp = open(f'{filename}.tmp', 'wb')
+            numpy.savez(fp, **tile)
+            fp.close()
+            os.replace(f'{filename}.tmp', filename)
+            record['written'] += 1
+
+        filename = os.path.join(directory, MANIFEST)
+        fp = open(f'{filename}.tmp', 'w')
+        json.dump({'source': source, 'settings': settings, 'tiles': hashes}, fp)
+        fp.close()
+        os.replace(f'{filename}.tmp', filename)
+
+        # Tiles left by a previous version of the source file or settings
+        record['deleted'] = 0
+        for entry in os.scandir(os.path.join(directory, 'tiles')):
+            if entry.name.endswith('.npz') and entry.name[:-4] not in hashes.keys():
+                os.remove(entry.path)
+                record['deleted'] += 1
+
+        record['pois'] = len(pois)
+        record['roads'] = len(roads)
+
+    return True
+
+def query(directory: str, bbox: tuple, pois_types: dict, stats: stagestats.StageStats = None) -> tuple[list, numpy.ndarray]:
+    """
+    Get the PoIs of types pois_types inside bbox (left, bottom, right, top)
+    and the road segments whose bounding box overlaps it, in the same format
+    as osmpois.extract_pois.
+
+    PoIs are in the same order as read from an OSM file. The keys of
+    pois_types must be among the keys the store was built with.
+    """
+    if stats == None:
+        stats = stagestats.StageStats()
+
+    manifest = load_manifest(directory)
+    if manifest == None:
+        raise FileNotFoundError(f'No OSM store in {directory}.')
+    missing = set(pois_types.keys()) - set(manifest['settings']['keys'])
+    if len(missing) > 0:
+        raise ValueError(f'The OSM store in {directory} has no PoIs of keys {", ".join(sorted(missing))}.')
+
+    with stats.stage('store_query') as record:
+        left, bottom, right, top = bbox
+        tile_size = manifest['settings']['tile_size']
+        x0, x1 = get_tile_index([left, right], tile_size).tolist()
+        y0, y1 = get_tile_index([bottom, top], tile_size).tolist()
+        names = [f'{x}_{y}' for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if f'{x}_{y}' in manifest['tiles'].keys()]
+
+        poi_keys = [numpy.empty((0, 2), dtype=numpy.int64)]
+        pois_data = []
+        roads = [numpy.empty((0, 4), dtype=numpy.float64)]
+        road_keys = [numpy.empty(0, dtype=numpy.int64)]
+        for name in names:
+            with numpy.load(get_tile_filename(directory, name)) as tile:
+                tile_pois = json.loads(tile['pois'].tobytes())
+                lat = numpy.array([poi['lat'] for poi in tile_pois], dtype=numpy.float64)
+                lon = numpy.array([poi['lon'] for poi in tile_pois], dtype=numpy.float64)
+                inside = numpy.flatnonzero((lat >= bottom) & (lat <= top) & (lon >= left) & (lon <= right))
+                poi_keys.append(tile['poi_keys'][inside])
+                pois_data += [tile_pois[i] for i in inside.tolist()]
+
+                segments = tile['roads']
+                overlaps = ((numpy.maximum(segments[:, 0], segments[:, 2]) >= bottom) & (numpy.minimum(segments[:, 0], segments[:, 2]) <= top) &
+                            (numpy.maximum(segments[:, 1], segments[:, 3]) >= left) & (numpy.minimum(segments[:, 1], segments[:, 3]) <= right))
+                roads.append(segments[overlaps])
+                road_keys.append(tile['road_keys'][overlaps])
+
+        # Segments overlapping several tiles are in all of them
+        road_keys, unique = numpy.unique(numpy.concatenate(road_keys), return_index=True)
+        roads = numpy.concatenate(roads)[unique]
+
+        poi_keys = numpy.concatenate(poi_keys)
+        weights = osmpois.compile_pois_types(pois_types)
+        pois = []
+        for i in numpy.lexsort((poi_keys[:, 1], poi_keys[:, 0])).tolist():
+            osmpois.add_poi(pois, pois_data[i], weights)
+
+        record['tiles'] = len(names)
+        record['pois'] = len(pois)
+        record['roads'] = len(roads)
+
+    return pois, roads
+
+if __name__ == '__main__':
+    """
+    Main program.
+    """
+    parser = argparse.ArgumentParser(description='Build or refresh a regional OSM store from an OSM PBF file.')
+    parser.add_argument('file', help='OSM PBF file of the region')
+    parser.add_argument('directory', help='directory of the store')
+    parser.add_argument('--tile-size', type=float, default=TILE_SIZE, help=f'size of the tiles in degrees (default {TILE_SIZE})')
+    parser.add_argument('--keys', default=','.join(POI_KEYS), help=f'comma separated keys of the PoIs to keep (default {",".join(POI_KEYS)})')
+    parser.add_argument('--force', action='store_true', help='read the file even if the store is up to date')
+    args = parser.parse_args()
+
+    # Python multiprocessing start method
+    mp.set_start_method('spawn')
+
+    stats = stagestats.StageStats()
+    pool = shmpool.SharedPool()
+    stats.get_pids = pool.get_pids
+    try:
+        refreshed = build(args.file, args.directory, args.tile_size, tuple(args.keys.split(',')), args.force, stats, pool)
+    finally:
+        pool.close()
+
+    if not refreshed:
+        print(f'{args.directory} is up to date.')
+        sys.exit(0)
+
+    for name, stage in stats.stages.items():
+        counts = ', '.join(f'{key}: {value}' for key, value in stage.items() if key not in ('cpu', 'workers_cpu', 'peak_rss', 'workers_peak_rss', 'wall'))
+        print(f'{name}: {stage["wall"]:.2f} s ({counts})')
@@ -21,6 +21,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 This module contains the functions for calculating zone risks from PoIs inside
 a bbox region.
 
+Zones are stored in columnar form: the grid object holds one NumPy array per
+zone attribute ('lat', 'lon', 'risk', 'RL', 'inside', 'has_edu', 'is_road'),
+indexed by zone ID (row * grid_x + column).
+
 After creating a grid object, use the following functions to calculate zone
 risks:
 
@@ -36,8 +40,18 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import osmpois
+import osmstore
+import shmpool
+import stagecache
+import stagestats
 import time
+import cProfile
 import json
+import hashlib
+import gzip
+import tempfile
+import shutil
+import atexit
 import geojson
 import sys
 import os
@@ -53,6 +67,17 @@ class OutOfBounds(Exception):
 class SkipZone(Exception):
     pass
 
+class InvalidCache(Exception):
+    pass
+
+class RiskZonesError(Exception):
+    """
+    Error that stops a run, with the exit status of the program.
+    """
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
 # Exit status
 EXIT_OK = 0
 EXIT_HELP = 1
@@ -61,14 +86,8 @@ EXIT_NO_ZONES = 3
 EXIT_NO_POIS = 4
 EXIT_NO_MEMORY = 5
 
-# Resources limits
-RES_MEM_SOFT, RES_MEM_HARD = resource.getrlimit(resource.RLIMIT_DATA)
+# Resources limits (applied with set_memory_limit)
 RES_MEM_SOFT = int(os.getenv('MEM_LIMIT')) * (1024 ** 2) if os.getenv('MEM_LIMIT') != None else 1024 ** 3
-resource.setrlimit(resource.RLIMIT_DATA, (RES_MEM_SOFT, RES_MEM_HARD))
-
-# Maximum and minimum values for integers.
-MIN_NUM = 10 ** (-10)
-MAX_NUM = 10 ** 10
 
 # Positioning modes.
 UNBALANCED = 1
@@ -78,9 +97,94 @@ RESTRICTED = 3
 # Multiprocessing
 MP_WORKERS=None  # If None, will use a value returned by the system
 
-def create_riskzones_grid(left: float, bottom: float, right: float, top: float, zone_size: int, M: int, n_edus: int) -> dict:
+# Maximum number of (zone, PoI) pairs evaluated at once by the risk engine.
+RISK_CHUNK_SIZE = 2 ** 20
+
+# Tiled mode: grids whose zone arrays would take more than TILED_MEMORY_SHARE
+# of the memory limit keep them in memory-mapped spill files (in SPILL_DIR, or
+# the system temporary directory) and are processed TILE_ZONES zones at a time.
+ZONE_BYTES = 52                 # Bytes used by the zone arrays for each zone
+TILED_MEMORY_SHARE = 0.5
+TILE_ZONES = 2 ** 22
+
+# Maximum number of road segments rasterized at once.
+ROADS_CHUNK_SIZE = 2 ** 16
+
+# Risk engines.
+RISK_EXACT = 'exact'    # Sum the influence of every PoI on every zone
+RISK_APPROX = 'approx'  # Sum nearby PoIs and approximate distant buckets of PoIs
+RISK_FFT = 'fft'        # Convolve a raster of PoI weights with the 1 / d^2 kernel
+
+# Default parameters for the approximate risk engine.
+RISK_RADIUS = 1000      # Bucket size (meters). PoIs in neighbour buckets are always summed
+RISK_TOLERANCE = 0.01   # Maximum relative error accepted for each approximated bucket
+
+# Default window (in zones) around each PoI computed exactly by the FFT risk engine.
+FFT_WINDOW = 16
+
+# Number of rows formatted at once by the CSV writers and gzip level of
+# compressed outputs (files ending in '.gz').
+CSV_CHUNK_SIZE = 2 ** 16
+CSV_GZIP_LEVEL = 6
+
+# Zones cache file format.
+CACHE_MAGIC = b'RZCACHE1'
+CACHE_ALIGN = 64                # Arrays start at multiples of this offset
+CACHE_ARRAYS = ('risk', 'RL', 'inside', 'zones_inside')
+
+# Configuration keys that change the classification stored in the zones cache.
+CACHE_CONF_KEYS = ('left', 'bottom', 'right', 'top', 'zone_size', 'M', 'geojson', 'pois', 'pois_types',
+                   'risk_engine', 'risk_radius', 'risk_tolerance', 'fft_window', 'haversine')
+
+# Earth radius (meters) used by the haversine formula.
+EARTH_RADIUS = 6378137
+
+# Process pool shared by every stage of a run (see get_pool).
+pool = None
+
+def set_memory_limit(limit: int = RES_MEM_SOFT) -> tuple:
+    """
+    Set the soft memory limit of this process (and the processes it starts
+    from now on) and return the previous limits.
+    """
+    limits = resource.getrlimit(resource.RLIMIT_DATA)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limits[1]))
+    return limits
+
+def get_pool() -> shmpool.SharedPool:
+    """
+    Get the process pool for this run, starting it on first use.
+
+    Every worker sets the memory limit (see set_memory_limit) when it starts,
+    so the limit applies to the workers whenever the pool was started.
+    """
+    global pool
+    if pool == None:
+        pool = shmpool.SharedPool(MP_WORKERS, set_memory_limit, (RES_MEM_SOFT,))
+    return pool
+
+def get_pool_pids() -> list:
+    """
+    Get the PIDs of the pool workers, if the pool was started.
+    """
+    return pool.get_pids() if pool != None else []
+
+def close_pool(terminate: bool = False):
+    """
+    Stop the process pool if it was started, without waiting for pending
+    tasks if terminate is set.
+    """
+    global pool
+    if pool != None:
+        pool.close(terminate)
+        pool = None
+
+def create_riskzones_grid(left: float, bottom: float, right: float, top: float, zone_size: int, M: int, n_edus: int, haversine: bool = False) -> dict:
     """
     Create a riskzones grid object for futher manipulation.
+
+    Distances are measured on a local projection of the grid unless haversine
+    is True, in which case the haversine formula is used everywhere.
     """
     grid = {
         'left': left,
@@ -92,11 +196,12 @@ def create_riskzones_grid(left: float, bottom: float, right: float, top: float,
         'height': abs(top - bottom),
         'M': M,
         'n_edus': n_edus,
+        'haversine': haversine,
         'edus': {},
         'polygons': [],
         'pol_points': 0,
-        'zones': [],
-        'zones_inside': [],
+        'n_zones': 0,
+        'zones_inside': numpy.empty(0, dtype=numpy.int64),
         'pois': [],
         'roads': [],
         'roads_points': 0,
@@ -115,8 +220,35 @@ def create_riskzones_grid(left: float, bottom: float, right: float, top: float,
     grid['zone_center'] = {'x': grid['width'] / grid['grid_x'] / 2, 'y': grid['height'] / grid['grid_y'] / 2}
     print(f'Grid size: {grid["grid_x"]}x{grid["grid_y"]}')
 
+    # Local projection: equirectangular about the center of the grid
+    lat0 = (top + bottom) / 2
+    grid['projection'] = {
+        'lat0': lat0,
+        'lon0': (left + right) / 2,
+        'kx': EARTH_RADIUS * numpy.cos(numpy.radians(lat0)) * numpy.pi / 180,  # Meters per degree of longitude
+        'ky': EARTH_RADIUS * numpy.pi / 180                                     # Meters per degree of latitude
+    }
+    set_pois(grid, [])
+
     return grid
 
+def project(grid: dict, lat, lon) -> tuple:
+    """
+    Convert geographic coordinates to the grid local projection (meters).
+    """
+    x = (lon - grid['projection']['lon0']) * grid['projection']['kx']
+    y = (lat - grid['projection']['lat0']) * grid['projection']['ky']
+    return x, y
+
+def unproject(grid: dict, x, y) -> tuple:
+    """
+    Convert coordinates in the grid local projection back to latitude and
+    longitude.
+    """
+    lat = y / grid['projection']['ky'] + grid['projection']['lat0']
+    lon = x / grid['projection']['kx'] + grid['projection']['lon0']
+    return lat, lon
+
 def calculate_distance(a: dict, b: dict) -> float:
     """
     Calculate the distance from a to b using haversine formula.
@@ -125,65 +257,255 @@ def calculate_distance(a: dict, b: dict) -> float:
     lat2 = numpy.radians(b['lat'])
     lon1 = numpy.radians(a['lon'])
     lon2 = numpy.radians(b['lon'])
-    r = 6378137
+    r = EARTH_RADIUS
     return 2 * r * numpy.arcsin(numpy.sqrt(numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2))
 
-def calculate_distance_in_grid(grid: dict, a: dict, b: dict) -> int:
+def calculate_distance_projected(a: dict, b: dict) -> float:
     """
-    Calculate the distance from a to b in the grid.
+    Calculate the distance from a to b using their coordinates in the grid
+    local projection.
     """
-    x1 = a['id'] % grid['grid_x']
-    x2 = b['id'] % grid['grid_x']
-    y1 = int(a['id'] / grid['grid_x'])
-    y2 = int(b['id'] / grid['grid_x'])
-    return numpy.sqrt(abs(x2 - x1) ** 2 + abs(y2 - y1) ** 2)
+    return numpy.sqrt((b['x'] - a['x']) ** 2 + (b['y'] - a['y']) ** 2)
+
+def calculate_point_distance(a: dict, b: dict) -> float:
+    """
+    Calculate the distance from a to b with the coordinates they carry: the
+    haversine formula for 'lat'/'lon' points and the local projection for
+    'x'/'y' points (see get_coordinates).
+    """
+    if 'lat' in a:
+        return calculate_distance(a, b)
+    else:
+        return calculate_distance_projected(a, b)
+
+def get_coordinates(grid: dict, ids) -> dict:
+    """
+    Get the coordinates of zones as a point dict, geographic if the grid uses
+    the haversine formula or projected otherwise.
+    """
+    if grid['haversine']:
+        return {'lat': grid['lat'][ids], 'lon': grid['lon'][ids]}
+    else:
+        return {'x': grid['x'][ids], 'y': grid['y'][ids]}
+
+def get_pois_coordinates(grid: dict, ids=slice(None)) -> dict:
+    """
+    Get the coordinates of PoIs as a point dict (see get_coordinates).
+    """
+    if grid['haversine']:
+        return {'lat': grid['pois_lat'][ids], 'lon': grid['pois_lon'][ids]}
+    else:
+        return {'x': grid['pois_x'][ids], 'y': grid['pois_y'][ids]}
 
 def init_zones(grid: dict):
     """
     Initialize every zone in the grid.
+
+    If the zone arrays would not fit the memory limit, the grid is switched
+    to tiled mode (see get_tiles).
     """
     print('Initializing data structure for zones... ', end='')
-    try:
-        grid['zones'].clear()
-        grid['zones_inside'].clear()
-
-        for j in range(grid['grid_y']):
-            for i in range(grid['grid_x']):
-                zone = {
-                    'id': j * grid['grid_x'] + i,
-                    'lat': (j / grid['grid_y'] * grid['height']) + grid['bottom'] + grid['zone_center']['y'],
-                    'lon': (i / grid['grid_x'] * grid['width']) + grid['left'] + grid['zone_center']['x'],
-                    'risk': 1.0,
-                    'RL': grid['M'],
-                    'inside': True,
-                    'has_edu': False,
-                    'is_road': False
-                }
-
-                grid['zones'].append(zone)
-                grid['zones_inside'].append(zone['id'])
+    grid['n_zones'] = grid['grid_x'] * grid['grid_y']
+    grid['tiled'] = grid['n_zones'] * ZONE_BYTES > RES_MEM_SOFT * TILED_MEMORY_SHARE
 
+    try:
+        allocate_zones(grid)
     except MemoryError:
-        print('--- Memory limit reached! ---')
-        print(f'riskzones is configured to use at most {RES_MEM_SOFT} bytes of memory.')
-        print('If you think this limit is too low, you can raise it by setting the value of RES_MEM_SOFT in this script.')
-        exit(EXIT_NO_MEMORY)
-    
-    print('Done!')
+        if grid['tiled']:
+            raise get_memory_error()
+
+        grid['tiled'] = True
+        allocate_zones(grid)
+
+    if grid['tiled']:
+        print(f'Done! Zones don\'t fit in memory, using tiled mode with spill files in {grid["spill_dir"]}.')
+    else:
+        print('Done!')
+
+def get_memory_error() -> RiskZonesError:
+    """
+    Get the error raised when the memory limit is reached.
+    """
+    return RiskZonesError('--- Memory limit reached! ---\n'
+                          f'riskzones is configured to use at most {RES_MEM_SOFT} bytes of memory.\n'
+                          'If you think this limit is too low, you can raise it by setting MEM_LIMIT in .env.',
+                          EXIT_NO_MEMORY)
+
+def allocate_zones(grid: dict):
+    """
+    Allocate and fill the zone arrays.
+    """
+    if grid['tiled']:
+        grid['spill_dir'] = tempfile.mkdtemp(prefix='riskzones_', dir=os.getenv('SPILL_DIR'))
+        atexit.register(shutil.rmtree, grid['spill_dir'], True)
+
+    rows = numpy.arange(grid['grid_y'])
+    cols = numpy.arange(grid['grid_x'])
+    lat = (rows / grid['grid_y'] * grid['height']) + grid['bottom'] + grid['zone_center']['y']
+    lon = (cols / grid['grid_x'] * grid['width']) + grid['left'] + grid['zone_center']['x']
+    x = project(grid, lat[0], lon)[0]
+    y = project(grid, lat, lon[0])[1]
+
+    for name, dtype in (('lat', numpy.float64), ('lon', numpy.float64), ('x', numpy.float64), ('y', numpy.float64),
+                        ('risk', numpy.float64), ('RL', numpy.uint8), ('inside', numpy.bool_),
+                        ('has_edu', numpy.bool_), ('is_road', numpy.bool_), ('zones_inside', numpy.int64)):
+        grid[name] = new_zones_array(grid, name, grid['n_zones'], dtype)
+
+    for row_begin, row_end in get_tiles(grid, grid['grid_y'], grid['grid_x']):
+        zones = slice(row_begin * grid['grid_x'], row_end * grid['grid_x'])
+        grid['lat'][zones] = numpy.repeat(lat[row_begin:row_end], grid['grid_x'])
+        grid['lon'][zones] = numpy.tile(lon, row_end - row_begin)
+        grid['x'][zones] = numpy.tile(x, row_end - row_begin)
+        grid['y'][zones] = numpy.repeat(y[row_begin:row_end], grid['grid_x'])
+        grid['risk'][zones] = 1
+        grid['RL'][zones] = grid['M']
+        grid['inside'][zones] = True
+        grid['has_edu'][zones] = False
+        grid['is_road'][zones] = False
+        grid['zones_inside'][zones] = numpy.arange(zones.start, zones.stop)
+
+def new_zones_array(grid: dict, name: str, size: int, dtype) -> numpy.ndarray:
+    """
+    Create an uninitialized zone array, in a spill file if the grid is tiled.
+    """
+    if grid['tiled'] and size > 0:
+        fd, filename = tempfile.mkstemp(prefix=f'{name}_', suffix='.bin', dir=grid['spill_dir'])
+        os.close(fd)
+        return numpy.memmap(filename, dtype=dtype, mode='w+', shape=(size,))
+    else:
+        return numpy.empty(size, dtype=dtype)
+
+def get_tiles(grid: dict, length: int, size: int = 1) -> list:
+    """
+    Split [0, length) in tiles of items of the given size (in zones).
+
+    Returns a single tile unless the grid is tiled, in which case each tile
+    has at most TILE_ZONES zones.
+    """
+    if not grid['tiled']:
+        return [(0, length)]
+
+    step = max(1, TILE_ZONES // size)
+    return [(begin, min(begin + step, length)) for begin in range(0, length, step)]
+
+def get_grid_geometry(grid: dict) -> dict:
+    """
+    Get the values that define the shape of the grid.
+    """
+    keys = ('left', 'bottom', 'right', 'top', 'zone_size', 'grid_x', 'grid_y', 'M', 'haversine')
+    return {key: grid[key] for key in keys}
+
+def get_cache_fingerprint(conf: dict) -> str:
+    """
+    Get a fingerprint of the configuration and input files a zones cache is
+    built from.
+
+    Input files are identified by their size and modification time (the
+    manifest of OSM stores), so a cache built before they were changed is not
+    trusted.
+    """
+    data = {key: conf.get(key) for key in CACHE_CONF_KEYS}
+    for key in ('geojson', 'pois'):
+        filename = conf.get(key)
+        if filename != None and os.path.isdir(filename):
+            filename = os.path.join(filename, osmstore.MANIFEST)
+        if filename != None and os.path.isfile(filename):
+            stat = os.stat(filename)
+            data[f'{key}_stat'] = [stat.st_size, stat.st_mtime_ns]
 
-def load_zones(grid: dict, zones: list):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def write_cache(grid: dict, filename: str, fingerprint: str):
     """
-    Load zones from JSON data.
+    Write the classified zones to a binary cache file.
+
+    The file has CACHE_MAGIC, the length of a JSON header and the header
+    itself (fingerprint, grid geometry and the type, shape and offset of each
+    array), followed by the raw arrays.
     """
-    grid['zones'].clear()
-    grid['zones_inside'].clear()
+    arrays = {}
+    offset = 0
+    for name in CACHE_ARRAYS:
+        arrays[name] = {'dtype': grid[name].dtype.str, 'shape': grid[name].shape, 'offset': offset}
+        offset += -(-grid[name].nbytes // CACHE_ALIGN) * CACHE_ALIGN
 
-    grid['zones'] = zones
-    grid['zones'].sort(key=lambda zone : zone['id'])
+    header = json.dumps({
+        'fingerprint': fingerprint,
+        'geometry': get_grid_geometry(grid),
+        'arrays': arrays
+    }).encode()
+    data_begin = -(-(len(CACHE_MAGIC) + 8 + len(header)) // CACHE_ALIGN) * CACHE_ALIGN
 
-    for zone in grid['zones']:
-        if zone['inside']:
-            grid['zones_inside'].append(zone['id'])
+    # Write to a temporary file first so an interrupted run doesn't leave a broken cache
+    fp = open(f'{filename}.tmp', 'wb')
+    fp.write(CACHE_MAGIC)
+    fp.write(len(header).to_bytes(8, 'little'))
+    fp.write(header)
+    for name in CACHE_ARRAYS:
+        fp.seek(data_begin + arrays[name]['offset'])
+        for begin, end in get_tiles(grid, len(grid[name])):
+            fp.write(numpy.ascontiguousarray(grid[name][begin:end]).tobytes())
+    fp.truncate(data_begin + offset)
+    fp.close()
+    os.replace(f'{filename}.tmp', filename)
+
+def load_cache(grid: dict, filename: str, fingerprint: str):
+    """
+    Load the classified zones from a binary cache file.
+
+    Arrays are memory mapped, so they are read from disk only when used.
+    Raises InvalidCache if the file is not a zones cache or was built from a
+    different configuration, and ValueError if it is corrupted.
+    """
+    fp = open(filename, 'rb')
+    if fp.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+        fp.close()
+        raise InvalidCache('not a zones cache file')
+    length = int.from_bytes(fp.read(8), 'little')
+    header = json.loads(fp.read(length))
+    size = os.fstat(fp.fileno()).st_size
+    fp.close()
+
+    if header['fingerprint'] != fingerprint:
+        raise InvalidCache('the cache was built from a different configuration or input files')
+    if header['geometry'] != get_grid_geometry(grid):
+        raise InvalidCache('the cache was built for a different grid')
+
+    data_begin = -(-(len(CACHE_MAGIC) + 8 + length) // CACHE_ALIGN) * CACHE_ALIGN
+    for name in CACHE_ARRAYS:
+        array = header['arrays'][name]
+        shape = tuple(array['shape'])
+        begin = data_begin + array['offset']
+        if begin + int(numpy.prod(shape)) * numpy.dtype(array['dtype']).itemsize > size:
+            raise ValueError(f'array {name} is truncated')
+
+        if numpy.prod(shape) == 0:
+            grid[name] = numpy.empty(shape, dtype=array['dtype'])
+        else:
+            grid[name] = numpy.memmap(filename, dtype=array['dtype'], mode='r', offset=begin, shape=shape)
+
+def load_stage(grid: dict, stages: stagecache.StageCache, stage: str, key: str) -> bool:
+    """
+    Load the outputs of a pipeline stage from the stage cache into the grid.
+    Returns False if they are not cached.
+    """
+    if stages == None:
+        return False
+
+    arrays = stages.load(key)
+    if arrays == None:
+        return False
+
+    print(f'Using cached {stage} stage.')
+    grid.update(arrays)
+    return True
+
+def store_stage(grid: dict, stages: stagecache.StageCache, key: str, names: tuple):
+    """
+    Store the outputs of a pipeline stage in the stage cache.
+    """
+    if stages != None:
+        stages.store(key, {name: grid[name] for name in names})
 
 def add_polygon(grid: dict, polygons: list):
     """
@@ -198,23 +520,76 @@ def add_polygon(grid: dict, polygons: list):
 def init_zones_by_polygon(grid: dict):
     """
     Check every zone if it is inside the polygon area.
+
+    The polygons are rasterized onto the grid row by row: the crossings of
+    every row with the polygon edges are computed once and the zones between
+    each pair of crossings are filled as a span.
     """
     print('Checking zones inside the polygon... ', end='')
 
-    grid['zones_inside'].clear()
-    
-    with mp.Pool(processes=MP_WORKERS) as pool:
-        payload = []
-        for zone in grid['zones']:
-            payload.append((zone, grid['polygons']))
-        grid['zones'] = pool.starmap(check_zone_in_polygon_set, payload)
-    
-    for zone in grid['zones']:
-        if zone['inside'] == True:
-            grid['zones_inside'].append(zone['id'])
+    rows_lat = grid['lat'][::grid['grid_x']]
+    cols_lon = grid['lon'][:grid['grid_x']]
+
+    polygon_spans = [get_polygon_spans(polygon, rows_lat, cols_lon) for polygon in grid['polygons']]
+
+    # Spans are accumulated as +1 at their first column and -1 after their last
+    # one, so a running sum through each row tells if a zone is inside any span.
+    tiles = get_tiles(grid, grid['grid_y'], grid['grid_x'])
+    count = 0
+    for row_begin, row_end in tiles:
+        spans = numpy.zeros((row_end - row_begin, grid['grid_x'] + 1), dtype=numpy.int32)
+        for rows, begin, end in polygon_spans:
+            tile = (rows >= row_begin) & (rows < row_end)
+            numpy.add.at(spans, (rows[tile] - row_begin, begin[tile]), 1)
+            numpy.add.at(spans, (rows[tile] - row_begin, end[tile]), -1)
+
+        inside = (numpy.cumsum(spans[:, :-1], axis=1) > 0).ravel()
+        grid['inside'][row_begin * grid['grid_x']:row_end * grid['grid_x']] = inside
+        count += int(numpy.count_nonzero(inside))
+
+    grid['zones_inside'] = new_zones_array(grid, 'zones_inside', count, numpy.int64)
+    count = 0
+    for row_begin, row_end in tiles:
+        zones = numpy.flatnonzero(grid['inside'][row_begin * grid['grid_x']:row_end * grid['grid_x']]) + row_begin * grid['grid_x']
+        grid['zones_inside'][count:count + len(zones)] = zones
+        count += len(zones)
 
     print('Done!')
-    print(f'{len(grid["zones_inside"])} of {len(grid["zones"])} zones inside the polygon.')
+    print(f'{len(grid["zones_inside"])} of {grid["n_zones"]} zones inside the polygon.')
+
+def get_polygon_spans(polygon: list, rows_lat: numpy.ndarray, cols_lon: numpy.ndarray) -> tuple:
+    """
+    Get the spans of columns inside a polygon for every row of the grid.
+
+    Returns three arrays: the row of each span, its first column and the
+    column right after its last one.
+    """
+    vertices = numpy.array(polygon, dtype=numpy.float64)[:, :2]
+    x1 = vertices[:, 0]
+    y1 = vertices[:, 1]
+    x2 = numpy.roll(x1, -1)
+    y2 = numpy.roll(y1, -1)
+
+    # Each edge crosses the rows whose latitude is in [min(y1, y2), max(y1, y2)).
+    # Horizontal edges don't cross any row.
+    first = numpy.searchsorted(rows_lat, numpy.minimum(y1, y2), side='left')
+    last = numpy.searchsorted(rows_lat, numpy.maximum(y1, y2), side='left')
+    count = last - first
+    edges = numpy.repeat(numpy.arange(len(x1)), count)
+    rows = numpy.repeat(first, count) + numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+
+    # Longitude where each edge crosses each row
+    y = rows_lat[rows]
+    x = x1[edges] + (y - y1[edges]) * (x2[edges] - x1[edges]) / (y2[edges] - y1[edges])
+
+    # Crossings sorted by row and longitude are paired as (enter, exit)
+    order = numpy.lexsort((x, rows))
+    rows = rows[order]
+    x = x[order]
+    begin = numpy.searchsorted(cols_lon, x[0::2], side='left')
+    end = numpy.searchsorted(cols_lon, x[1::2], side='left')
+
+    return rows[0::2], begin, end
 
 def init_pois_by_polygon(grid: dict, pois: list) -> list:
     """
@@ -222,291 +597,662 @@ def init_pois_by_polygon(grid: dict, pois: list) -> list:
     """
     print(f'Checking PoIs inside the polygon... ', end='')
 
-    grid['pois'].clear()
-    pois_results = []
-    
-    with mp.Pool(processes=MP_WORKERS) as pool:
-        payload = []
-        for poi in pois:
-            payload.append((poi, grid['polygons']))
-        pois_results = pool.starmap(check_zone_in_polygon_set, payload)
-    
-    for poi in pois_results:
-        if poi['inside'] == True:
-            grid['pois'].append(poi)
+    pois_inside = []
+    grid['pois_index'] = numpy.empty(0, dtype=numpy.int64)
+
+    if len(pois) > 0 and len(grid['polygons']) > 0:
+        pool = get_pool()
+        vertices = numpy.concatenate([numpy.array(polygon, dtype=numpy.float64)[:, :2] for polygon in grid['polygons']])
+        offsets = numpy.cumsum([0] + [len(polygon) for polygon in grid['polygons']])
+        inside = pool.empty((len(pois),), numpy.bool_)
+
+        # Each task checks a range of PoIs against every polygon edge
+        chunk = max(1, RISK_CHUNK_SIZE // len(vertices))
+        pool.map_ranges(check_pois_in_polygons, len(pois), chunk,
+            pool.share(numpy.array([poi['lat'] for poi in pois])),
+            pool.share(numpy.array([poi['lon'] for poi in pois])),
+            pool.share(vertices),
+            pool.share(offsets),
+            inside
+        )
+
+        grid['pois_index'] = numpy.flatnonzero(pool.view(inside))
+        pois_inside = [pois[i] for i in grid['pois_index'].tolist()]
+        pool.release()
+
+    set_pois(grid, pois_inside)
 
     print('Done!')
     print(f'{len(grid["pois"])} of {len(pois)} PoIs inside the polygon.')
 
-def check_zone_in_polygon_set(zone: dict, polygons: dict) -> bool:
+def set_pois(grid: dict, pois: list):
     """
-    Check a zone is inside any polygon in a polygons set.
+    Set the PoIs of the grid and their coordinates and weight arrays.
     """
-    zone['inside'] = False
-    for pol in polygons:
-        if check_zone_in_polygon(zone, pol):
-            zone['inside'] = True
-            break
+    grid['pois'] = pois
+    grid['pois_lat'] = numpy.array([poi['lat'] for poi in pois], dtype=numpy.float64)
+    grid['pois_lon'] = numpy.array([poi['lon'] for poi in pois], dtype=numpy.float64)
+    grid['pois_weight'] = numpy.array([poi['weight'] for poi in pois], dtype=numpy.float64)
+    grid['pois_group'] = numpy.array([poi['type'] if 'type' in poi.keys() and not poi.get('weight_override', False) else '' for poi in pois], dtype=str)
+    grid['pois_x'], grid['pois_y'] = project(grid, grid['pois_lat'], grid['pois_lon'])
 
-    return zone
-
-def check_zone_in_polygon(zone: dict, polygon: list) -> bool:
+def check_pois_in_polygons(pois_lat: tuple, pois_lon: tuple, vertices: tuple, offsets: tuple, inside: tuple, begin: int, end: int):
     """
-    Check if a zone is inside a polygon.
+    Pool task: check if the PoIs in [begin, end) are inside any polygon.
     """
-    line1 = {
-        'p1': {
-            'lon': zone['lon'],
-            'lat': zone['lat']
-        },
-        'p2': {
-            'lon': zone['lon'] + 180,
-            'lat': zone['lat']
-        }
-    }
+    pois_lat = shmpool.attach(pois_lat)[begin:end]
+    pois_lon = shmpool.attach(pois_lon)[begin:end]
+    vertices = shmpool.attach(vertices)
+    offsets = shmpool.attach(offsets)
 
-    intersec = 0
-    for i in range(-1, len(polygon) - 1):
-        line2 = {
-            'p1': {
-                'lon': polygon[i][0],
-                'lat': polygon[i][1]
-            },
-            'p2': {
-                'lon': polygon[i + 1][0],
-                'lat': polygon[i + 1][1]
-            }
-        }
-
-        # We only need to check the zone against lines at its right and if zone's latitude
-        # is between the line's latitudes
-        if  (line2['p1']['lon'] >= zone['lon'] or line2['p2']['lon'] >= zone['lon']) and \
-            ((line2['p1']['lat'] <= zone['lat'] <= line2['p2']['lat']) or ((line2['p2']['lat'] <= zone['lat'] <= line2['p1']['lat']))):
-            if check_intersection(line1, line2):
-                intersec += 1
-    
-    return intersec % 2 == 1
+    result = numpy.zeros(end - begin, dtype=numpy.bool_)
+    for i in range(len(offsets) - 1):
+        result |= check_points_in_polygon(pois_lat, pois_lon, vertices[offsets[i]:offsets[i + 1]])
+
+    shmpool.attach(inside)[begin:end] = result
 
-def check_intersection(line1: dict, line2: dict) -> bool:
+def check_points_in_polygon(lat: numpy.ndarray, lon: numpy.ndarray, polygon: numpy.ndarray) -> numpy.ndarray:
     """
-    Check if line1 and line2 intersects.
+    Check if points are inside a polygon by counting the polygon edges crossed
+    by a ray from each point to the east.
+
+    An edge is crossed if the point's latitude is in [min(y1, y2), max(y1, y2)),
+    the same rule used to rasterize polygons onto the grid.
     """
-    if line2['p1']['lon'] == line2['p2']['lon']:
-        a2 = MAX_NUM
-    else:
-        a2 = (line2['p1']['lat'] - line2['p2']['lat']) / (line2['p1']['lon'] - line2['p2']['lon'])
-    b1 = -1
-    b2 = -1
-    c1 = line1['p1']['lat']
-    c2 = line2['p1']['lat'] - a2 * line2['p1']['lon']
-    
-    f1_1 = numpy.sign(b1 * line2['p1']['lat'] + c1)
-    f1_2 = numpy.sign(b1 * line2['p2']['lat'] + c1)
-    f2_1 = numpy.sign(a2 * line1['p1']['lon'] + b2 * line1['p1']['lat'] + c2)
-    f2_2 = numpy.sign(a2 * line1['p2']['lon'] + b2 * line1['p2']['lat'] + c2)
+    x1 = polygon[:, 0]
+    y1 = polygon[:, 1]
+    x2 = numpy.roll(x1, -1)
+    y2 = numpy.roll(y1, -1)
+
+    lat = lat[:, numpy.newaxis]
+    lon = lon[:, numpy.newaxis]
+    crossing = (numpy.minimum(y1, y2) <= lat) & (lat < numpy.maximum(y1, y2))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
 
-    return f1_1 != f1_2 and f2_1 != f2_2
+    return numpy.count_nonzero(crossing & (x > lon), axis=1) % 2 == 1
 
-def add_roads(grid: dict, roads: list):
+def add_roads(grid: dict, roads: numpy.ndarray):
     """
     Add roads to zones list.
+
+    roads is an (N, 4) array of segments (start lat, start lon, end lat, end
+    lon), as returned by osmpois.extract_pois. Every road segment is converted
+    to continuous grid coordinates, clipped to the grid and drawn with a DDA
+    line, marking each zone it crosses.
     """
-    for road in roads:
-        # Ignore points outside the grid
-        if road['start']['lat'] < grid['bottom'] or road['start']['lat'] > grid['top'] \
-           or road['end']['lat'] < grid['bottom'] or road['end']['lat'] > grid['top'] \
-           or road['start']['lon'] < grid['left'] or road['start']['lon'] > grid['right'] \
-           or road['end']['lon'] < grid['left'] or road['end']['lon'] > grid['right']:
-           continue
+    for begin in range(0, len(roads), ROADS_CHUNK_SIZE):
+        rows, cols = rasterize_segments(grid, roads[begin:begin + ROADS_CHUNK_SIZE])
+        grid['is_road'][rows * grid['grid_x'] + cols] = True
 
-        a = coordinates_to_id(grid, road['start']['lat'], road['start']['lon'])
-        b = coordinates_to_id(grid, road['end']['lat'], road['end']['lon'])
+    # Count road zones
+    grid['roads_points'] += int(numpy.count_nonzero(grid['is_road']))
+
+def rasterize_segments(grid: dict, segments: numpy.ndarray) -> tuple:
+    """
+    Get the rows and columns of the zones crossed by segments, an (N, 4) array
+    of (start lat, start lon, end lat, end lon).
+
+    Segments are clipped to the grid (Liang-Barsky), so parts of a road
+    outside the AoI are dropped but the part inside is kept.
+    """
+    gx = grid['grid_x']
+    gy = grid['grid_y']
+
+    # Continuous grid coordinates: zone (row, col) covers [row, row + 1) x [col, col + 1)
+    y0 = (segments[:, 0] - grid['bottom']) / abs(grid['height']) * gy
+    x0 = (segments[:, 1] - grid['left']) / abs(grid['width']) * gx
+    dy = (segments[:, 2] - grid['bottom']) / abs(grid['height']) * gy - y0
+    dx = (segments[:, 3] - grid['left']) / abs(grid['width']) * gx - x0
+
+    # Clip t in [0, 1] against each border of the grid
+    t0 = numpy.zeros(len(segments))
+    t1 = numpy.ones(len(segments))
+    keep = numpy.ones(len(segments), dtype=bool)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x0), (dx, gx - x0), (-dy, y0), (dy, gy - y0)):
+            t = q / p
+            keep &= (p != 0) | (q >= 0)
+            t0 = numpy.where(p < 0, numpy.maximum(t0, t), t0)
+            t1 = numpy.where(p > 0, numpy.minimum(t1, t), t1)
+    keep &= t0 <= t1
+
+    x0, y0, dx, dy, t0, t1 = x0[keep], y0[keep], dx[keep], dy[keep], t0[keep], t1[keep]
+    col_a = numpy.clip(numpy.floor(x0 + t0 * dx), 0, gx - 1).astype(numpy.int64)
+    row_a = numpy.clip(numpy.floor(y0 + t0 * dy), 0, gy - 1).astype(numpy.int64)
+    col_b = numpy.clip(numpy.floor(x0 + t1 * dx), 0, gx - 1).astype(numpy.int64)
+    row_b = numpy.clip(numpy.floor(y0 + t1 * dy), 0, gy - 1).astype(numpy.int64)
+
+    # DDA: one zone per step along the major axis of each segment
+    steps = numpy.maximum(numpy.abs(col_b - col_a), numpy.abs(row_b - row_a))
+    count = steps + 1
+    segment = numpy.repeat(numpy.arange(len(steps)), count)
+    k = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+    t = k / numpy.maximum(steps, 1)[segment]
+    cols = col_a[segment] + numpy.rint(t * (col_b - col_a)[segment]).astype(numpy.int64)
+    rows = row_a[segment] + numpy.rint(t * (row_b - row_a)[segment]).astype(numpy.int64)
+
+    return rows, cols
+
+def calculate_risk_from_pois(grid: dict, engine: str = RISK_EXACT, radius: float = RISK_RADIUS, tolerance: float = RISK_TOLERANCE, window: int = FFT_WINDOW):
+    """
+    Calculate the risk perception considering all PoIs.
 
-        if a < 0 or b < 0 or a >= len(grid['zones']) or b >= len(grid['zones']):
-            continue
-        
-        # Select the movement approach
-        dist_x = b % grid['grid_x'] - a % grid['grid_x']
-        dist_y = int(b / grid['grid_x']) - int(a / grid['grid_x'])
+    With the approximate engine, only PoIs within about radius meters of a
+    zone are summed exactly and the relative error of each approximated
+    bucket of distant PoIs is kept below tolerance. With the FFT engine, the
+    zones up to window zones away from each PoI are computed exactly.
 
-        if abs(dist_x) >= abs(dist_y):
-            move_zones_x(grid, a, b, dist_x, dist_y)
+    The influence of each group of PoIs (see get_pois_groups) is kept in
+    grid['influences'], so the risks can be recalculated for new PoI type
+    weights with reweight_risks.
+    """
+    if len(grid['pois']) == 0:
+        return
+
+    print(f'Calculating risk perception... ', end='')
+
+    # The FFT engine needs the whole grid raster in memory
+    if engine == RISK_FFT and grid['tiled']:
+        print('the FFT engine is not available in tiled mode, using the approximate engine... ', end='')
+        engine = RISK_APPROX
+
+    grid['influence_groups'], grid['influence_weights'], members, pois_weight = get_pois_groups(grid)
+    grid['influences'] = []
+    for group in range(len(grid['influence_groups'])):
+        pois = get_pois_subset(grid, members[group], pois_weight[members[group]])
+        influence = new_zones_array(grid, f'influence_{group}', len(grid['zones_inside']), numpy.float64)
+
+        if engine == RISK_FFT:
+            influence[:] = calculate_influence_fft(pois, window)[grid['zones_inside']]
         else:
-            move_zones_y(grid, a, b, dist_x, dist_y)
+            for begin, end in get_tiles(grid, len(grid['zones_inside'])):
+                zones = numpy.asarray(grid['zones_inside'][begin:end])
+                if engine == RISK_APPROX:
+                    influence[begin:end] = calculate_influence_approx(pois, zones, radius, tolerance)
+                    grid['risk_error'] = max(grid.get('risk_error', 0.0), pois['risk_error'])
+                else:
+                    influence[begin:end] = calculate_influence_exact(pois, zones)
 
-        grid['zones'][a]['is_road'] = grid['zones'][b]['is_road'] = True
-    
-    # Count road zones
-    for zone in grid['zones']:
-        if zone['is_road']:
-            grid['roads_points'] += 1
+        grid['influences'].append(influence)
 
-def coordinates_to_id(grid: dict, lat, lon):
+    reweight_risks(grid)
+
+    print('Done!')
+    if 'risk_error' in grid.keys():
+        print(f'Relative error bound of the approximate risk: {grid["risk_error"]:.2e}')
+
+def get_pois_groups(grid: dict) -> tuple:
     """
-    Calculate the zone ID from its coordinates.
+    Split the PoIs in groups whose influence can be weighted as a whole.
+
+    Each PoI type ('key=value' in poi['type']) is a group whose PoIs have unit
+    weight and the group takes the type weight. PoIs without a type or with
+    a weight of their own (poi['weight_override']) form a group with weight
+    1, named '', where each PoI keeps its weight.
+
+    Returns the names and weights of the groups, the PoIs of each group and
+    the weight of each PoI inside its group.
     """
-    prop_x = (lon - grid['left']) / abs(grid['width'])
-    prop_y = (lat - grid['bottom']) / abs(grid['height'])
-    pos_x = int(prop_x * grid['grid_x'])
-    pos_y = int(prop_y * grid['grid_y'])
-    return pos_y * grid['grid_x'] + pos_x
+    groups = []
+    weights = []
+    members = []
+    pois_weight = grid['pois_weight'].copy()
 
-def move_zones_x(grid: dict, a: dict, b: dict, dist_x: int, dist_y: int):
+    for name in numpy.unique(grid['pois_group']).tolist():
+        pois = numpy.flatnonzero(grid['pois_group'] == name)
+        groups.append(name)
+        members.append(pois)
+        if name == '':
+            weights.append(1.0)
+        else:
+            weights.append(float(grid['pois_weight'][pois[0]]))
+            pois_weight[pois] = 1
+
+    return groups, numpy.array(weights), members, pois_weight
+
+def get_pois_subset(grid: dict, pois: numpy.ndarray, pois_weight: numpy.ndarray) -> dict:
     """
-    Move through road in X axis
+    Get a shallow copy of the grid with only some of its PoIs, with new
+    weights.
     """
-    if dist_x == 0:
-        return
+    subset = dict(grid)
+    subset['pois'] = [grid['pois'][i] for i in pois.tolist()]
+    for key in ('pois_lat', 'pois_lon', 'pois_x', 'pois_y'):
+        subset[key] = grid[key][pois]
+    subset['pois_weight'] = pois_weight
+    return subset
 
-    # Calculate movement steps
-    if dist_y > 0:
-        step_y = (dist_y + 1) / (abs(dist_x) + 1)
-    else:
-        step_y = (dist_y - 1) / (abs(dist_x) + 1)
-    delta_y = 0.0
-    id = a
-    num_x = int(dist_x / abs(dist_x))
-    if dist_y != 0:
-        num_y = grid['grid_x'] * (int(dist_y / abs(dist_y)))
-    else:
-        num_y = 0
-    
-    # While getting near to the destination zone, keep moving.
-    # If we start to get far, stop!
-    prev_dist = dist = calculate_distance(grid['zones'][id], grid['zones'][b])
-    while dist <= prev_dist:
-        id += num_x
-        delta_y = delta_y + step_y
-        if abs(delta_y) >= 1:
-            id += num_y
-            delta_y -= int(delta_y / abs(delta_y))
-
-        if id < 0 or id > len(grid['zones']):
-            break
+def reweight_risks(grid: dict, weights: dict = None):
+    """
+    Calculate the risk perception of the zones from the influence of each
+    group of PoIs, then normalize the risks and calculate the RLs.
 
-        try:
-            grid['zones'][id]['is_road'] = True
+    weights maps PoI types to new weights (e.g. {'amenity=hospital': 8.0}).
+    Only a weighted sum per zone is needed, so exploring weights doesn't
+    require the PoIs distances again.
+    """
+    if weights != None:
+        for group, name in enumerate(grid['influence_groups']):
+            if name in weights.keys():
+                grid['influence_weights'][group] = weights[name]
 
-            # Update distance
-            prev_dist = dist
-            dist = calculate_distance(grid['zones'][id], grid['zones'][b])
-        except IndexError:
-            break
-    
-def move_zones_y(grid: dict, a: dict, b: dict, dist_x: int, dist_y: int):
+    for begin, end in get_tiles(grid, len(grid['zones_inside'])):
+        influence = numpy.zeros(end - begin)
+        for weight, group_influence in zip(grid['influence_weights'], grid['influences']):
+            influence += weight * group_influence[begin:end]
+
+        with numpy.errstate(divide='ignore'):
+            grid['risk'][grid['zones_inside'][begin:end]] = 1 / influence
+
+    normalize_risks(grid)
+    calculate_RL(grid)
+
+def get_scenarios_weights(grid: dict, scenarios: list) -> numpy.ndarray:
     """
-    Move through road in Y axis
+    Get the weights of the groups of PoIs for each scenario, one row per
+    scenario.
+
+    A scenario changes the weights of the PoI types in its 'pois_types', in
+    the same format as the config file. Other groups keep their weights.
     """
-    if dist_y == 0:
-        return
+    weights = numpy.tile(grid['influence_weights'], (len(scenarios), 1))
+    for row, scenario in enumerate(scenarios):
+        for key, values in scenario.get('pois_types', {}).items():
+            for value, params in values.items():
+                name = f'{key}={value}'
+                if name in grid['influence_groups']:
+                    weights[row, grid['influence_groups'].index(name)] = params['w']
 
-    # Calculate movement steps
-    if dist_x > 0:
-        step_x = (dist_x + 1) / (abs(dist_y) + 1)
-    else:
-        step_x = (dist_x - 1) / (abs(dist_y) + 1)
-    delta_x = 0.0
-    id = a
-    if dist_x != 0:
-        num_x = int(dist_x / abs(dist_x))
-    else:
-        num_x = 0
-    num_y = grid['grid_x'] * (int(dist_y / abs(dist_y)))
-
-    # While getting near to the destination zone, keep moving.
-    # If we start to get far, stop!
-    prev_dist = dist = calculate_distance(grid['zones'][id], grid['zones'][b])
-    while dist <= prev_dist:
-        id += num_y
-        delta_x = delta_x + step_x
-        if abs(delta_x) >= 1:
-            id += num_x
-            delta_x -= int(delta_x / abs(delta_x))
-        
-        if id < 0 or id > len(grid['zones']):
-            break
+    return weights
 
-        try:
-            grid['zones'][id]['is_road'] = True
+def get_scenarios_risks(grid: dict, weights: numpy.ndarray, begin: int, end: int) -> numpy.ndarray:
+    """
+    Calculate the risk perception of zones_inside[begin:end] for every row of
+    weights, in the same way as reweight_risks.
+    """
+    influence = numpy.zeros((len(weights), end - begin))
+    for group, group_influence in enumerate(grid['influences']):
+        influence += weights[:, group:group + 1] * group_influence[begin:end]
 
-            # Update distance
-            prev_dist = dist
-            dist = calculate_distance(grid['zones'][id], grid['zones'][b])
-        except IndexError:
-            break
+    with numpy.errstate(divide='ignore'):
+        return 1 / influence
 
-def calculate_risk_from_pois(grid: dict):
+def classify_scenarios(grid: dict, weights: numpy.ndarray, M: list) -> list:
     """
-    Calculate the risk perception considering all PoIs.
+    Calculate the RLs of the zones inside the AoI for several scenarios at
+    once, from the influence of each group of PoIs.
+
+    Each row of weights has the group weights of a scenario (see
+    get_scenarios_weights) and M has the number of RLs of each scenario.
+    Returns a list with the RLs of grid['zones_inside'] for each scenario.
     """
-    if len(grid['pois']) == 0:
-        return
+    M = numpy.array(M).reshape(-1, 1)
+    tiles = get_tiles(grid, len(grid['zones_inside']), len(weights))
+    min = numpy.full((len(weights), 1), numpy.inf)
+    max = numpy.full((len(weights), 1), -numpy.inf)
+    for begin, end in tiles:
+        risks = get_scenarios_risks(grid, weights, begin, end)
+        min = numpy.minimum(min, risks.min(axis=1, keepdims=True))
+        max = numpy.maximum(max, risks.max(axis=1, keepdims=True))
 
-    print(f'Calculating risk perception... ', end='')
+    amplitude = max - min
+    amplitude[amplitude == 0] = 1
 
-    with mp.Pool(processes=MP_WORKERS) as pool:
-        payload = []
-        for id in grid['zones_inside']:
-            payload.append((grid['zones'][id], grid['pois']))
-        risks = pool.starmap(calculate_risk_of_zone, payload)
-    
-    for risk in risks:
-        grid['zones'][risk[0]]['risk'] = risk[1]
+    rls = [new_zones_array(grid, f'RL_{row}', len(grid['zones_inside']), numpy.uint8) for row in range(len(weights))]
+    for begin, end in tiles:
+        risks = (get_scenarios_risks(grid, weights, begin, end) - min) / amplitude
+        with numpy.errstate(divide='ignore'):
+            rl = M - numpy.minimum(numpy.abs(numpy.trunc(numpy.log(risks))), M - 1)
+        rl[risks == 0] = 1
+        for row in range(len(weights)):
+            rls[row][begin:end] = rl[row]
 
-    normalize_risks(grid)
-    calculate_RL(grid)
+    return rls
 
-    print('Done!')
+def get_scenario_conf(conf: dict, scenario: dict, number: int) -> dict:
+    """
+    Get the config of a scenario: the main config updated with the scenario
+    keys.
 
-def calculate_risk_of_zone(zone: dict, pois: list) -> float:
+    Output files not set by the scenario get the scenario number appended to
+    the main file names (e.g. map.csv becomes map_1.csv).
     """
-    Calculate the risk perception considering all PoIs.
+    scenario_conf = dict(conf)
+    scenario_conf.pop('scenarios')
+    scenario_conf.update(scenario)
+
+    for key in ('output', 'output_edus', 'output_roads', 'output_raster', 'res_data'):
+        if key in conf.keys() and key not in scenario.keys():
+            root, ext = os.path.splitext(conf[key])
+            if ext == '.gz':
+                root, ext = os.path.splitext(root)
+                ext += '.gz'
+            scenario_conf[key] = f'{root}_{number}{ext}'
+
+    return scenario_conf
+
+def calculate_influence_exact(grid: dict, zones: numpy.ndarray) -> numpy.ndarray:
     """
-    sum = 0
+    Calculate the influence of every PoI on the zones in the zones array.
+    """
+    # Split the zones in blocks so each block against all PoIs fits RISK_CHUNK_SIZE
+    pool = get_pool()
+    influence = pool.empty(zones.shape, numpy.float64)
+    pool.map_ranges(calculate_influence_of_range, len(zones), max(1, RISK_CHUNK_SIZE // len(grid['pois'])),
+        pool.share_dict(get_coordinates(grid, zones)),
+        pool.share_dict(get_pois_coordinates(grid)),
+        pool.share(grid['pois_weight']),
+        influence
+    )
+    result = pool.view(influence).copy()
+    pool.release()
+    return result
+
+def calculate_influence_of_range(zones: dict, pois: dict, pois_weight: tuple, influence: tuple, begin: int, end: int):
+    """
+    Pool task: calculate the PoIs influence on the zones in [begin, end).
+    """
+    zones = {key: value[begin:end] for key, value in shmpool.attach_dict(zones).items()}
+    shmpool.attach(influence)[begin:end] = calculate_influence_of_pois(zones, shmpool.attach_dict(pois), shmpool.attach(pois_weight))
+
+def calculate_influence_of_pois(zones: dict, pois: dict, pois_weight: numpy.ndarray) -> numpy.ndarray:
+    """
+    Calculate the sum of weight / distance ** 2 of the PoIs for a block of zones.
+
+    Distances are computed for every (PoI, zone) pair at once. PoIs are laid
+    along the first axis so the sum is accumulated in the same order as a
+    PoI by PoI loop would do.
+    """
+    zones = {key: value[numpy.newaxis, :] for key, value in zones.items()}
+    pois = {key: value[:, numpy.newaxis] for key, value in pois.items()}
+
+    with numpy.errstate(divide='ignore'):
+        return (pois_weight[:, numpy.newaxis] / (calculate_point_distance(zones, pois) ** 2)).sum(axis=0)
+
+def calculate_influence_approx(grid: dict, zones: numpy.ndarray, radius: float, tolerance: float) -> numpy.ndarray:
+    """
+    Calculate the PoIs influence on the zones in the zones array with the
+    approximate engine.
+
+    PoIs and zones are indexed by a uniform grid of buckets of radius x radius
+    meters. For the zones of a bucket, PoIs in the same and in the 8 neighbour
+    buckets are summed exactly. Each distant bucket is replaced by its total
+    weight placed at its weighted centroid (as in Barnes-Hut) when the error
+    bound 3 * Q * D^2 / (W * (D - r)^4) of that replacement is below tolerance,
+    where Q is the weighted second moment of the bucket, W its total weight,
+    r its radius and D the distance from the zone to the centroid. Buckets
+    that fail the test are summed exactly.
+
+    The largest relative error bound of the zone sums is stored in
+    grid['risk_error'].
+    """
+    pool = get_pool()
+
+    # Sort PoIs by bucket
+    pois_x = grid['pois_x']
+    pois_y = grid['pois_y']
+    pois_bx = numpy.floor(pois_x / radius).astype(numpy.int64)
+    pois_by = numpy.floor(pois_y / radius).astype(numpy.int64)
+    order = numpy.lexsort((pois_bx, pois_by))
+    pois_weight = grid['pois_weight'][order]
+    pois_x, pois_y, pois_bx, pois_by = pois_x[order], pois_y[order], pois_bx[order], pois_by[order]
+    starts = get_group_starts(pois_bx, pois_by)
+
+    # Bucket totals, weighted centroids (plain centroid if all weights are 0),
+    # second moments and radii
+    count = numpy.diff(numpy.append(starts, len(pois_weight)))
+    weight = numpy.add.reduceat(pois_weight, starts)
+    total = numpy.where(weight > 0, weight, count)
+    factor = numpy.where(numpy.repeat(weight > 0, count), pois_weight, 1)
+    center_x = numpy.add.reduceat(factor * pois_x, starts) / total
+    center_y = numpy.add.reduceat(factor * pois_y, starts) / total
+    dist2 = (pois_x - numpy.repeat(center_x, count)) ** 2 + (pois_y - numpy.repeat(center_y, count)) ** 2
+    center_lat, center_lon = unproject(grid, center_x, center_y)
+    buckets = {
+        'bx': pois_bx[starts],
+        'by': pois_by[starts],
+        'offsets': numpy.append(starts, len(pois_weight)),
+        'weight': weight,
+        'moment': numpy.add.reduceat(pois_weight * dist2, starts),
+        'radius': numpy.sqrt(numpy.maximum.reduceat(dist2, starts))
+    }
+    if grid['haversine']:
+        centers = {'lat': center_lat, 'lon': center_lon}
+    else:
+        centers = {'x': center_x, 'y': center_y}
+
+    # Sort zones by bucket
+    zones_x = grid['x'][zones]
+    zones_y = grid['y'][zones]
+    zones_bx = numpy.floor(zones_x / radius).astype(numpy.int64)
+    zones_by = numpy.floor(zones_y / radius).astype(numpy.int64)
+    zones_order = numpy.lexsort((zones_bx, zones_by))
+    cells = get_group_starts(zones_bx[zones_order], zones_by[zones_order])
+
+    arrays = {
+        'zones': pool.share_dict(get_coordinates(grid, zones[zones_order])),
+        'cells': pool.share(numpy.append(cells, len(zones_order))),
+        'cells_bx': pool.share(zones_bx[zones_order][cells]),
+        'cells_by': pool.share(zones_by[zones_order][cells]),
+        'pois': pool.share_dict(get_pois_coordinates(grid, order)),
+        'pois_weight': pool.share(pois_weight),
+        'buckets': pool.share_dict(buckets),
+        'centers': pool.share_dict(centers),
+        'sum': pool.empty(zones_order.shape, numpy.float64),
+        'error': pool.empty(zones_order.shape, numpy.float64)
+    }
 
-    for poi in pois:
-        sum += poi['weight'] / (calculate_distance(zone, poi) ** 2)
+    pool.map_ranges(calculate_influence_of_cells, len(cells), 1, arrays, tolerance)
+
+    sum = numpy.empty(len(zones_order))
+    sum[zones_order] = pool.view(arrays['sum'])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        grid['risk_error'] = float(numpy.nan_to_num(pool.view(arrays['error']) / pool.view(arrays['sum'])).max())
+    pool.release()
+
+    return sum
+
+def calculate_influence_of_cells(arrays: dict, tolerance: float, begin: int, end: int):
+    """
+    Pool task: calculate the PoIs influence on the zones of buckets [begin, end)
+    with the approximate engine (see calculate_influence_approx).
+    """
+    arrays = shmpool.attach_dict(arrays)
+    cells = arrays['cells']
+    buckets = arrays['buckets']
+    offsets = buckets['offsets']
+
+    for cell in range(begin, end):
+        # Buckets around this cell are always summed exactly
+        near = (numpy.abs(buckets['bx'] - arrays['cells_bx'][cell]) <= 1) & \
+               (numpy.abs(buckets['by'] - arrays['cells_by'][cell]) <= 1)
+        far = numpy.flatnonzero(~near)
+        near = numpy.flatnonzero(near)
+
+        chunk = max(1, RISK_CHUNK_SIZE // max(len(far), offsets[-1]))
+        for zone in range(cells[cell], cells[cell + 1], chunk):
+            zones = slice(zone, min(zone + chunk, cells[cell + 1]))
+            zones = {key: value[zones] for key, value in arrays['zones'].items()}
+
+            # Error bound of each (zone, distant bucket) approximation
+            dist = calculate_point_distance(
+                {key: value[:, numpy.newaxis] for key, value in zones.items()},
+                {key: value[far] for key, value in arrays['centers'].items()}
+            )
+            weight = buckets['weight'][far]
+            gap = dist - buckets['radius'][far]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                bound = numpy.where(weight > 0, 3 * buckets['moment'][far] * dist ** 2 / (weight * gap ** 4), 0)
+            accept = ((gap > 0) & (bound <= tolerance)).all(axis=0)
+
+            # Exact sum for near buckets and distant buckets that can't be approximated
+            exact = numpy.concatenate((near, far[~accept]))
+            count = offsets[exact + 1] - offsets[exact]
+            members = numpy.repeat(offsets[exact] - numpy.cumsum(count) + count, count) + numpy.arange(count.sum())
+            sum = calculate_influence_of_pois(
+                zones,
+                {key: value[members] for key, value in arrays['pois'].items()},
+                arrays['pois_weight'][members]
+            )
+
+            # Approximated buckets
+            influence = weight[accept] / dist[:, accept] ** 2
+            zones = slice(zone, min(zone + chunk, cells[cell + 1]))
+            arrays['sum'][zones] = sum + influence.sum(axis=1)
+            arrays['error'][zones] = (influence * bound[:, accept]).sum(axis=1)
+
+def calculate_influence_fft(grid: dict, window: int) -> numpy.ndarray:
+    """
+    Calculate the PoIs influence on every zone in the grid with the FFT engine.
+
+    Zones form a regular lattice, so on the local projection of the grid the
+    influence of the PoIs is the convolution of a raster of PoI weights with a
+    1 / d^2 kernel. Each PoI weight is spread over the 4 zones around it
+    (cloud-in-cell) so its position inside a zone is kept to first order.
+
+    The kernel is zeroed for offsets up to window zones, and the zones in that
+    window around each PoI get the exact contribution instead. PoIs outside
+    the grid are always summed exactly.
+    """
+    gx = grid['grid_x']
+    gy = grid['grid_y']
+    pois_weight = grid['pois_weight']
+
+    # Size of a zone in meters on the local projection
+    dx = grid['width'] / gx * grid['projection']['kx']
+    dy = grid['height'] / gy * grid['projection']['ky']
+
+    # PoI position in zone units, relative to the center of the first zone
+    px = (grid['pois_x'] - grid['x'][0]) / dx
+    py = (grid['pois_y'] - grid['y'][0]) / dy
+    i0 = numpy.floor(px).astype(numpy.int64)
+    j0 = numpy.floor(py).astype(numpy.int64)
+    fx = px - i0
+    fy = py - j0
+    in_grid = (i0 >= -1) & (i0 < gx) & (j0 >= -1) & (j0 < gy)
+    deposits = ((0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)), (0, 1, (1 - fx) * fy), (1, 1, fx * fy))
+
+    # Cloud-in-cell raster with one extra row and column on each side
+    raster = numpy.zeros((gy + 2, gx + 2))
+    for a, b, f in deposits:
+        numpy.add.at(raster, (j0[in_grid] + b + 1, i0[in_grid] + a + 1), pois_weight[in_grid] * f[in_grid])
+
+    # Kernel for every offset between a raster cell and a zone
+    ly = get_fft_size(2 * gy + 1)
+    lx = get_fft_size(2 * gx + 1)
+    oy = numpy.arange(-gy, gy + 1)
+    ox = numpy.arange(-gx, gx + 1)
+    with numpy.errstate(divide='ignore'):
+        kernel = 1 / ((oy[:, numpy.newaxis] * dy) ** 2 + (ox[numpy.newaxis, :] * dx) ** 2)
+    kernel[numpy.maximum(numpy.abs(oy)[:, numpy.newaxis], numpy.abs(ox)[numpy.newaxis, :]) <= window] = 0
+    kernel_padded = numpy.zeros((ly, lx))
+    kernel_padded[numpy.ix_(oy % ly, ox % lx)] = kernel
+
+    # Raster cell (j, i) holds zone (j - 1, i - 1), so the field of zone (y, x)
+    # is found at (y + 1, x + 1)
+    field = numpy.fft.irfft2(numpy.fft.rfft2(raster, (ly, lx)) * numpy.fft.rfft2(kernel_padded), (ly, lx))
+    influence = numpy.maximum(field[1:gy + 1, 1:gx + 1], 0).ravel()
+    del field, kernel_padded, kernel, raster
+
+    # Exact contribution in the window around each PoI. Each of its 4 raster
+    # cells counts only where it was left out of the convolution.
+    offsets = numpy.arange(-window, window + 2)
+    wy, wx = numpy.meshgrid(offsets, offsets, indexing='ij')
+    wy = wy.ravel()
+    wx = wx.ravel()
+    pois = numpy.flatnonzero(in_grid)
+    chunk = max(1, RISK_CHUNK_SIZE // len(wx))
+    for begin in range(0, len(pois), chunk):
+        p = pois[begin:begin + chunk, numpy.newaxis]
+        zx = i0[p] + wx
+        zy = j0[p] + wy
+        fraction = numpy.zeros(zx.shape)
+        for a, b, f in deposits:
+            fraction += numpy.where(numpy.maximum(numpy.abs(wx - a), numpy.abs(wy - b)) <= window, f[p], 0)
+        valid = (zx >= 0) & (zx < gx) & (zy >= 0) & (zy < gy) & (fraction > 0)
+        ids = (zy * gx + zx)[valid]
+        p = numpy.broadcast_to(p, zx.shape)[valid]
+        dist = calculate_point_distance(get_coordinates(grid, ids), get_pois_coordinates(grid, p))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            influence += numpy.bincount(ids, pois_weight[p] * fraction[valid] / dist ** 2, minlength=len(influence))
+
+    # PoIs outside the grid
+    outside = numpy.flatnonzero(~in_grid)
+    if len(outside) > 0:
+        chunk = max(1, RISK_CHUNK_SIZE // len(outside))
+        for begin in range(0, len(influence), chunk):
+            zones = slice(begin, begin + chunk)
+            influence[zones] += calculate_influence_of_pois(
+                get_coordinates(grid, zones),
+                get_pois_coordinates(grid, outside),
+                pois_weight[outside]
+            )
+
+    return influence
+
+def get_fft_size(n: int) -> int:
+    """
+    Get the smallest number >= n with no prime factors other than 2, 3 and 5.
+    """
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
 
-    return (zone['id'], 1 / sum)
+def get_group_starts(x: numpy.ndarray, y: numpy.ndarray) -> numpy.ndarray:
+    """
+    Get the positions where each group of equal (x, y) pairs starts in sorted
+    coordinate arrays.
+    """
+    new = numpy.ones(len(x), dtype=numpy.bool_)
+    new[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+    return numpy.flatnonzero(new)
 
 def normalize_risks(grid: dict):
     """
     Normalize the risk perception values.
     """
-    min = max = grid['zones'][grid['zones_inside'][0]]['risk']
-
-    for id in grid['zones_inside']:
-        if grid['zones'][id]['risk'] > max: max = grid['zones'][id]['risk']
-        if grid['zones'][id]['risk'] < min: min = grid['zones'][id]['risk']
+    tiles = get_tiles(grid, len(grid['zones_inside']))
+    min = numpy.inf
+    max = -numpy.inf
+    for begin, end in tiles:
+        risks = grid['risk'][grid['zones_inside'][begin:end]]
+        min = numpy.minimum(min, risks.min())
+        max = numpy.maximum(max, risks.max())
     
     amplitude = max - min
     if amplitude == 0:
         amplitude = 1
 
-    for id in grid['zones_inside']:
-        grid['zones'][id]['risk'] = (grid['zones'][id]['risk'] - min) / amplitude
+    for begin, end in tiles:
+        zones = numpy.asarray(grid['zones_inside'][begin:end])
+        grid['risk'][zones] = (grid['risk'][zones] - min) / amplitude
     
 def calculate_RL(grid: dict):
     """
     Calculate the RL according to risk perception.
     """
-    for id in grid['zones_inside']:
-        if grid['zones'][id]['risk'] == 0:
-            grid['zones'][id]['RL'] = 1
-        else:
-            rl = grid['M'] - numpy.minimum(abs(int(numpy.log(grid['zones'][id]['risk']))), grid['M'] - 1)
-            grid['zones'][id]['RL'] = int(rl)
+    for begin, end in get_tiles(grid, len(grid['zones_inside'])):
+        zones = numpy.asarray(grid['zones_inside'][begin:end])
+        risks = grid['risk'][zones]
+        with numpy.errstate(divide='ignore'):
+            rl = grid['M'] - numpy.minimum(numpy.abs(numpy.trunc(numpy.log(risks))), grid['M'] - 1)
+        rl[risks == 0] = 1
+        grid['RL'][zones] = rl
 
 def get_number_of_zones_by_RL(grid: dict) -> dict:
     """
     Calculate the number of zones by RL.
     """
+    count = numpy.bincount(grid['RL'][grid['zones_inside']], minlength=grid['M'] + 1)
     nzones = {}
     for i in range(1, grid['M'] + 1):
-        nzones[i] = 0
-    
-    for id in grid['zones_inside']:
-        nzones[grid['zones'][id]['RL']] += 1
+        nzones[i] = int(count[i])
     
     return nzones
     
@@ -529,14 +1275,12 @@ def get_number_of_edus_by_RL(grid: dict, n_edus: int) -> dict:
 
 def get_zones_by_RL(grid: dict) -> dict:
     """
-    Get a dict of zones by RL.
+    Get a dict of zone IDs by RL.
     """
+    rls = grid['RL'][grid['zones_inside']]
     zones_by_RL = {}
     for i in range(grid['M'] + 1):
-        zones_by_RL[i] = []
-
-    for id in grid['zones_inside']:
-        zones_by_RL[grid['zones'][id]['RL']].append(grid['zones'][id])
+        zones_by_RL[i] = grid['zones_inside'][rls == i].tolist()
     
     return zones_by_RL
 
@@ -556,8 +1300,7 @@ def reset_edus_flag(grid: dict, n_edus=None):
     """
     Reset EDUs flag.
     """
-    for zone in grid['zones']:
-        zone['has_edu'] = False
+    grid['has_edu'][:] = False
     
     grid['edus'] = {}
     for i in range(1, grid['M'] + 1):
@@ -574,9 +1317,7 @@ def reset_edus_data(grid: dict, n_edus=None):
     grid['Ax'] = {}
     grid['radius'] = {}
     grid['step'] = {}
-    grid['step_x'] = {}
     grid['step_y'] = {}
-    grid['zone_in_y'] = {}
     grid['min_dist'] = {}
 
     for i in range(1, grid['M'] + 1):
@@ -586,19 +1327,15 @@ def reset_edus_data(grid: dict, n_edus=None):
         grid['Ax'][i] = numpy.round(grid['At'][i] / edus[i])            # Coverage area of an EDU
         grid['radius'][i] = numpy.sqrt(grid['Ax'][i]) / 2               # Radius of an EDU
         grid['step'][i] = int(2 * grid['radius'][i] + 1)                # Step distance on x and y directions
-        grid['step_x'][i] = grid['step_y'][i] = 0                       # The steps are accounted individually for each RL
-        grid['zone_in_y'][i] = False                                    # To check if there was any zone for a RL in any y
+        grid['step_y'][i] = 0                                           # The steps are accounted individually for each RL
         grid['min_dist'][i] = 2 * grid['radius'][i] + 1                 # Minimum distance an EDU must have from another in this RL
     grid['smallest_radius'] = grid['radius'][grid['M']]                 # Radius of the highest level
     grid['highest_radius'] = grid['radius'][1]                          # Radius of the lowest level
-    grid['search_range'] = -int(numpy.ceil(2 * grid['grid_x'] / grid['smallest_radius']))
     
     # Make sure there are no 0 radius
     if grid['smallest_radius'] == 0: grid['smallest_radius'] = 1
     if grid['highest_radius'] == 0: grid['highest_radius'] = 1
 
-    grid['zones'].sort(key=lambda zone : zone['id'])
-
 def set_edus_positions_uniform(grid, mode: int):
     """
     Uniformly select zones for EDUs positioning.
@@ -622,38 +1359,31 @@ def set_edus_positions_uniform_unbalanced(grid):
     Unbalanced positioning mode.
     """
     print('Chosen positioning method: uniform unbalanced.')
+    inside = grid['inside'].reshape(grid['grid_y'], grid['grid_x'])
+    rls = grid['RL'].reshape(grid['grid_y'], grid['grid_x'])
+
     for y in range(grid['grid_y']):
-        # First, reset step for every RL in x direction and check if there was any zone in y
+        # For each RL, take the zones of this row inside AoI and put an EDU
+        # every step zones if this is a row for this RL.
         for i in range(1, grid['M'] + 1):
-            grid['step_x'][i] = 0
-            if grid['zone_in_y'][i]:
-                grid['step_y'][i] += 1
-                grid['zone_in_y'][i] = False
-
-        # For each zone in this row, check if it is inside AoI and check if it is time to
-        # put an EDU in it
-        for x in range(grid['grid_x']):
-            id = grid['grid_x'] * y + x
-            zone = grid['zones'][id]
-            if not zone['inside']: continue
-
-            for i in range(1, grid['M'] + 1):
-                if zone['RL'] != i: continue
-                grid['zone_in_y'][i] = True  # If there was any zone for this RL in this y, we can increment step_y later
-
-                if grid['step_x'][i] % grid['step'][i] == 0 and grid['step_y'][i] % grid['step'][i] == 0:
-                    grid['edus'][i].append(zone)
-                    
-                grid['step_x'][i] += 1
-
-                prog = (id / len(grid['zones'])) * 100
-                print(f'Positioning EDUs... {prog:.2f}%', end='\r')
+            row = numpy.flatnonzero(inside[y] & (rls[y] == i))
+            if len(row) == 0: continue
+
+            if grid['step_y'][i] % grid['step'][i] == 0:
+                grid['edus'][i].extend((grid['grid_x'] * y + row[::grid['step'][i]]).tolist())
+            grid['step_y'][i] += 1  # There was a zone for this RL in this y
+
+        prog = (y / grid['grid_y']) * 100
+        print(f'Positioning EDUs... {prog:.2f}%', end='\r')
     
 def set_edus_positions_uniform_balanced(grid: dict):
     """
     Balanced positioning mode.
     """
     print('Chosen positioning method: uniform balanced.')
+    inside = grid['inside'].tolist()
+    rls = grid['RL'].tolist()
+    index = create_edus_index(grid)
     y = int(grid['smallest_radius'])
     while y < grid['grid_y']:
         x = 0
@@ -662,10 +1392,9 @@ def set_edus_positions_uniform_balanced(grid: dict):
                 while True:
                     # Get the zone in this coordinate by its ID
                     id = grid['grid_x'] * y + x
-                    zone = grid['zones'][id]
 
                     # The zone must be inside the AoI, otherwise, check the next zone
-                    if zone['inside']:
+                    if inside[id]:
                         break
                     elif x >= grid['grid_x']:
                         raise OutOfBounds
@@ -674,21 +1403,16 @@ def set_edus_positions_uniform_balanced(grid: dict):
 
                 try:
                     # Don't even try if we are still within the range of another EDU
-                    for i in range(1, grid['M'] + 1):
-                        for edu in grid['edus'][i][-1:grid['search_range']:-1]:
-                            dist = calculate_distance_in_grid(grid, zone, edu)
-                            if dist < grid['min_dist'][zone['RL']]:
-                                raise SkipZone
-
-                    zone['has_edu'] = True
-                    grid['edus'][zone['RL']].append(zone)
+                    if not check_edus_index(index, x, y, grid['min_dist'][rls[id]]):
+                        raise SkipZone
+
+                    add_to_edus_index(index, x, y)
+                    grid['has_edu'][id] = True
+                    grid['edus'][rls[id]].append(id)
                     x += int(grid['smallest_radius'] * 2)
                 
                 except SkipZone:
                     x += 1
-            
-                prog = (id / len(grid['zones'])) * 100
-                print(f'Positioning EDUs... {prog:.2f}%', end='\r')
 
         except IndexError:
             pass
@@ -696,6 +1420,47 @@ def set_edus_positions_uniform_balanced(grid: dict):
             pass
         
         y += 1
+        prog = (y / grid['grid_y']) * 100
+        print(f'Positioning EDUs... {prog:.2f}%', end='\r')
+
+def create_edus_index(grid: dict) -> dict:
+    """
+    Create an empty spatial hash of EDUs positions.
+
+    Positions are kept in square buckets as large as the smallest minimum
+    distance between EDUs, so a spacing check only looks at the few buckets
+    around the candidate zone.
+    """
+    return {
+        'cell': max(1, int(min(grid['min_dist'].values()))),
+        'buckets': {}
+    }
+
+def add_to_edus_index(index: dict, x: int, y: int):
+    """
+    Add an EDU in zone (x, y) of the grid to the spatial hash.
+    """
+    key = (x // index['cell'], y // index['cell'])
+    index['buckets'].setdefault(key, []).append((x, y))
+
+def check_edus_index(index: dict, x: int, y: int, min_dist: float) -> bool:
+    """
+    Check if zone (x, y) of the grid is at least min_dist zones away from
+    every EDU in the spatial hash.
+    """
+    cell = index['cell']
+    rings = int(numpy.ceil(min_dist / cell))
+    cx = x // cell
+    cy = y // cell
+    min_dist = min_dist ** 2
+
+    for by in range(cy - rings, cy + rings + 1):
+        for bx in range(cx - rings, cx + rings + 1):
+            for ex, ey in index['buckets'].get((bx, by), ()):
+                if (ex - x) ** 2 + (ey - y) ** 2 < min_dist:
+                    return False
+
+    return True
 
 def set_edus_positions_uniform_restricted(grid: dict):
     """
@@ -704,8 +1469,14 @@ def set_edus_positions_uniform_restricted(grid: dict):
     print('Moving EDUs to permitted zones...')
 
     final_edus = {}
+    final_zones = {}
+    spiral_paths = {}
     for i in range(1, grid['M'] + 1):
         final_edus[i] = []
+        final_zones[i] = set()
+
+    # Nearest permitted zone (only roads for now) of every zone
+    nearest = get_nearest_permitted_zones(grid, grid['inside'] & grid['is_road'])
 
     edus_total = 0
     edus_remaining = grid['n_edus'] - edus_total
@@ -723,40 +1494,49 @@ def set_edus_positions_uniform_restricted(grid: dict):
         # For each EDU check if it is in a permitted zone (only roads for now).
         # If not, move it to the nearest permitted zone.
         for i in range(1, grid['M'] + 1):
-            zones_removal = []
+            zones_removal = set()
+
+            # Zones reachable within the RL radius, as offsets from the EDU zone
+            radius = grid['radius'][i]
+            if radius not in spiral_paths:
+                path = get_spiral_path(grid, radius)
+                spiral_paths[radius] = (path, set(numpy.cumsum(path).tolist()))
+            spiral_path, reachable = spiral_paths[radius]
 
-            for zone in grid['edus'][i]:
-                if zone['is_road']: continue
+            for zone in list(grid['edus'][i]):
+                if grid['is_road'][zone]: continue
 
                 # Mark the zone for EDU removal (it is not a road)
-                zone_id = zone['id']
-                zones_removal.append(zone)
-                zone['has_edu'] = False
-
-                # Find another zone within the RL radius to place the EDU
-                spiral_path = get_spiral_path(grid, grid['radius'][i])
-                for step in spiral_path:
-                    zone_id += step
-                    try:
-                        nearby_zone = grid['zones'][zone_id]
-                        if not nearby_zone['inside']: continue
-                        if not nearby_zone['is_road']: continue
-                        if nearby_zone['has_edu']: continue
-                        if nearby_zone in final_edus[i]: continue
-
-                        nearby_zone['has_edu'] = True
-                        grid['edus'][i].append(nearby_zone)
+                zones_removal.add(zone)
+                grid['has_edu'][zone] = False
+
+                # Take the nearest permitted zone if it is reachable and free
+                zone_id = int(nearest[zone])
+                if zone_id < 0 or zone_id - zone not in reachable: continue
+                if grid['has_edu'][zone_id] or zone_id in final_zones[i]:
+                    # Otherwise, find another zone within the RL radius to place the EDU
+                    zone_id = zone
+                    for step in spiral_path:
+                        zone_id += step
+                        if not 0 <= zone_id < grid['n_zones']: continue
+                        if not grid['inside'][zone_id]: continue
+                        if not grid['is_road'][zone_id]: continue
+                        if grid['has_edu'][zone_id]: continue
+                        if zone_id in final_zones[i]: continue
                         break
-                    except IndexError:
+                    else:
                         continue
+
+                grid['has_edu'][zone_id] = True
+                grid['edus'][i].append(zone_id)
         
             # Remove from grid['edus'] all zones that have been marked for removal
-            for zone in zones_removal:
-                grid['edus'][i].remove(zone)
+            grid['edus'][i] = [zone for zone in grid['edus'][i] if zone not in zones_removal]
             
         # Move all the positioned EDUs to the final structure
         for i in range(1, grid['M'] + 1):
             final_edus[i].extend(grid['edus'][i])
+            final_zones[i].update(grid['edus'][i])
             grid['edus'][i] = []
 
         # Recalculate the total and remaining
@@ -769,6 +1549,72 @@ def set_edus_positions_uniform_restricted(grid: dict):
     for i in range(1, grid['M'] + 1):
         grid['edus'][i] = [*final_edus[i]]
 
+def get_nearest_permitted_zones(grid: dict, permitted: numpy.ndarray) -> numpy.ndarray:
+    """
+    Get the ID of the nearest permitted zone of every zone, or -1 if there is
+    no permitted zone in the grid.
+
+    The map is built with jump flooding: each zone repeatedly takes the
+    nearest of the permitted zones known by its 8 neighbours at distance
+    step, for steps halving from the grid size down to 1, plus a final pass
+    with step 1. In tiled mode the maps are kept in spill files and each
+    pass runs a tile of rows at a time.
+    """
+    gx = grid['grid_x']
+    gy = grid['grid_y']
+    dtype = numpy.int32 if grid['n_zones'] < 2 ** 31 else numpy.int64
+    nearest = new_zones_array(grid, 'nearest', grid['n_zones'], dtype).reshape(gy, gx)
+    nearest_x = new_zones_array(grid, 'nearest_x', grid['n_zones'], numpy.int32).reshape(gy, gx)
+    nearest_y = new_zones_array(grid, 'nearest_y', grid['n_zones'], numpy.int32).reshape(gy, gx)
+    dist = new_zones_array(grid, 'nearest_dist', grid['n_zones'], numpy.int64).reshape(gy, gx)
+    cols = numpy.arange(gx)
+
+    tiles = get_tiles(grid, gy, gx)
+    for begin, end in tiles:
+        zones = numpy.arange(begin * gx, end * gx).reshape(-1, gx)
+        flags = permitted[begin * gx:end * gx].reshape(-1, gx)
+        nearest[begin:end] = numpy.where(flags, zones, -1)
+        nearest_x[begin:end] = cols
+        nearest_y[begin:end] = numpy.arange(begin, end).reshape(-1, 1)
+        dist[begin:end] = numpy.where(flags, 0, numpy.iinfo(numpy.int64).max)
+
+    steps = []
+    step = 1 << int(max(gx, gy) - 1).bit_length()
+    while step > 1:
+        step //= 2
+        steps.append(step)
+    steps += [2, 1]
+
+    for step in steps:
+        for dy in (-step, 0, step):
+            for dx in (-step, 0, step):
+                if dx == 0 and dy == 0: continue
+                if abs(dy) >= gy or abs(dx) >= gx: continue
+
+                # Rows are visited so that every source row is read before the
+                # pass updates it, as if the whole pass read a copy of the maps
+                for begin, end in (reversed(tiles) if dy < 0 else tiles):
+                    # Zones at (y, x) and the neighbours at (y + dy, x + dx) they look at
+                    y0 = max(begin, -dy)
+                    y1 = min(end, gy - dy)
+                    if y0 >= y1: continue
+                    dst = (slice(y0, y1), slice(max(0, -dx), gx - max(0, dx)))
+                    src = (slice(y0 + dy, y1 + dy), slice(max(0, dx), gx - max(0, -dx)))
+
+                    candidate = numpy.array(nearest[src])
+                    candidate_x = numpy.array(nearest_x[src])
+                    candidate_y = numpy.array(nearest_y[src])
+                    candidate_dist = ((candidate_x - cols[dst[1]]).astype(numpy.int64) ** 2 +
+                                      (candidate_y - numpy.arange(y0, y1).reshape(-1, 1)).astype(numpy.int64) ** 2)
+
+                    better = (candidate >= 0) & (candidate_dist < dist[dst])
+                    nearest[dst][better] = candidate[better]
+                    nearest_x[dst][better] = candidate_x[better]
+                    nearest_y[dst][better] = candidate_y[better]
+                    dist[dst][better] = candidate_dist[better]
+
+    return nearest.reshape(-1)
+
 def get_spiral_path(grid: dict, range_radius: int) -> list:
     """
     Compute a spiral path for zone search whithin a range.
@@ -791,7 +1637,7 @@ def get_spiral_path(grid: dict, range_radius: int) -> list:
 
 def get_zones_in_area(grid: dict, center_id: int, radius: int) -> list:
     """
-    Get all zones within a squared area.
+    Get the IDs of all zones within a squared area.
     """
     center_x = int(center_id % grid['grid_x'])
     center_y = int(center_id / grid['grid_x'])
@@ -805,181 +1651,431 @@ def get_zones_in_area(grid: dict, center_id: int, radius: int) -> list:
             if j < 0: continue
             if j >= grid['grid_x']: break
 
-            zones.append(grid['zones'][i * grid['grid_x'] + j])
+            zones.append(i * grid['grid_x'] + j)
     
-    zones.sort(key=lambda zone : zone['id'])
+    zones.sort()
     return zones
 
-if __name__ == '__main__':
-    """
-    Main program.
+def write_raster(filename: str, grid: dict):
     """
-    if len(sys.argv) < 2:
-        print(f'Use: {sys.argv[0]} config.json\n')
-        print('config.json is a configuration file in JSON format. See examples in conf folder.')
-        sys.exit(EXIT_HELP)
+    Write the classified grid as a compact raster result in NumPy .npz format.
 
-    # Python multiprocessing start method
-    mp.set_start_method('spawn')
+    Zones form a regular lattice, so the grid bbox and size are enough to
+    locate them. The file holds:
 
-    # Config file
-    fp = open(sys.argv[1], 'r')
-    conf = json.load(fp)
+    - left, bottom, right, top, zone_size, grid_x, grid_y, M: grid header;
+    - RL: uint8 array of shape (grid_y, grid_x), 0 for zones outside the AoI;
+    - inside, roads, edus: flags of every zone, packed with numpy.packbits.
+    """
+    edus = numpy.zeros(grid['n_zones'], dtype=numpy.bool_)
+    for i in range(1, grid['M'] + 1):
+        edus[grid['edus'][i]] = True
+
+    fp = open(filename, 'wb')
+    numpy.savez_compressed(
+        fp,
+        left=numpy.float64(grid['left']),
+        bottom=numpy.float64(grid['bottom']),
+        right=numpy.float64(grid['right']),
+        top=numpy.float64(grid['top']),
+        zone_size=numpy.int64(grid['zone_size']),
+        grid_x=numpy.int64(grid['grid_x']),
+        grid_y=numpy.int64(grid['grid_y']),
+        M=numpy.int64(grid['M']),
+        RL=numpy.where(grid['inside'], grid['RL'], 0).astype(numpy.uint8).reshape(grid['grid_y'], grid['grid_x']),
+        inside=numpy.packbits(grid['inside']),
+        roads=numpy.packbits(grid['inside'] & grid['is_road']),
+        edus=numpy.packbits(edus)
+    )
     fp.close()
 
-    # Create a new grid and initialize its zones
-    grid = create_riskzones_grid(
-        conf['left'], conf['bottom'], conf['right'], conf['top'],
-        conf['zone_size'], conf['M'], conf['edus']
-    )
-    init_zones(grid)
+def open_output(filename: str):
+    """
+    Open an output text file, gzip compressed if its name ends with '.gz'.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt', compresslevel=CSV_GZIP_LEVEL)
+    else:
+        return open(filename, 'w')
 
-    # Get PoIs and roads from OSM file
-    pois, roads = osmpois.extract_pois(conf['pois'], conf['pois_types'])
+def write_points_csv(filename: str, grid: dict, ids: numpy.ndarray, classes: numpy.ndarray = None):
+    """
+    Write the zones in ids as points to a CSV file, with their class if
+    classes is given.
 
-    # Load cache file if enabled
-    cache_filename = f'{os.path.splitext(sys.argv[1])[0]}.cache'
-    if conf['cache_zones'] == True and os.path.isfile(cache_filename):
-        try:
-            print(f'Loading cache file {cache_filename}...')
-            fp = open(cache_filename, 'r')
-            load_zones(grid, json.load(fp))
-            fp.close()
-        except json.JSONDecodeError:
-            print('The cache file is corrupted. Delete it and run the program again.')
-            exit(EXIT_CACHE_CORRUPTED)
+    Rows are formatted and written CSV_CHUNK_SIZE zones at a time, so the
+    whole file is never held in memory.
+    """
+    if classes is None:
+        header = 'system:index,.geo\n'
+        template = '{:020},"{{""type"":""Point"",""coordinates"":[{},{}]}}"\n'
     else:
-        # GeoJSON file
-        try:
-            fp = open(conf['geojson'], 'r')
-            geojson_collection = geojson.load(fp)
-            fp.close()
+        header = 'system:index,class,.geo\n'
+        template = '{:020},{},"{{""type"":""Point"",""coordinates"":[{},{}]}}"\n'
+
+    fp = open_output(filename)
+    fp.write(header)
+    for begin in range(0, len(ids), CSV_CHUNK_SIZE):
+        chunk = ids[begin:begin + CSV_CHUNK_SIZE]
+        columns = [range(begin, begin + len(chunk))]
+        if classes is not None:
+            columns.append(classes[begin:begin + CSV_CHUNK_SIZE].tolist())
+        columns.append(grid['lon'][chunk].tolist())
+        columns.append(grid['lat'][chunk].tolist())
+        fp.write(''.join([template.format(*row) for row in zip(*columns)]))
+    fp.close()
 
-            polygons = []
-            if geojson_collection.type == 'FeatureCollection':
-                if geojson_collection.features[0].geometry.type == 'Polygon':
-                    polygons.append(geojson_collection.features[0].geometry.coordinates[0])
-                elif geojson_collection.features[0].geometry.type == 'MultiPolygon':
-                    polygons = geojson_collection.features[0].geometry.coordinates[0]
+def set_edus_positions(grid: dict, edu_alg: str):
+    """
+    Position the EDUs with the algorithm named edu_alg.
+    """
+    if edu_alg == 'random':
+        set_edus_positions_random(grid)
+    elif edu_alg == 'balanced':
+        set_edus_positions_uniform(grid, UNBALANCED)
+    elif edu_alg == 'enhanced':
+        set_edus_positions_uniform(grid, BALANCED)
+    elif edu_alg == 'restricted':
+        set_edus_positions_uniform(grid, RESTRICTED)
 
-            add_polygon(grid, polygons)
-            print(f'{grid["pol_points"]} points form the AoI polygon.')
+def write_results(grid: dict, conf: dict) -> int:
+    """
+    Write the output files set in conf, except res_data, and return the
+    number of CSV rows written.
+    """
+    # Write a CSV file with risk zones
+    write_points_csv(conf['output'], grid, grid['zones_inside'], grid['RL'][grid['zones_inside']])
+    rows = len(grid['zones_inside'])
+    
+    # Write a CSV file with EDUs positions
+    if 'output_edus' in conf.keys():
+        edus = [edu for i in range(1, grid['M'] + 1) for edu in grid['edus'][i]]
+        write_points_csv(conf['output_edus'], grid, numpy.array(edus, dtype=numpy.int64))
+        rows += len(edus)
 
-            time_begin = time.perf_counter()
-            init_zones_by_polygon(grid)
-            if len(grid['zones_inside']) == 0:
-                print('No zones to classify!')
-                exit(EXIT_NO_ZONES)
-
-            init_pois_by_polygon(grid, pois)
-            if len(grid['pois']) == 0:
-                print('No PoIs inside the AoI!')
-                exit(EXIT_NO_POIS)
-        except KeyError:
-            print('WARNING: No GeoJSON file specified. Not filtering by AoI polygon.')
-            grid['pois'] = pois
-        except FileNotFoundError:
-            print(f'WARNING: GeoJSON file {conf["geojson"]} not found. Not filtering by AoI polygon.')
-            grid['pois'] = pois
+    # Write a CSV file with forbidden zones
+    if 'output_roads' in conf.keys():
+        roads = grid['zones_inside'][grid['is_road'][grid['zones_inside']]]
+        write_points_csv(conf['output_roads'], grid, roads)
+        rows += len(roads)
 
-        # Calculate risks
-        calculate_risk_from_pois(grid)
+    # Write a compact raster with the whole result
+    if 'output_raster' in conf.keys():
+        write_raster(conf['output_raster'], grid)
 
-        # Output elapsed time
-        time_classification = time.perf_counter() - time_begin
-        print(f'Classification time: {round(time_classification, 3)} seconds.')
+    return rows
 
-    # Write cache file
-    if conf['cache_zones'] == True and not os.path.isfile(cache_filename):
-        print('Writing cache file... ', end='')
-        fp = open(cache_filename, 'w')
-        json.dump(grid['zones'], fp)
-        fp.close()
-        print('Done!')
+def write_res_data(filename: str, grid: dict, time_classification: float, time_positioning: float, stages: dict):
+    """
+    Write a JSON file with results data and the statistics of each stage
+    (see stagestats).
+    """
+    n_edus = 0
+    for i in range(1, grid['M'] + 1):
+        n_edus += len(grid['edus'][i])
 
-    # Run EDUs positioning algorithm
-    time_begin = time.perf_counter()
+    res_data = {
+        'n_zones': len(grid['zones_inside']),
+        'n_pois': len(grid['pois']),
+        'n_edus': n_edus,
+        'time_classification': time_classification,
+        'time_positioning': time_positioning,
+        'time_total': stagestats.get_total_time(stages),
+        'peak_rss': stagestats.get_total_peak_rss(stages),
+        'stages': stages
+    }
 
-    add_roads(grid, roads)
-    print(f'{grid["roads_points"]} allowed zones.')
+    fp = open(filename, 'w')
+    json.dump(res_data, fp)
+    fp.close()
 
-    if conf['edu_alg'] == 'random':
-        set_edus_positions_random(grid)
-    elif conf['edu_alg'] == 'balanced':
-        set_edus_positions_uniform(grid, UNBALANCED)
-    elif conf['edu_alg'] == 'enhanced':
-        set_edus_positions_uniform(grid, BALANCED)
-    elif conf['edu_alg'] == 'restricted':
-        set_edus_positions_uniform(grid, RESTRICTED)
 
-    # Output elapsed time
-    time_positioning = time.perf_counter() - time_begin
-    print(f'Positioning time: {round(time_positioning, 3)} seconds.')
+class RiskZonesEngine:
+    """
+    RiskZones pipeline for a config (the contents of a config file).
+
+    The steps are load(), classify(), place_edus() and export(), or run() to
+    go through all of them for the main config and its scenarios. Errors
+    raise RiskZonesError. The process pool (see get_pool) is left running
+    when the engine is done, so the next engines in the same process reuse
+    its workers.
+    """
+    def __init__(self, conf: dict, cache_filename: str = None):
+        self.conf = conf
+        self.cache_filename = cache_filename
+        self.runs = [conf]
+        if 'scenarios' in conf.keys():
+            self.runs += [get_scenario_conf(conf, scenario, i) for i, scenario in enumerate(conf['scenarios'], 1)]
+        self.runs_RL = None
+        self.grid = None
+        self.pois = None
+        self.roads = None
+        self.time_classification = [0] * len(self.runs)
+        self.time_roads = None
+        self.time_positioning = 0
+
+        # Statistics of the stages shared by every run and of each run
+        self.stats = stagestats.StageStats(get_pool_pids)
+        self.runs_stats = [stagestats.StageStats(get_pool_pids) for run in self.runs]
+
+    def load(self):
+        """
+        Create the grid and read the PoIs and roads from the OSM file (only
+        the grid area of PBF files) or from the grid area of an OSM store
+        (see osmstore), if pois is a directory.
+        """
+        conf = self.conf
+        self.grid = create_riskzones_grid(
+            conf['left'], conf['bottom'], conf['right'], conf['top'],
+            conf['zone_size'], conf['M'], conf['edus'], conf.get('haversine', False)
+        )
+        with self.stats.stage('grid') as record:
+            init_zones(self.grid)
+            record['zones'] = self.grid['n_zones']
+            record['tiled'] = self.grid['tiled']
+
+        bbox = (conf['left'], conf['bottom'], conf['right'], conf['top'])
+        if os.path.isdir(conf['pois']):
+            self.pois, self.roads = osmstore.query(conf['pois'], bbox, conf['pois_types'], self.stats)
+        else:
+            self.pois, self.roads = osmpois.extract_pois(conf['pois'], conf['pois_types'], self.stats, bbox, get_pool())
 
-    print('Writing output CSV files... ', end='')
+    def get_polygons(self) -> list:
+        """
+        Get the AoI polygons from the GeoJSON file, or None if there is none.
+        """
+        try:
+            fp = open(self.conf['geojson'], 'r')
+            geojson_collection = geojson.load(fp)
+            fp.close()
+        except KeyError:
+            print('WARNING: No GeoJSON file specified. Not filtering by AoI polygon.')
+            return None
+        except FileNotFoundError:
+            print(f'WARNING: GeoJSON file {self.conf["geojson"]} not found. Not filtering by AoI polygon.')
+            return None
+
+        polygons = []
+        if geojson_collection.type == 'FeatureCollection':
+            if geojson_collection.features[0].geometry.type == 'Polygon':
+                polygons.append(geojson_collection.features[0].geometry.coordinates[0])
+            elif geojson_collection.features[0].geometry.type == 'MultiPolygon':
+                polygons = geojson_collection.features[0].geometry.coordinates[0]
+        return polygons
+
+    def classify(self):
+        """
+        Classify the zones inside the AoI for the main config and its
+        scenarios, loading the zones cache if enabled.
+        """
+        grid = self.grid
+        conf = self.conf
+
+        # Load cache file if enabled. Scenarios need the influence of each
+        # group of PoIs, which the zones cache doesn't keep.
+        use_cache = conf['cache_zones'] == True and self.cache_filename != None
+        cache_fingerprint = get_cache_fingerprint(conf) if use_cache else None
+        cache_loaded = False
+        stages = stagecache.open_from_env() if not grid['tiled'] else None
+        if use_cache and len(self.runs) == 1 and os.path.isfile(self.cache_filename):
+            try:
+                print(f'Loading cache file {self.cache_filename}...')
+                with self.stats.stage('cache_load') as record:
+                    load_cache(grid, self.cache_filename, cache_fingerprint)
+                    record['zones'] = len(grid['zones_inside'])
+                cache_loaded = True
+            except InvalidCache as e:
+                print(f'WARNING: Ignoring cache file: {e}.')
+            except (ValueError, KeyError):
+                raise RiskZonesError('The cache file is corrupted. Delete it and run the program again.', EXIT_CACHE_CORRUPTED)
+
+        if not cache_loaded:
+            polygons = self.get_polygons()
+            if polygons == None:
+                time_begin = time.perf_counter()
+                set_pois(grid, self.pois)
+            else:
+                add_polygon(grid, polygons)
+                print(f'{grid["pol_points"]} points form the AoI polygon.')
+
+                time_begin = time.perf_counter()
+                with self.stats.stage('polygon') as record:
+                    key = stagecache.get_key('inside', get_grid_geometry(grid), polygons)
+                    record['cached'] = load_stage(grid, stages, 'AoI polygon', key)
+                    if not record['cached']:
+                        init_zones_by_polygon(grid)
+                        store_stage(grid, stages, key, ('inside', 'zones_inside'))
+                    record['vertices'] = grid['pol_points']
+                    record['zones'] = len(grid['zones_inside'])
+                if len(grid['zones_inside']) == 0:
+                    raise RiskZonesError('No zones to classify!', EXIT_NO_ZONES)
+
+                with self.stats.stage('pois') as record:
+                    pois_data = numpy.array([[poi['lat'], poi['lon']] for poi in self.pois], dtype=numpy.float64)
+                    key = stagecache.get_key('pois', polygons, pois_data)
+                    record['cached'] = load_stage(grid, stages, 'PoIs filter', key)
+                    if record['cached']:
+                        set_pois(grid, [self.pois[i] for i in grid['pois_index'].tolist()])
+                    else:
+                        init_pois_by_polygon(grid, self.pois)
+                        store_stage(grid, stages, key, ('pois_index',))
+                    record['pois'] = len(self.pois)
+                    record['pois_inside'] = len(grid['pois'])
+                if len(grid['pois']) == 0:
+                    raise RiskZonesError('No PoIs inside the AoI!', EXIT_NO_POIS)
+
+            # Calculate risks
+            risk_params = [
+                conf.get('risk_engine', RISK_EXACT),
+                conf.get('risk_radius', RISK_RADIUS),
+                conf.get('risk_tolerance', RISK_TOLERANCE),
+                conf.get('fft_window', FFT_WINDOW)
+            ]
+            with self.stats.stage('risk') as record:
+                # PoI type weights are left out of the key: they only reweight the
+                # cached influence of each group of PoIs
+                pois_weight = numpy.where(grid['pois_group'] == '', grid['pois_weight'], 0)
+                key = stagecache.get_key('risk', get_grid_geometry(grid), grid['zones_inside'],
+                                         grid['pois_lat'], grid['pois_lon'], grid['pois_group'], pois_weight, risk_params)
+                record['cached'] = load_stage(grid, stages, 'risk', key)
+                if record['cached']:
+                    grid['influence_groups'] = grid['influence_groups'].tolist()
+                    grid['influence_weights'] = get_pois_groups(grid)[1]
+                    reweight_risks(grid)
+                else:
+                    calculate_risk_from_pois(grid, *risk_params)
+                    store_stage(grid, stages, key, ('influence_groups', 'influences'))
+                record['engine'] = risk_params[0]
+                record['zones'] = len(grid['zones_inside'])
+                record['pois'] = len(grid['pois'])
+                record['groups'] = len(grid['influence_groups'])
+
+            # Output elapsed time
+            self.time_classification[0] = time.perf_counter() - time_begin
+            print(f'Classification time: {round(self.time_classification[0], 3)} seconds.')
+
+        # Write cache file
+        if use_cache and not cache_loaded:
+            print('Writing cache file... ', end='')
+            with self.stats.stage('cache_write') as record:
+                write_cache(grid, self.cache_filename, cache_fingerprint)
+                record['bytes'] = os.path.getsize(self.cache_filename)
+            print('Done!')
+
+        # Scenarios share the zones, PoIs and influences of the main config
+        if len(self.runs) > 1:
+            time_begin = time.perf_counter()
+            print(f'Classifying {len(self.runs) - 1} scenarios... ', end='')
+            with self.stats.stage('scenarios') as record:
+                self.runs_RL = classify_scenarios(grid, get_scenarios_weights(grid, self.runs), [run['M'] for run in self.runs])
+                record['scenarios'] = len(self.runs) - 1
+            self.time_classification[1:] = [(time.perf_counter() - time_begin) / (len(self.runs) - 1)] * (len(self.runs) - 1)
+            print('Done!')
+
+    def place_edus(self, run: int = 0):
+        """
+        Position the EDUs for the main config (run 0) or a scenario.
+        """
+        grid = self.grid
+
+        # Roads are the same for every run
+        if self.time_roads == None:
+            time_begin = time.perf_counter()
+            with self.stats.stage('roads') as record:
+                add_roads(grid, self.roads)
+                record['segments'] = len(self.roads)
+                record['zones'] = grid['roads_points']
+            print(f'{grid["roads_points"]} allowed zones.')
+            self.time_roads = time.perf_counter() - time_begin
+
+        grid['M'] = self.runs[run]['M']
+        grid['n_edus'] = self.runs[run]['edus']
+        if self.runs_RL != None:
+            grid['RL'][grid['zones_inside']] = self.runs_RL[run]
+
+        # Run EDUs positioning algorithm
+        time_begin = time.perf_counter()
+        with self.runs_stats[run].stage('positioning') as record:
+            set_edus_positions(grid, self.runs[run]['edu_alg'])
+            record['algorithm'] = self.runs[run]['edu_alg']
+            record['edus'] = sum(len(grid['edus'][i]) for i in range(1, grid['M'] + 1))
+        self.time_positioning = self.time_roads + time.perf_counter() - time_begin
+        print(f'Positioning time: {round(self.time_positioning, 3)} seconds.')
+
+    def export(self, run: int = 0):
+        """
+        Write the output files of the main config (run 0) or a scenario,
+        with the statistics of its stages in res_data.
+        """
+        print('Writing output CSV files... ', end='')
+        with self.runs_stats[run].stage('output') as record:
+            record['rows'] = write_results(self.grid, self.runs[run])
+
+        if 'res_data' in self.runs[run].keys():
+            stages = {**self.stats.stages, **self.runs_stats[run].stages}
+            write_res_data(self.runs[run]['res_data'], self.grid, self.time_classification[run], self.time_positioning, stages)
+        print('Done.')
+
+    def run(self):
+        """
+        Run the whole pipeline for the main config and its scenarios.
+        """
+        # Profile the whole run if asked
+        if 'profile' in self.conf.keys():
+            profile = cProfile.Profile()
+            profile.enable()
 
-    # Write a JSON file with results data
-    if 'res_data' in conf.keys():
-        n_edus = 0
-        for i in range(1, grid['M'] + 1):
-            n_edus += len(grid['edus'][i])
-
-        res_data = {
-            'n_zones': len(grid['zones_inside']),
-            'n_pois': len(grid['pois']),
-            'n_edus': n_edus,
-            'time_classification': time_classification,
-            'time_positioning': time_positioning
-        }
-
-        fp = open(conf['res_data'], 'w')
-        json.dump(res_data, fp)
-        fp.close()
+        try:
+            self.load()
+            self.classify()
+            for run in range(len(self.runs)):
+                if run > 0:
+                    print(f'Scenario {run}:')
+                self.place_edus(run)
+                self.export(run)
+        except MemoryError:
+            raise get_memory_error()
+        finally:
+            if 'profile' in self.conf.keys():
+                profile.disable()
+                profile.dump_stats(self.conf['profile'])
+
+    def close(self):
+        """
+        Delete the spill files of a tiled grid and free the shared blocks left
+        by a failed run, keeping the pool workers.
+        """
+        if self.grid != None and self.grid.get('tiled'):
+            shutil.rmtree(self.grid['spill_dir'], True)
+        if pool != None:
+            pool.release()
 
-    # Write a CSV file with risk zones
-    row = 0
-    data = 'system:index,class,.geo\n'
-    grid['zones_inside'].sort()
+if __name__ == '__main__':
+    """
+    Main program.
+    """
+    if len(sys.argv) < 2:
+        print(f'Use: {sys.argv[0]} config.json\n')
+        print('config.json is a configuration file in JSON format. See examples in conf folder.')
+        sys.exit(EXIT_HELP)
 
-    for id in grid['zones_inside']:
-        coordinates = f'[{grid["zones"][id]["lon"]},{grid["zones"][id]["lat"]}]'
-        data += f'{row:020},{grid["zones"][id]["RL"]},"{{""type"":""Point"",""coordinates"":{coordinates}}}"\n'
-        row += 1
+    # Python multiprocessing start method
+    mp.set_start_method('spawn')
+    set_memory_limit()
 
-    fp = open(conf['output'], 'w')
-    fp.write(data)
+    # Config file
+    fp = open(sys.argv[1], 'r')
+    conf = json.load(fp)
     fp.close()
-    
-    # Write a CSV file with EDUs positions
-    if 'output_edus' in conf.keys():
-        row = 0
-        data = 'system:index,.geo\n'
-
-        for i in range(1, grid['M'] + 1):
-            for zone in grid['edus'][i]:
-                coordinates = f'[{zone["lon"]},{zone["lat"]}]'
-                data += f'{row:020},"{{""type"":""Point"",""coordinates"":{coordinates}}}"\n'
-                row += 1
-
-        fp = open(conf['output_edus'], 'w')
-        fp.write(data)
-        fp.close()
 
-    # Write a CSV file with forbidden zones
-    if 'output_roads' in conf.keys():
-        row = 0
-        data = 'system:index,.geo\n'
-
-        for id in grid['zones_inside']:
-            zone = grid['zones'][id]
-            if zone['is_road']:
-                coordinates = f'[{zone["lon"]},{zone["lat"]}]'
-                data += f'{row:020},"{{""type"":""Point"",""coordinates"":{coordinates}}}"\n'
-                row += 1
-
-        fp = open(conf['output_roads'], 'w')
-        fp.write(data)
-        fp.close()
+    engine = RiskZonesEngine(conf, f'{os.path.splitext(sys.argv[1])[0]}.cache')
+    try:
+        engine.run()
+    except RiskZonesError as e:
+        print(e)
+        exit(e.status)
+    finally:
+        engine.close()
+        close_pool()
 
-    print('Done.')
     exit(EXIT_OK)
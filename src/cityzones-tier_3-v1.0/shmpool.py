@@ -0,0 +1,164 @@
+# encoding:utf-8
+"""
+RiskZones shared memory process pool
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This module contains a process pool whose tasks read their input arrays from
+shared memory blocks instead of receiving them pickled.
+
+The main process copies each array once with SharedPool.share(), which returns
+a small descriptor. Tasks receive only descriptors and an index range, and call
+attach() to get a NumPy view of the shared data.
+"""
+
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy
+
+# Shared memory blocks attached by this process and the generation they belong to
+attached = {}
+attached_generation = None
+
+class SharedPool:
+    """
+    Process pool created once per run that shares arrays with its workers.
+
+    initializer(*initargs) is called by every worker when it starts.
+    """
+    def __init__(self, processes: int = None, initializer=None, initargs: tuple = ()):
+        self.processes = processes if processes != None else os.cpu_count()
+        self.pool = mp.Pool(processes=self.processes, initializer=initializer, initargs=initargs)
+        self.blocks = {}
+        self.generation = 0
+
+    def share(self, array: numpy.ndarray) -> tuple:
+        """
+        Copy an array to a new shared memory block and return its descriptor.
+        """
+        array = numpy.ascontiguousarray(array)
+        descriptor = self.empty(array.shape, array.dtype)
+        self.view(descriptor)[...] = array
+        return descriptor
+
+    def empty(self, shape: tuple, dtype) -> tuple:
+        """
+        Create an uninitialized shared array and return its descriptor.
+        """
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape)) * dtype.itemsize
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.blocks[block.name] = block
+        return (block.name, tuple(shape), dtype.str, self.generation)
+
+    def share_dict(self, arrays: dict) -> dict:
+        """
+        Share every array in a dict and return a dict of descriptors.
+        """
+        return {key: self.share(value) for key, value in arrays.items()}
+
+    def view(self, descriptor: tuple) -> numpy.ndarray:
+        """
+        Get a view of a shared array in the main process.
+        """
+        name, shape, dtype, _ = descriptor
+        return numpy.ndarray(shape, dtype=dtype, buffer=self.blocks[name].buf)
+
+    def map_ranges(self, func, length: int, chunk: int, *args) -> list:
+        """
+        Run func(*args, begin, end) for consecutive index ranges of at most
+        chunk items covering [0, length).
+        """
+        # Make sure every worker gets something to do
+        chunk = max(1, min(chunk, -(-length // self.processes)))
+        payload = []
+        for begin in range(0, length, chunk):
+            payload.append((*args, begin, min(begin + chunk, length)))
+        return self.starmap(func, payload)
+
+    def starmap(self, func, payload: list) -> list:
+        """
+        Run func(*args) in the workers for every tuple of args in payload.
+        """
+        return self.pool.starmap(func, payload)
+
+    def get_pids(self) -> list:
+        """
+        Get the PIDs of the worker processes, or an empty list if they can't
+        be known.
+        """
+        # multiprocessing.Pool has no public list of its processes, but keeps
+        # the current ones (including replaced workers) in _pool
+        processes = getattr(self.pool, '_pool', None)
+        if processes == None:
+            return []
+        return [process.pid for process in processes if process.pid != None]
+
+    def release(self):
+        """
+        Free every shared block created so far.
+        """
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks.clear()
+        self.generation += 1
+
+    def close(self, terminate: bool = False):
+        """
+        Free shared blocks and stop the workers, without waiting for pending
+        tasks if terminate is set.
+        """
+        self.release()
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+def attach(descriptor: tuple) -> numpy.ndarray:
+    """
+    Get a view of a shared array inside a worker.
+
+    Blocks from previous generations are detached as soon as a newer one is
+    seen, so a long-lived worker doesn't keep freed memory mapped.
+    """
+    global attached_generation
+
+    name, shape, dtype, generation = descriptor
+    if generation != attached_generation:
+        blocks = [block for block, _ in attached.values()]
+        attached.clear()
+        for block in blocks:
+            block.close()
+        attached_generation = generation
+
+    if name not in attached:
+        block = shared_memory.SharedMemory(name=name)
+        attached[name] = (block, numpy.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+    return attached[name][1]
+
+def attach_dict(descriptors: dict) -> dict:
+    """
+    Attach every descriptor in a (possibly nested) dict of descriptors.
+    """
+    arrays = {}
+    for key, value in descriptors.items():
+        arrays[key] = attach_dict(value) if isinstance(value, dict) else attach(value)
+    return arrays
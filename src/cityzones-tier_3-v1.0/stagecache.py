@@ -0,0 +1,125 @@
+# encoding:utf-8
+"""
+RiskZones stage cache
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This module contains a disk cache for the outputs of the riskzones pipeline
+stages.
+
+Each stage output is a set of NumPy arrays stored under a key computed from
+the exact inputs of the stage with get_key(), so a new task with the same AoI
+and PoIs finds the outputs of a previous task regardless of its file names.
+When the cache grows over its size budget, the least recently used entries are
+deleted.
+"""
+
+import os
+import json
+import hashlib
+import numpy
+
+# Default size budget of the cache (MiB).
+CACHE_SIZE = 1024
+
+class StageCache:
+    """
+    Stage outputs stored in a directory, limited to budget bytes.
+    """
+    def __init__(self, directory: str, budget: int):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_filename(self, key: str) -> str:
+        """
+        Get the file name of a cache entry.
+        """
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def load(self, key: str) -> dict:
+        """
+        Get the arrays stored under key, or None if there is no such entry.
+        """
+        filename = self.get_filename(key)
+        try:
+            with numpy.load(filename) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+        # The modification time tracks the last use of the entry
+        os.utime(filename)
+        return arrays
+
+    def store(self, key: str, arrays: dict):
+        """
+        Store arrays under key and evict old entries if the cache is over
+        its budget.
+        """
+        filename = self.get_filename(key)
+        fp = open(f'{filename}.tmp', 'wb')
+        numpy.savez(fp, **arrays)
+        fp.close()
+        os.replace(f'{filename}.tmp', filename)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits its budget.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+def get_key(stage: str, *inputs) -> str:
+    """
+    Compute the cache key of a stage from its inputs.
+
+    Inputs may be NumPy arrays or JSON serializable values.
+    """
+    digest = hashlib.sha256(stage.encode())
+    for value in inputs:
+        if isinstance(value, numpy.ndarray):
+            digest.update(f'{value.dtype.str}{value.shape}'.encode())
+            digest.update(numpy.ascontiguousarray(value).tobytes())
+        else:
+            digest.update(json.dumps(value, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def open_from_env() -> StageCache:
+    """
+    Open the cache set by the STAGE_CACHE_DIR and STAGE_CACHE_SIZE (MiB)
+    environment variables, or return None if STAGE_CACHE_DIR is not set.
+    """
+    if os.getenv('STAGE_CACHE_DIR') == None:
+        return None
+
+    size = int(os.getenv('STAGE_CACHE_SIZE')) if os.getenv('STAGE_CACHE_SIZE') != None else CACHE_SIZE
+    return StageCache(os.getenv('STAGE_CACHE_DIR'), size * (1024 ** 2))
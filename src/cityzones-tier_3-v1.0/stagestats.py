@@ -0,0 +1,155 @@
+# encoding:utf-8
+"""
+RiskZones stage statistics
+Copyright (C) 2023 João Paulo Just Peixoto
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************
+
+This module measures the resources used by each stage of the riskzones
+pipeline: wall time, CPU time and peak resident memory of the main process
+and of the pool workers, along with item counts set by the stage itself.
+
+On Linux the peak memory of each process is reset at the start of every stage
+(through /proc/<pid>/clear_refs), so it is the peak of that stage alone.
+Elsewhere it is the peak of the whole process up to the end of the stage and
+the pool workers are not measured.
+"""
+
+import os
+import time
+import resource
+import contextlib
+
+# Clock ticks per second of the CPU times in /proc/<pid>/stat
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+class StageStats:
+    """
+    Statistics of the stages of a run, in the order they ran.
+
+    get_pids is a function that returns the PIDs of the pool workers.
+    """
+    def __init__(self, get_pids=None):
+        self.get_pids = get_pids if get_pids != None else list
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Measure a stage. The record of the stage is yielded, so the stage can
+        add its item counts to it. A stage measured again is added to its
+        previous statistics.
+        """
+        record = {}
+        pids = self.get_pids()
+        for pid in ['self', *pids]:
+            reset_peak_rss(pid)
+        workers_cpu = {pid: get_cpu_time(pid) for pid in pids}
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            yield record
+        finally:
+            stats = {
+                'wall': time.perf_counter() - wall,
+                'cpu': time.process_time() - cpu,
+                'workers_cpu': 0.0,
+                'peak_rss': get_peak_rss('self'),
+                'workers_peak_rss': 0
+            }
+            for pid in self.get_pids():
+                stats['workers_cpu'] += get_cpu_time(pid) - workers_cpu.get(pid, 0.0)
+                stats['workers_peak_rss'] = max(stats['workers_peak_rss'], get_peak_rss(pid))
+
+            stats.update(record)
+            if name in self.stages.keys():
+                stats = merge_stats(self.stages[name], stats)
+            self.stages[name] = stats
+
+def get_total_time(stages: dict) -> float:
+    """
+    Get the wall time of all stages in a dict of stage statistics.
+    """
+    return sum(stats['wall'] for stats in stages.values())
+
+def get_total_peak_rss(stages: dict) -> int:
+    """
+    Get the highest peak memory of a process in all stages in a dict of stage
+    statistics.
+    """
+    return max([max(stats['peak_rss'], stats['workers_peak_rss']) for stats in stages.values()], default=0)
+
+def merge_stats(previous: dict, stats: dict) -> dict:
+    """
+    Merge the statistics of two measures of a stage: peaks are the highest of
+    both, other numbers are summed.
+    """
+    merged = dict(previous)
+    for key, value in stats.items():
+        if key in ('peak_rss', 'workers_peak_rss'):
+            merged[key] = max(previous.get(key, 0), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key in previous.keys():
+            merged[key] = previous[key] + value
+        else:
+            merged[key] = value
+    return merged
+
+def reset_peak_rss(pid):
+    """
+    Reset the peak resident memory of a process, if the system allows it.
+    """
+    try:
+        fp = open(f'/proc/{pid}/clear_refs', 'w')
+        fp.write('5')
+        fp.close()
+    except OSError:
+        pass
+
+def get_peak_rss(pid) -> int:
+    """
+    Get the peak resident memory of a process (bytes).
+    """
+    try:
+        fp = open(f'/proc/{pid}/status', 'r')
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                fp.close()
+                return int(line.split()[1]) * 1024
+        fp.close()
+    except OSError:
+        pass
+
+    if pid != 'self':
+        return 0
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def get_cpu_time(pid) -> float:
+    """
+    Get the CPU time (user and system) used by a process so far (seconds).
+    """
+    try:
+        fp = open(f'/proc/{pid}/stat', 'r')
+        fields = fp.read().rsplit(')', 1)[1].split()
+        fp.close()
+    except OSError:
+        return 0.0
+
+    # utime and stime are fields 14 and 15 of the stat line
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
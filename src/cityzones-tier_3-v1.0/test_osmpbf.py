@@ -0,0 +1,58 @@
+import numpy
+import pytest
+import osmpbf
+import osmpois
+import xml.etree.ElementTree as ET
+
+POIS_TYPES = {'amenity': {'hospital': {'w': 10}, 'police': {'w': 2}, 'fire_station': {'w': 5}, 'school': {'w': 1}}}
+
+def encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value == 0:
+            data.append(byte)
+            return bytes(data)
+        data.append(byte | 0x80)
+
+def extract_xml(source: str, filename: str, bbox: tuple):
+    """
+    Cut an XML file as osmium extract -b does (complete_ways strategy).
+    """
+    left, bottom, right, top = bbox
+    root = ET.parse(source).getroot()
+    nodes = [element for element in root if element.tag == 'node']
+    inside = {node.get('id') for node in nodes if bottom <= float(node.get('lat')) <= top and left <= float(node.get('lon')) <= right}
+    ways = [way for way in root if way.tag == 'way' and any(nd.get('ref') in inside for nd in way.iter('nd'))]
+    needed = (inside | {nd.get('ref') for way in ways for nd in way.iter('nd')}) & {node.get('id') for node in nodes}
+    way_ids = {way.get('id') for way in ways}
+    relations = [relation for relation in root if relation.tag == 'relation' and any(
+        (member.get('type') == 'node' and member.get('ref') in needed) or (member.get('type') == 'way' and member.get('ref') in way_ids)
+        for member in relation.iter('member'))]
+
+    extract = ET.Element('osm', version='0.6')
+    extract.extend([node for node in nodes if node.get('id') in needed] + ways + relations)
+    ET.ElementTree(extract).write(filename)
+
+def test_decode_varints():
+    rng = numpy.random.default_rng(0)
+    values = rng.integers(-2 ** 62, 2 ** 62, 1000).tolist() + [0, 1, -1, 2 ** 63 - 1, -2 ** 63]
+    zigzag = [(value << 1) ^ (value >> 63) for value in values]
+    data = memoryview(b''.join(encode_varint(value & (2 ** 64 - 1)) for value in zigzag))
+    assert osmpbf.read_packed(data) == [value & (2 ** 64 - 1) for value in zigzag]
+    assert osmpbf.decode_zigzag(osmpbf.decode_varints(data)).tolist() == values
+
+def test_pbf_matches_xml():
+    pois_xml, roads_xml = osmpois.extract_pois('osm/test.osm', POIS_TYPES)
+    pois_pbf, roads_pbf = osmpois.extract_pois('osm/test.osm.pbf', POIS_TYPES)
+    assert pois_pbf == pois_xml
+    assert numpy.array_equal(roads_pbf, roads_xml)
+
+@pytest.mark.parametrize('bbox', [(-38.95, -12.244, -38.94, -12.235), (-38.9548, -12.2459, -38.9349, -12.2298), (10, 10, 11, 11)])
+def test_pbf_bbox(tmp_path, bbox):
+    extract_xml('osm/test.osm', tmp_path / 'extract.osm', bbox)
+    pois_xml, roads_xml = osmpois.extract_pois(str(tmp_path / 'extract.osm'), POIS_TYPES)
+    pois_pbf, roads_pbf = osmpois.extract_pois('osm/test.osm.pbf', POIS_TYPES, bbox=bbox)
+    assert pois_pbf == pois_xml
+    assert numpy.array_equal(roads_pbf, roads_xml)
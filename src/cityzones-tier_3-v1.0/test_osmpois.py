@@ -0,0 +1,42 @@
+import numpy
+import osmpois
+import stagestats
+
+def test_coordinate_store_unsorted():
+    store = osmpois.CoordinateStore()
+    store.extend(numpy.array([5, 1]), numpy.array([[5.0, 50.0], [1.0, 10.0]]))
+    coords, found = store.lookup(numpy.array([1, 2, 5]))
+    assert found.tolist() == [True, False, True]
+    assert coords[found].tolist() == [[1.0, 10.0], [5.0, 50.0]]
+
+    # Elements added after a lookup, out of order and replacing an id
+    store.add(2, 2.0, 20.0)
+    store.add(5, 6.0, 60.0)
+    store.extend(numpy.array([0]), numpy.array([[0.0, 0.0]]))
+    coords, found = store.lookup(numpy.array([0, 1, 2, 5, 7]))
+    assert found.tolist() == [True, True, True, True, False]
+    assert coords[found].tolist() == [[0.0, 0.0], [1.0, 10.0], [2.0, 20.0], [6.0, 60.0]]
+    assert len(store) == 4
+
+UNSORTED_OSM = '''<osm version="0.6">
+<node id="1" lat="-12.24" lon="-38.95"/>
+<node id="2" lat="-12.23" lon="-38.94"/>
+<way id="10"><nd ref="1"/><nd ref="2"/><tag k="highway" v="residential"/></way>
+<node id="3" lat="-12.22" lon="-38.93"><tag k="amenity" v="hospital"/></node>
+<way id="11"><nd ref="3"/><nd ref="4"/><tag k="amenity" v="police"/></way>
+</osm>'''
+
+def test_extract_pois_unsorted(tmp_path):
+    (tmp_path / 'unsorted.osm').write_text(UNSORTED_OSM)
+    stats = stagestats.StageStats()
+    pois, roads = osmpois.extract_pois(str(tmp_path / 'unsorted.osm'), {'amenity': {'hospital': {'w': 10}, 'police': {'w': 2}}}, stats)
+
+    assert [(poi['type'], poi['lat'], poi['lon'], poi['weight']) for poi in pois] == [
+        ('amenity=hospital', -12.22, -38.93, 10),
+        ('amenity=police', -12.22, -38.93, 2)
+    ]
+    assert roads.tolist() == [[-12.24, -38.95, -12.23, -38.94]]
+    assert stats.stages['osm_nodes']['nodes'] == 3
+    assert stats.stages['osm_nodes']['pois'] == 1
+    assert stats.stages['osm_ways']['ways'] == 2
+    assert stats.stages['osm_ways']['roads'] == 1
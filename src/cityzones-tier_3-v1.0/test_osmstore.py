@@ -0,0 +1,52 @@
+import os
+import numpy
+import pytest
+import osmpois
+import osmstore
+import riskzones
+import stagestats
+
+POIS_TYPES = {'amenity': {'hospital': {'w': 10}, 'police': {'w': 2}, 'fire_station': {'w': 5}, 'school': {'w': 1}}}
+
+def rasterize(roads: numpy.ndarray, bbox: tuple) -> numpy.ndarray:
+    left, bottom, right, top = bbox
+    grid = {'left': left, 'bottom': bottom, 'width': right - left, 'height': top - bottom, 'grid_x': 100, 'grid_y': 100}
+    rows, cols = riskzones.rasterize_segments(grid, roads)
+    is_road = numpy.zeros((100, 100), dtype=bool)
+    is_road[rows, cols] = True
+    return is_road
+
+@pytest.mark.parametrize('bbox', [(-38.95, -12.244, -38.94, -12.235), (-38.9548, -12.2459, -38.9349, -12.2298), (10, 10, 11, 11)])
+def test_query_matches_extract(tmp_path, bbox):
+    left, bottom, right, top = bbox
+    osmstore.build('osm/test.osm.pbf', str(tmp_path), 0.005)
+    pois_pbf, roads_pbf = osmpois.extract_pois('osm/test.osm.pbf', POIS_TYPES, bbox=bbox)
+    pois_store, roads_store = osmstore.query(str(tmp_path), bbox, POIS_TYPES)
+
+    # The store keeps only the tags needed by the PoIs
+    pois_pbf = [{key: value for key, value in poi.items() if key in osmstore.POI_FIELDS + ('amenity', 'type')}
+                for poi in pois_pbf if bottom <= poi['lat'] <= top and left <= poi['lon'] <= right]
+    assert pois_store == pois_pbf
+    assert (rasterize(roads_store, bbox) == rasterize(roads_pbf, bbox)).all()
+
+def test_refresh(tmp_path):
+    source = tmp_path / 'source.osm'
+    store = str(tmp_path / 'store')
+    xml = open('osm/test.osm').read()
+    source.write_text(xml)
+    assert osmstore.build(str(source), store, 0.005)
+    assert not osmstore.build(str(source), store, 0.005)
+    pois, _ = osmstore.query(store, (-39, -13, -38, -12), POIS_TYPES)
+    tiles = sorted(os.listdir(os.path.join(store, 'tiles')))
+
+    # Only the tile of the changed PoI is written again
+    source.write_text(xml.replace('v="school"', 'v="police"', 1))
+    stats = stagestats.StageStats()
+    assert osmstore.build(str(source), store, 0.005, stats=stats)
+    assert stats.stages['store_write']['written'] == 1
+    assert sorted(os.listdir(os.path.join(store, 'tiles'))) == tiles
+    refreshed, _ = osmstore.query(store, (-39, -13, -38, -12), POIS_TYPES)
+    assert [poi['type'] for poi in refreshed] == ['amenity=police'] + [poi['type'] for poi in pois[1:]]
+
+    with pytest.raises(ValueError):
+        osmstore.query(store, (-39, -13, -38, -12), {'shop': {'bakery': {'w': 1}}})
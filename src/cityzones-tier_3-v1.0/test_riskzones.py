@@ -0,0 +1,123 @@
+import numpy
+import pytest
+import benchmark
+import riskzones
+
+def make_grid(gx: int, gy: int, tiled: bool = False, tmp_path=None) -> dict:
+    grid = {'grid_x': gx, 'grid_y': gy, 'n_zones': gx * gy, 'tiled': tiled}
+    if tiled:
+        grid['spill_dir'] = str(tmp_path)
+    return grid
+
+def brute_force_distances(gx: int, gy: int, permitted: numpy.ndarray) -> numpy.ndarray:
+    targets = numpy.flatnonzero(permitted)
+    zones = numpy.arange(gx * gy)
+    dx = zones[:, None] % gx - targets[None, :] % gx
+    dy = zones[:, None] // gx - targets[None, :] // gx
+    return (dx ** 2 + dy ** 2).min(axis=1)
+
+@pytest.mark.parametrize('gx, gy', [(130, 100), (100, 130), (300, 100), (7, 90), (64, 64)])
+def test_nearest_permitted_zones_non_square(gx, gy):
+    rng = numpy.random.default_rng(gx * gy)
+    permitted = rng.random(gx * gy) < 0.002
+    permitted[rng.integers(gx * gy)] = True
+    nearest = riskzones.get_nearest_permitted_zones(make_grid(gx, gy), permitted)
+
+    assert permitted[nearest].all()
+    zones = numpy.arange(gx * gy)
+    distances = (zones % gx - nearest % gx) ** 2 + (zones // gx - nearest // gx) ** 2
+    assert (distances == brute_force_distances(gx, gy, permitted)).all()
+
+def test_nearest_permitted_zones_none_permitted():
+    nearest = riskzones.get_nearest_permitted_zones(make_grid(30, 20), numpy.zeros(600, dtype=numpy.bool_))
+    assert (nearest == -1).all()
+
+def test_nearest_permitted_zones_tiled(tmp_path, monkeypatch):
+    gx, gy = 300, 100
+    rng = numpy.random.default_rng(1)
+    permitted = rng.random(gx * gy) < 0.002
+    expected = riskzones.get_nearest_permitted_zones(make_grid(gx, gy), permitted)
+
+    monkeypatch.setattr(riskzones, 'TILE_ZONES', 7 * gx)
+    nearest = riskzones.get_nearest_permitted_zones(make_grid(gx, gy, True, tmp_path), permitted)
+    assert (numpy.asarray(nearest) == expected).all()
+
+def make_city(tmp_path, **conf) -> dict:
+    case = {'size': 3000, 'zone_size': 25, 'vertices': 32, 'pois': 50, 'road_spacing': 200, 'edus': 100}
+    city = benchmark.make_city(str(tmp_path), 'city', case)
+    del city['scenarios']
+    city['edu_alg'] = 'enhanced'
+    city.update(conf)
+    return city
+
+def run_engine(conf: dict, name: str, tmp_path) -> tuple:
+    conf = {**conf, 'output': str(tmp_path / f'{name}.csv'), 'output_edus': str(tmp_path / f'{name}_edus.csv'),
+            'output_roads': str(tmp_path / f'{name}_roads.csv'), 'res_data': str(tmp_path / f'{name}_res_data.json')}
+    engine = riskzones.RiskZonesEngine(conf)
+    try:
+        engine.run()
+    finally:
+        engine.close()
+    outputs = tuple(open(conf[key], 'rb').read() for key in ('output', 'output_edus', 'output_roads'))
+    return outputs, engine.stats.stages
+
+def get_influences(conf: dict) -> tuple:
+    engine = riskzones.RiskZonesEngine(conf)
+    try:
+        engine.load()
+        engine.classify()
+    finally:
+        engine.close()
+    influences = numpy.array(engine.grid['influences'])
+    return influences, numpy.dot(engine.grid['influence_weights'], influences), engine.grid.get('risk_error')
+
+@pytest.fixture
+def no_stage_cache(monkeypatch):
+    monkeypatch.delenv('STAGE_CACHE_DIR', raising=False)
+
+def test_risk_approx_error_bound(tmp_path, no_stage_cache):
+    city = make_city(tmp_path)
+    exact, _, _ = get_influences(city)
+    approx, _, error = get_influences({**city, 'risk_engine': 'approx', 'risk_radius': 300})
+
+    assert 0 < error <= riskzones.RISK_TOLERANCE
+    assert (abs(approx - exact) <= error * exact * (1 + 1e-9)).all()
+
+def test_risk_fft_error(tmp_path, no_stage_cache):
+    city = make_city(tmp_path, zone_size=100)
+    exact, exact_risk, _ = get_influences(city)
+    fft, fft_risk, _ = get_influences({**city, 'risk_engine': 'fft'})
+
+    assert (abs(fft - exact) / exact).max() < 1e-2
+    assert (abs(fft_risk - exact_risk) / exact_risk).max() < 2e-3
+
+def test_tiled_outputs(tmp_path, monkeypatch, no_stage_cache):
+    city = make_city(tmp_path)
+    outputs, stages = run_engine(city, 'memory', tmp_path)
+    assert not stages['grid']['tiled']
+
+    monkeypatch.setattr(riskzones, 'TILED_MEMORY_SHARE', 0)
+    monkeypatch.setattr(riskzones, 'TILE_ZONES', 1000)
+    monkeypatch.setenv('SPILL_DIR', str(tmp_path))
+    tiled, stages = run_engine(city, 'tiled', tmp_path)
+    assert stages['grid']['tiled']
+    assert tiled == outputs
+
+def test_stage_cache_outputs(tmp_path, monkeypatch, no_stage_cache):
+    city = make_city(tmp_path)
+    reweighted = make_city(tmp_path, pois_types={**city['pois_types'], 'amenity': {'hospital': {'w': 1.0},
+                                                 'fire_station': {'w': 5.0}, 'police': {'w': 20.0}}})
+    outputs, _ = run_engine(city, 'fresh', tmp_path)
+    outputs_reweighted, _ = run_engine(reweighted, 'fresh_reweighted', tmp_path)
+
+    monkeypatch.setenv('STAGE_CACHE_DIR', str(tmp_path / 'stages'))
+    first, stages = run_engine(city, 'first', tmp_path)
+    assert not stages['risk']['cached']
+    cached, stages = run_engine(city, 'cached', tmp_path)
+    assert stages['polygon']['cached'] and stages['pois']['cached'] and stages['risk']['cached']
+    assert first == outputs and cached == outputs
+
+    # Only the PoI type weights changed, so the influences are reweighted
+    cached, stages = run_engine(reweighted, 'cached_reweighted', tmp_path)
+    assert stages['risk']['cached']
+    assert cached == outputs_reweighted and cached != outputs
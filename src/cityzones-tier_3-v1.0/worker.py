@@ -21,19 +21,30 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 This script acts as a worker for the CityZones application server.
 
 It will periodically request a task from the web service and run it with
-riskzones.py locally, sending the results back to the web service. The worker
-performs the classifications requested online.
+the RiskZones engine locally, sending the results back to the web service.
+The worker performs the classifications requested online.
+
+Tasks run in the worker process itself, so the engine's process pool is
+started once and kept warm for the next tasks. Map data of each task is read
+from the OSM store in OSM_STORE_DIR, if set, which is built from the regional
+PBF_FILE and refreshed whenever it is updated. Without a store, the area of
+the task is extracted from PBF_FILE with osmium, if OSMIUM_PATH is set, or
+else read straight from PBF_FILE.
 """
 
 from dotenv import load_dotenv
 load_dotenv()
 
 import os
-import sys
 import subprocess
+import signal
+import resource
 import json
 import requests
 import time
+import riskzones
+import osmstore
+import multiprocessing as mp
 from requests_toolbelt import MultipartEncoder
 from datetime import datetime
 
@@ -42,6 +53,12 @@ sleep_time = int(os.getenv('SLEEP_INT'))
 def logger(text: str):
     print(f'{datetime.now().isoformat()}: {text}')
 
+def timeout_handler(signum, frame):
+    """
+    Stop a task that runs for longer than SUBPROC_TIMEOUT.
+    """
+    raise TimeoutError()
+
 def delete_task_files(task: dict):
     """
     Delete task files described in its config data.
@@ -49,16 +66,35 @@ def delete_task_files(task: dict):
     fileslist = []
     fileslist.append(f"{os.getenv('TASKS_DIR')}/{task['config']['base_filename']}.json")
     fileslist.append(task['config']['geojson'])
-    fileslist.append(task['config']['pois'])
     fileslist.append(task['config']['output'])
     fileslist.append(task['config']['output_edus'])
     fileslist.append(task['config']['output_roads'])
     fileslist.append(task['config']['res_data'])
+    if 'output_raster' in task['config'].keys():
+        fileslist.append(task['config']['output_raster'])
+    if task['config']['pois'].startswith(f"{os.getenv('TASKS_DIR')}/"):
+        fileslist.append(task['config']['pois'])
 
     for file in fileslist:
         if os.path.isfile(file):
             os.remove(file)
 
+def refresh_store():
+    """
+    Build the OSM store in OSM_STORE_DIR from PBF_FILE, or refresh it if the
+    file was updated since it was built.
+    """
+    if os.getenv('OSM_STORE_DIR') == None:
+        return
+
+    try:
+        if osmstore.build(os.getenv('PBF_FILE'), os.getenv('OSM_STORE_DIR'), pool=riskzones.get_pool()):
+            logger(f'OSM store {os.getenv("OSM_STORE_DIR")} refreshed from {os.getenv("PBF_FILE")}.')
+    except Exception as e:
+        logger(f'There was an error while refreshing the OSM store: {e}')
+    finally:
+        riskzones.get_pool().release()
+
 def get_task() -> dict:
     """
     Request a task from the web app.
@@ -93,69 +129,86 @@ def process_task(task: dict):
     # Apply directories path to configuration
     try:
         config['geojson'] = f"{os.getenv('TASKS_DIR')}/{config['geojson']}"
-        config['pois'] = f"{os.getenv('TASKS_DIR')}/{config['pois']}"
+        if os.getenv('OSM_STORE_DIR') != None and osmstore.load_manifest(os.getenv('OSM_STORE_DIR')) != None:
+            config['pois'] = os.getenv('OSM_STORE_DIR')
+        elif os.getenv('OSMIUM_PATH') != None:
+            config['pois'] = f"{os.getenv('TASKS_DIR')}/{config['pois']}"
+        else:
+            config['pois'] = os.getenv('PBF_FILE')
         config['output'] = f"{os.getenv('OUT_DIR')}/{config['output']}"
         config['output_edus'] = f"{os.getenv('OUT_DIR')}/{config['output_edus']}"
         config['output_roads'] = f"{os.getenv('OUT_DIR')}/{config['output_roads']}"
         config['res_data'] = f"{os.getenv('OUT_DIR')}/{config['res_data']}"
+        if 'output_raster' in config.keys():
+            config['output_raster'] = f"{os.getenv('OUT_DIR')}/{config['output_raster']}"
         filename = f"{os.getenv('TASKS_DIR')}/{config['base_filename']}.json"
     except KeyError:
         logger('A key is missing in task JSON file. Aborting!')
         return
 
-    # Write temp configuration files
-    fp_config = open(filename, 'w')
-    json.dump(config, fp_config)
-    fp_config.close()
-
+    # Write temp GeoJSON file
     fp_geojson = open(f"{config['geojson']}", 'w')
     json.dump(geojson, fp_geojson)
     fp_geojson.close()
 
     # Extract data from PBF file
+    if config['pois'].startswith(f"{os.getenv('TASKS_DIR')}/"):
+        try:
+            res = subprocess.run([
+                os.getenv('OSMIUM_PATH'),
+                'extract',
+                '-b',
+                f'{config["left"]},{config["bottom"]},{config["right"]},{config["top"]}',
+                os.getenv('PBF_FILE'),
+                '-o',
+                config['pois'],
+                '--overwrite'
+            ], capture_output=True, timeout=int(os.getenv('SUBPROC_TIMEOUT')))
+        except subprocess.TimeoutExpired:
+            logger("Timeout running osmium for the task's AoI.")
+            return
+
+        if res.returncode != 0:
+            logger(f'There was an error while extracting map data using {config["base_filename"]} coordinates.')
+            return
+
+    # Run the RiskZones engine. The memory limit of this process applies only
+    # while it runs; the pool workers always have it (see riskzones.get_pool).
+    engine = riskzones.RiskZonesEngine(config, f'{os.path.splitext(filename)[0]}.cache')
+    limits = riskzones.set_memory_limit()
+    signal.signal(signal.SIGALRM, timeout_handler)
+    signal.alarm(int(os.getenv('SUBPROC_TIMEOUT')))
     try:
-        res = subprocess.run([
-            os.getenv('OSMIUM_PATH'),
-            'extract',
-            '-b',
-            f'{config["left"]},{config["bottom"]},{config["right"]},{config["top"]}',
-            os.getenv('PBF_FILE'),
-            '-o',
-            config['pois'],
-            '--overwrite'
-        ], capture_output=True, timeout=int(os.getenv('SUBPROC_TIMEOUT')))
-    except subprocess.TimeoutExpired:
-        logger("Timeout running osmium for the task's AoI.")
-        return
-
-    if res.returncode != 0:
-        logger(f'There was an error while extracting map data using {config["base_filename"]} coordinates.')
-        return
-
-    # Run riskzones.py
-    try:
-        res = subprocess.run([
-            sys.executable,
-            'riskzones.py',
-            filename
-        ], timeout=int(os.getenv('SUBPROC_TIMEOUT')))
-    except subprocess.TimeoutExpired:
+        engine.run()
+    except TimeoutError:
+        # The pool workers may still be busy with the task, so stop them
         logger("Timeout running RiskZones for the task.")
+        riskzones.close_pool(True)
         return
-
-    if res.returncode != 0:
-        logger(f'There was an error while running riskzones.py for {config["base_filename"]}.')
+    except Exception as e:
+        logger(f'There was an error while running RiskZones for {config["base_filename"]}: {e}')
         return
-
-    # Post results to the web app
-    encoder = MultipartEncoder(
-        fields={
+    finally:
+        signal.alarm(0)
+        engine.close()
+        resource.setrlimit(resource.RLIMIT_DATA, limits)
+
+    # Post results to the web app. If there is a raster result, it replaces the
+    # map and roads CSV files, which the server can rebuild from it.
+    if 'output_raster' in config.keys():
+        fields = {
+            'raster': ('raster.npz', open(config['output_raster'], 'rb'), 'application/octet-stream'),
+            'edus': ('edus.csv', open(config['output_edus'], 'rb'), 'text/csv'),
+            'res_data': ('res_data.json', open(config['res_data'], 'rb'), 'application/json'),
+        }
+    else:
+        fields = {
             'map': ('map.csv', open(config['output'], 'rb'), 'text/csv'),
             'edus': ('edus.csv', open(config['output_edus'], 'rb'), 'text/csv'),
             'roads': ('roads.csv', open(config['output_roads'], 'rb'), 'text/csv'),
             'res_data': ('res_data.json', open(config['res_data'], 'rb'), 'application/json'),
         }
-    )
+    encoder = MultipartEncoder(fields=fields)
 
     logger(f'Sending data to web service...')
     try:
@@ -179,6 +232,9 @@ def process_task(task: dict):
         logger(f'There was an error trying to connect to the server.')
     
 if __name__ == '__main__':
+    # Python multiprocessing start method
+    mp.set_start_method('spawn')
+
     # Create the queue and output directories
     try:
         os.makedirs(os.getenv('TASKS_DIR'))
@@ -188,6 +244,7 @@ if __name__ == '__main__':
 
     # Main loop
     while True:
+        refresh_store()
         task = get_task()
         if task != None:
             process_task(task)